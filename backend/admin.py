@@ -0,0 +1,77 @@
+import argparse
+import backup
+import database
+import media
+import utils
+
+# ==========================================
+# TAREAS DE MANTENIMIENTO (LÍNEA DE COMANDOS)
+# ==========================================
+# Uso (desde backend/):
+#     python admin.py migrar
+#     python admin.py reconstruir-metricas
+#     python admin.py reconstruir-busqueda
+#     python admin.py gc-media [--gracia SEGUNDOS]
+#     python admin.py encolar-correos-pendientes
+#     python admin.py backup [--tipo completo|incremental]
+#     python admin.py restaurar DESTINO [--carpeta DIR] [--hasta AAAA-MM-DD_HHMMSS]
+
+def cmd_migrar(args):
+    version = database.migrar()
+    print(f"✅ Esquema en la versión {version}")
+
+def cmd_reconstruir_metricas(args):
+    database.migrar()
+    total, pendientes, cliente_top = database.reconstruir_metricas()
+    print(f"✅ Métricas recalculadas: {total} reportes, {pendientes} pendientes, top {cliente_top}")
+
+def cmd_reconstruir_busqueda(args):
+    database.migrar()
+    n = database.reconstruir_busqueda()
+    print(f"✅ Índice de búsqueda reconstruido: {n} reportes")
+
+def cmd_gc_media(args):
+    database.migrar()
+    borrados = media.recolectar_basura(gracia=args.gracia)
+    print(f"✅ {borrados} archivos sin uso eliminados del almacén de fotos")
+
+def cmd_encolar_correos(args):
+    database.migrar()
+    fecha = utils.obtener_hora_chile().strftime('%Y-%m-%d %H:%M:%S')
+    n = database.encolar_correos_pendientes(fecha)
+    print(f"✅ {n} reportes antiguos sin correo encolados (el worker de la API los procesará)")
+
+def cmd_backup(args):
+    database.migrar()
+    ok, msg = backup.ejecutar_backup(origen="consola", tipo=args.tipo)
+    if not ok: raise SystemExit(1)
+
+def cmd_restaurar(args):
+    base, incrementales, claves = backup.restaurar(args.destino, args.carpeta, args.hasta)
+    print(f"✅ {args.destino} restaurada desde {base} + {incrementales} incrementales ({claves} claves aplicadas)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Mantenimiento de la base de Tecnocomp")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    sub.add_parser("migrar", help="Aplica las migraciones pendientes").set_defaults(fn=cmd_migrar)
+    sub.add_parser("reconstruir-metricas", help="Recalcula las tablas metricas_* desde reportes").set_defaults(fn=cmd_reconstruir_metricas)
+    sub.add_parser("reconstruir-busqueda", help="Rehace el índice de texto reportes_fts").set_defaults(fn=cmd_reconstruir_busqueda)
+    gc = sub.add_parser("gc-media", help="Borra fotos/firmas que ningún reporte usa")
+    gc.add_argument("--gracia", type=int, default=None, help="Antigüedad mínima en segundos (MEDIA_GC_GRACIA por defecto)")
+    gc.set_defaults(fn=cmd_gc_media)
+    sub.add_parser(
+        "encolar-correos-pendientes", help="Regenera PDF y envía el correo de reportes antiguos con email_enviado = 0"
+    ).set_defaults(fn=cmd_encolar_correos)
+    bk = sub.add_parser("backup", help="Respalda la base en SharePoint (y poda los antiguos)")
+    bk.add_argument("--tipo", choices=backup.TIPOS, default=None, help="Por defecto, completo cada BACKUP_COMPLETO_DIAS")
+    bk.set_defaults(fn=cmd_backup)
+    rs = sub.add_parser("restaurar", help="Arma una base nueva con el último respaldo completo y sus incrementales")
+    rs.add_argument("destino", help="Ruta de la base a crear (no debe existir)")
+    rs.add_argument("--carpeta", default=None, help="Leer los respaldos de esta carpeta local en vez de SharePoint")
+    rs.add_argument("--hasta", default=None, help="Ignorar respaldos posteriores a esta fecha (AAAA-MM-DD_HHMMSS)")
+    rs.set_defaults(fn=cmd_restaurar)
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == "__main__":
+    main()
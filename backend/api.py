@@ -1,23 +1,47 @@
-import shutil
 import os
+import io
+import hashlib
+import csv
 import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
 from typing import List, Optional
-from datetime import datetime
-# IMPORTANTE: Agregamos BackgroundTasks para tareas en segundo plano
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Query, Header
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 
 import database
 import utils
-import pdf_generator
 import config
+import pipeline
+import recepcion
+import cache_maestros
+import media
+import backup
 
 app = FastAPI(title="Tecnocomp API")
 
-# Inicializamos la DB
-database.inicializar_db()
+# --- WORKER DEL PIPELINE DE REPORTES ---
+@app.on_event("startup")
+def iniciar_pipeline():
+    # La DB se inicializa al arrancar y no al importar: los procesos de render
+    # (spawn) reimportan este archivo como __mp_main__ cuando se lanza con `python api.py`
+    database.inicializar_db()
+    # Token e IDs de SharePoint se precargan sin bloquear el arranque
+    threading.Thread(target=utils.precalentar_sharepoint, daemon=True).start()
+    pipeline.iniciar_worker()
+    media.iniciar_gc()
+    backup.iniciar_programador()
+
+@app.on_event("shutdown")
+def detener_pipeline():
+    backup.detener_programador()
+    media.detener_gc()
+    pipeline.detener_worker()
 
 # --- MODELOS ---
 class ClienteBase(BaseModel):
@@ -33,27 +57,38 @@ class UsuarioBase(BaseModel):
     cliente: str
 
 # --- ENDPOINTS DE LECTURA ---
+# Responden desde cache_maestros con ETag (304 si la tablet ya tiene la versión)
 @app.get("/clientes")
-def get_clientes(): return database.obtener_clientes()
+def get_clientes(request: Request):
+    return cache_maestros.responder(request, "clientes", database.obtener_clientes)
 
 @app.get("/tecnicos")
-def get_tecnicos(): return database.obtener_tecnicos()
+def get_tecnicos(request: Request):
+    return cache_maestros.responder(request, "tecnicos", database.obtener_tecnicos)
 
 # --- NUEVO: OBTENER TODOS LOS USUARIOS (Para sincronizar entre tablets) ---
 @app.get("/usuarios_todos")
-def get_all_usuarios():
-    # Conectamos directamente para sacar todo el listado global
-    con = database.conectar()
-    cur = con.cursor()
-    cur.execute("SELECT nombre, cliente_nombre FROM usuarios")
+def get_all_usuarios(request: Request):
     # Formateamos como lista de diccionarios
-    datos = [{"nombre": row[0], "cliente": row[1]} for row in cur.fetchall()]
-    con.close()
-    return datos
+    return cache_maestros.responder(
+        request, "usuarios",
+        lambda: [{"nombre": row[0], "cliente": row[1]} for row in database.obtener_todos_usuarios()]
+    )
+
+@app.get("/sync")
+def sync(since: Optional[int] = Query(None, ge=0)):
+    """
+    Cambios de clientes, técnicos y usuarios desde el cursor `since` que la
+    tablet guardó en su última sincronización (sin `since` = descarga completa).
+    La tablet aplica `upsert` y `delete` de cada tabla y guarda el `cursor` nuevo.
+    """
+    cursor, completo, cambios = database.obtener_cambios_desde(since)
+    return {"cursor": cursor, "completo": completo, **cambios}
 
 @app.post("/clientes")
 def create_cliente(cliente: ClienteBase):
-    database.agregar_cliente(cliente.nombre, cliente.email)
+    if database.agregar_cliente(cliente.nombre, cliente.email):
+        cache_maestros.invalidar("clientes")
     return {"status": "ok"}
 
 # --- NUEVO: CREAR TÉCNICO ---
@@ -61,6 +96,7 @@ def create_cliente(cliente: ClienteBase):
 def create_tecnico(tecnico: TecnicoBase):
     # Usamos la función que ya existe en database.py
     if database.agregar_nuevo_tecnico(tecnico.nombre):
+        cache_maestros.invalidar("tecnicos")
         return {"status": "ok", "message": "Técnico creado"}
     else:
         # Si ya existe o falla, devolvemos ok para no trabar la sync
@@ -69,70 +105,290 @@ def create_tecnico(tecnico: TecnicoBase):
 # --- NUEVO: CREAR USUARIO ---
 @app.post("/usuarios")
 def create_usuario(usuario: UsuarioBase):
-    if database.agregar_usuario(usuario.nombre, usuario.cliente):
+    try:
+        creado = database.agregar_usuario(usuario.nombre, usuario.cliente)
+    except sqlite3.IntegrityError:
+        # Sin el cliente el usuario no se puede guardar: la tablet debe enviarlo antes
+        raise HTTPException(status_code=422, detail=f"Cliente '{usuario.cliente}' no existe")
+    if creado:
+        cache_maestros.invalidar("usuarios")
         return {"status": "ok", "message": "Usuario creado"}
     else:
         return {"status": "ok", "message": "Usuario ya existía o error"}
 
 @app.get("/usuarios/{cliente_nombre}")
-def get_usuarios(cliente_nombre: str):
-    return database.obtener_usuarios_por_cliente(cliente_nombre)
+def get_usuarios(cliente_nombre: str, request: Request):
+    return cache_maestros.responder(
+        request, "usuarios",
+        lambda: database.obtener_usuarios_por_cliente(cliente_nombre),
+        clave=cliente_nombre
+    )
+
+# --- CARGA MASIVA (JSON o CSV) ---
+async def _leer_lote(request: Request, columnas):
+    """
+    Filas del cuerpo como lista de dicts: un arreglo JSON de objetos o, con
+    Content-Type text/csv, un CSV con encabezado (se ignoran columnas extra).
+    """
+    cuerpo = await request.body()
+    tipo = request.headers.get("content-type", "")
+    try:
+        if "csv" in tipo:
+            texto = cuerpo.decode("utf-8-sig")
+            # Excel en español exporta con ';'
+            encabezado = texto.split("\n", 1)[0]
+            separador = ";" if ";" in encabezado and "," not in encabezado else ","
+            filas = list(csv.DictReader(io.StringIO(texto), delimiter=separador))
+        else:
+            filas = json.loads(cuerpo)
+            if not isinstance(filas, list) or not all(isinstance(f, dict) for f in filas):
+                raise ValueError("Se esperaba un arreglo de objetos")
+    except (ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Lote inválido: {e}")
+    if len(filas) > config.LOTE_MAX_FILAS:
+        raise HTTPException(status_code=413, detail=f"Máximo {config.LOTE_MAX_FILAS} filas por lote")
+    return [{c: (f.get(c) or "") for c in columnas} for f in filas]
+
+def _resumen_lote(filas, resultados):
+    resumen = {}
+    for r in resultados:
+        tipo = r.split(":")[0]
+        resumen[tipo] = resumen.get(tipo, 0) + 1
+    return {
+        "status": "ok",
+        "resumen": resumen,
+        "filas": [{"fila": i + 1, **f, "resultado": r} for i, (f, r) in enumerate(zip(filas, resultados))]
+    }
+
+@app.post("/clientes/lote")
+async def importar_clientes(request: Request):
+    filas = await _leer_lote(request, ["nombre", "email"])
+    resultados = await run_in_threadpool(database.importar_clientes, [(f["nombre"], f["email"]) for f in filas])
+    cache_maestros.invalidar("clientes")
+    return _resumen_lote(filas, resultados)
+
+@app.post("/tecnicos/lote")
+async def importar_tecnicos(request: Request):
+    filas = await _leer_lote(request, ["nombre"])
+    resultados = await run_in_threadpool(database.importar_tecnicos, [f["nombre"] for f in filas])
+    cache_maestros.invalidar("tecnicos")
+    return _resumen_lote(filas, resultados)
+
+@app.post("/usuarios/lote")
+async def importar_usuarios(request: Request):
+    filas = await _leer_lote(request, ["nombre", "cliente"])
+    resultados = await run_in_threadpool(database.importar_usuarios, [(f["nombre"], f["cliente"]) for f in filas])
+    cache_maestros.invalidar("usuarios")
+    return _resumen_lote(filas, resultados)
+
+# --- MÉTRICAS (tablas materializadas, no recorren reportes) ---
+@app.get("/metricas")
+def get_metricas(meses: int = Query(12, ge=1, le=120)):
+    total, pendientes, cliente_top = database.obtener_kpis_generales()
+    return {
+        "total": total,
+        "pendientes": pendientes,
+        "cliente_top": cliente_top,
+        "por_cliente": [{"cliente": c, "reportes": n} for c, n in database.obtener_datos_clientes()],
+        "por_tecnico": [{"tecnico": t, "reportes": n} for t, n in database.obtener_datos_tecnicos()],
+        "por_mes": [{"mes": m, "reportes": n} for m, n in database.obtener_evolucion_mensual(meses)],
+        "pendientes_por_cliente": [{"cliente": c, "pendientes": n} for c, n in database.obtener_pendientes_por_cliente()],
+    }
+
+# --- CONSULTAS POR USUARIO Y TAREA (tablas reporte_usuarios / reporte_tareas) ---
+@app.get("/metricas/atenciones")
+def get_atenciones(cliente: Optional[str] = None, usuario: Optional[str] = None,
+                   desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Cuántas veces fue atendido (o no) cada usuario. Fechas YYYY-MM-DD, ambas inclusive."""
+    filas = database.obtener_atenciones_usuarios(
+        cliente, usuario, _fecha_filtro(desde, "desde"), _fecha_filtro(hasta, "hasta", dia_siguiente=True)
+    )
+    return [
+        {"cliente": c, "usuario": u, "atendido": a, "no_atendido": n, "ultima_visita": f}
+        for c, u, a, n, f in filas
+    ]
+
+@app.get("/metricas/tareas")
+def get_tareas(cliente: Optional[str] = None, desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Tareas de mantenimiento realizadas en el período, de la más frecuente a la menos."""
+    filas = database.obtener_conteo_tareas(
+        cliente, _fecha_filtro(desde, "desde"), _fecha_filtro(hasta, "hasta", dia_siguiente=True)
+    )
+    return [{"tarea": t, "veces": n, "visitas": v} for t, n, v in filas]
+
+# --- FOTOS Y FIRMAS (almacén de media) ---
+@app.get("/media/{sha}")
+def get_media(sha: str):
+    fila = database.obtener_media(sha)
+    if not fila or not os.path.exists(media.ruta_absoluta(fila[0])):
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    # El contenido de un sha nunca cambia
+    return FileResponse(media.ruta_absoluta(fila[0]), headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.get("/media/{sha}/miniatura")
+def get_miniatura(sha: str):
+    ruta = media.obtener_miniatura(sha)
+    if not ruta:
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    return FileResponse(ruta, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+# --- HISTORIAL DE REPORTES (paginado) ---
+def _fecha_filtro(valor, nombre, dia_siguiente=False):
+    if not valor: return None
+    try:
+        dia = datetime.strptime(valor, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"'{nombre}' debe tener formato YYYY-MM-DD")
+    if dia_siguiente: dia += timedelta(days=1)
+    return dia.strftime("%Y-%m-%d")
+
+def _json_o_lista(valor):
+    try: return json.loads(valor) if valor else []
+    except ValueError: return []
+
+@app.get("/reportes")
+def listar_reportes(
+    cliente: Optional[str] = None,
+    tecnico: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    email: Optional[str] = Query(None, pattern="^(enviado|pendiente)$"),
+    antes_de: Optional[int] = None,
+    limite: int = Query(50, ge=1, le=200),
+    completo: bool = False
+):
+    """
+    Historial del más nuevo al más antiguo. Para la página siguiente se envía
+    `antes_de=<siguiente>` de la respuesta anterior. Por defecto no incluye
+    detalles_usuarios ni fotos (`completo=true` para incluirlos).
+    `desde`/`hasta` son fechas YYYY-MM-DD, ambas inclusive.
+    """
+    items, siguiente = database.buscar_reportes(
+        cliente=cliente,
+        tecnico=tecnico,
+        desde=_fecha_filtro(desde, "desde"),
+        hasta=_fecha_filtro(hasta, "hasta", dia_siguiente=True),
+        email_enviado=None if email is None else email == "enviado",
+        antes_de=antes_de,
+        limite=limite,
+        completo=completo
+    )
+    if completo:
+        for item in items:
+            item["detalles_usuarios"] = _json_o_lista(item["detalles_usuarios"])
+            item["imagen_path"] = _json_o_lista(item["imagen_path"])
+    return {"items": items, "siguiente": siguiente}
+
+@app.get("/reportes/buscar")
+def buscar_reportes_texto(
+    q: str,
+    cliente: Optional[str] = None,
+    tecnico: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    desplazamiento: int = Query(0, ge=0),
+    limite: int = Query(20, ge=1, le=100)
+):
+    """
+    Busca en observaciones, trabajo y motivo de cada usuario, nombres de usuarios,
+    cliente y técnico. Cada palabra vale como prefijo; "entre comillas" busca la frase.
+    Ordenado por relevancia; para la página siguiente se envía
+    `desplazamiento=<siguiente>` de la respuesta anterior.
+    """
+    consulta = database.consulta_fts(q)
+    if not consulta:
+        raise HTTPException(status_code=422, detail="La búsqueda no tiene palabras")
+    total, items = database.buscar_texto(
+        consulta,
+        cliente=cliente,
+        tecnico=tecnico,
+        desde=_fecha_filtro(desde, "desde"),
+        hasta=_fecha_filtro(hasta, "hasta", dia_siguiente=True),
+        limite=limite,
+        desplazamiento=desplazamiento
+    )
+    siguiente = desplazamiento + limite if desplazamiento + limite < total else None
+    return {"total": total, "items": items, "siguiente": siguiente}
+
+@app.get("/reporte/{reporte_id}")
+def get_reporte(reporte_id: int):
+    reporte = database.obtener_reporte_detalle(reporte_id)
+    if not reporte:
+        raise HTTPException(status_code=404, detail="Reporte no encontrado")
+    reporte["detalles_usuarios"] = _json_o_lista(reporte["detalles_usuarios"])
+    reporte["imagen_path"] = _json_o_lista(reporte["imagen_path"])
+    reporte["fotos"] = [
+        {"usuario": u, "posicion": p, "ruta": r} for u, p, r in database.obtener_fotos_reporte(reporte_id)
+    ]
+    reporte["etapas"] = [
+        {"etapa": e[0], "estado": e[1], "intentos": e[2], "mensaje": e[3], "actualizado": e[4]}
+        for e in database.obtener_etapas_reporte(reporte_id)
+    ]
+    return reporte
+
+# --- COLA DE ENTREGA (etapas en 'error' = dead letter) ---
+@app.get("/pipeline/estado")
+def estado_pipeline():
+    resumen = {}
+    for etapa, estado, cantidad in database.obtener_resumen_etapas():
+        resumen.setdefault(etapa, {})[estado] = cantidad
+    return resumen
+
+@app.get("/pipeline/fallidas")
+def etapas_fallidas(limite: int = Query(100, ge=1, le=1000)):
+    return [
+        {"reporte_id": r, "cliente": c, "fecha": f, "etapa": e, "intentos": i, "mensaje": m, "actualizado": a}
+        for r, c, f, e, i, m, a in database.obtener_etapas_fallidas(limite)
+    ]
+
+@app.post("/pipeline/reintentar")
+def reintentar_fallidas(reporte_id: Optional[int] = None, etapa: Optional[str] = None):
+    """Reencola etapas en 'error' (todas, las de un reporte y/o las de un tipo de etapa)."""
+    if etapa and etapa not in config.PIPELINE_ETAPAS:
+        raise HTTPException(status_code=422, detail=f"Etapa desconocida: {etapa}")
+    fecha = utils.obtener_hora_chile().strftime('%Y-%m-%d %H:%M:%S')
+    n = database.reencolar_fallidas(fecha, reporte_id, etapa)
+    if n: pipeline.notificar()
+    return {"status": "ok", "reencoladas": n}
 
 # --- ENDPOINT DE BACKUP MANUAL ---
 @app.get("/sistema/backup")
-def forzar_backup():
+def forzar_backup(tipo: Optional[str] = None):
     """
     Llama a este link para guardar una copia de la DB en SharePoint.
+    El respaldo corre en segundo plano: se consulta en /sistema/backup/{trabajo}.
+    `tipo` (completo / incremental) fuerza uno; sin él se elige como en los programados.
     """
-    ok, msg = utils.subir_backup_database()
-    return {"status": "ok" if ok else "error", "mensaje": msg}
-
-# --- FUNCIÓN DE LIMPIEZA (Se ejecuta después de responder) ---
-def eliminar_archivos_temporales(rutas: List[str]):
-    print(f"🧹 Iniciando limpieza de {len(rutas)} archivos temporales...")
-    for ruta in rutas:
-        try:
-            if os.path.exists(ruta):
-                os.remove(ruta)
-                print(f"   - Borrado: {ruta}")
-        except Exception as e:
-            print(f"   ⚠️ Error borrando {ruta}: {e}")
+    if tipo and tipo not in backup.TIPOS:
+        raise HTTPException(status_code=422, detail=f"Tipo de respaldo desconocido: {tipo}")
+    trabajo, nuevo = backup.iniciar_backup(tipo=tipo)
+    return JSONResponse(status_code=202, content={
+        "status": "ok", "trabajo": trabajo["id"], "nuevo": nuevo,
+        "estado": trabajo["estado"], "url": f"/sistema/backup/{trabajo['id']}"
+    })
+
+@app.get("/sistema/backup/{trabajo_id}")
+def estado_backup(trabajo_id: str):
+    trabajo = backup.obtener_trabajo(trabajo_id)
+    if not trabajo:
+        raise HTTPException(status_code=404, detail="Trabajo de respaldo no encontrado")
+    return trabajo
 
 # --- ENDPOINTS DE BORRADO ---
 
 @app.delete("/reporte/{reporte_id}")
 def borrar_reporte(reporte_id: int):
-    try:
-        # Nota: Asegúrate de que database.eliminar_reporte exista o usa una query directa
-        # Si no tienes la función en database.py, puedes descomentar esto:
-        # con = database.conectar()
-        # con.execute("DELETE FROM reportes WHERE id = ?", (reporte_id,))
-        # con.commit()
-        # con.close()
-        # return {"status": "ok"}
-        
-        # Asumiendo que existe o usando una genérica:
-        con = database.conectar()
-        cur = con.cursor()
-        cur.execute("DELETE FROM reportes WHERE id = ?", (reporte_id,))
-        filas = cur.rowcount
-        con.commit()
-        con.close()
-        
-        if filas > 0:
-            return {"status": "ok", "message": "Eliminado correctamente"}
-        else:
-            raise HTTPException(status_code=404, detail="Reporte no encontrado")
-            
-    except Exception as e:
-        print(f"Error borrando reporte: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    if database.eliminar_reporte(reporte_id):
+        return {"status": "ok", "message": "Eliminado correctamente"}
+    raise HTTPException(status_code=404, detail="Reporte no encontrado")
 
 @app.delete("/cliente/{nombre}")
 def borrar_cliente(nombre: str):
     import urllib.parse
     nombre_limpio = urllib.parse.unquote(nombre)
     if database.eliminar_cliente(nombre_limpio):
+        # Sus usuarios se borran junto con el cliente
+        cache_maestros.invalidar("clientes", "usuarios")
         return {"status": "ok", "message": f"Cliente {nombre_limpio} eliminado"}
     raise HTTPException(status_code=404, detail="Cliente no encontrado")
 
@@ -141,6 +397,7 @@ def borrar_tecnico(nombre: str):
     import urllib.parse
     nombre_limpio = urllib.parse.unquote(nombre)
     if database.eliminar_tecnico(nombre_limpio):
+        cache_maestros.invalidar("tecnicos")
         return {"status": "ok", "message": f"Técnico {nombre_limpio} eliminado"}
     raise HTTPException(status_code=404, detail="Técnico no encontrado")
 
@@ -150,13 +407,45 @@ def borrar_usuario(cliente: str, nombre: str):
     cliente_limpio = urllib.parse.unquote(cliente)
     nombre_limpio = urllib.parse.unquote(nombre)
     if database.eliminar_usuario(nombre_limpio, cliente_limpio):
+        cache_maestros.invalidar("usuarios")
         return {"status": "ok", "message": f"Usuario {nombre_limpio} eliminado"}
     raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
 
+# --- LÍMITE DE TAMAÑO ANTES DE PARSEAR EL MULTIPART ---
+@app.middleware("http")
+async def limitar_tamano_reporte(request: Request, call_next):
+    if request.url.path == "/reporte/crear":
+        largo = request.headers.get("content-length")
+        if largo and largo.isdigit() and int(largo) > config.RECEPCION_MAX_PETICION:
+            return JSONResponse(status_code=413, content={"detail": "La visita supera el tamaño máximo permitido"})
+    return await call_next(request)
+
+# --- IDEMPOTENCIA DE /reporte/crear ---
+def _huella_visita(cliente, tecnico, obs, datos_usuarios):
+    # Identifica el contenido de la visita: la misma clave con otra visita es un error de la tablet
+    return hashlib.sha256(json.dumps([cliente, tecnico, obs, datos_usuarios]).encode("utf-8")).hexdigest()
+
+def _vencimiento_idempotencia(ahora):
+    # Claves creadas antes de esto ya no cuentan (IDEMPOTENCIA_TTL_HORAS)
+    return (ahora - timedelta(hours=config.IDEMPOTENCIA_TTL_HORAS)).strftime('%Y-%m-%d %H:%M:%S')
+
+def _respuesta_repetida(clave, huella_original, huella, reporte_id):
+    if huella_original != huella:
+        raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otra visita")
+    print(f"🔁 Reintento de la visita {reporte_id} (Idempotency-Key {clave}): no se procesa de nuevo")
+    return JSONResponse(
+        content={
+            "status": "success",
+            "server_id": reporte_id,
+            "job_id": reporte_id,
+            "message": "Reporte ya recibido anteriormente. Consulte su estado."
+        },
+        headers={"Idempotent-Replayed": "true"}
+    )
+
 @app.post("/reporte/crear")
 async def crear_reporte(
-    background_tasks: BackgroundTasks, 
     cliente: str = Form(...),
     tecnico: str = Form(...),
     obs: str = Form(""),
@@ -165,42 +454,63 @@ async def crear_reporte(
     email_tecnico: str = Form(None),
     firma_tecnico: UploadFile = File(None),
     fotos: List[UploadFile] = File(None),
-    firmas_usuarios: List[UploadFile] = File(None) 
+    firmas_usuarios: List[UploadFile] = File(None),
+    idempotency_key: Optional[str] = Header(None, max_length=255)
 ):
-    
-    archivos_para_borrar = []
+    """
+    Recibe la visita, guarda archivos y el registro, y responde de inmediato.
+    PDF, SharePoint, lista y correo los ejecuta el worker de `pipeline`;
+    el avance se consulta en GET /reporte/{id}/estado.
+    Con la cabecera Idempotency-Key, un reintento de la misma visita devuelve
+    el reporte original (y su job_id) sin guardar ni procesar nada de nuevo.
+    Las llamadas a SQLite van por run_in_threadpool: pueden esperar un lock
+    (hasta DB_BUSY_TIMEOUT_MS) y no deben detener el event loop.
+    """
+    huella = _huella_visita(cliente, tecnico, obs, datos_usuarios)
+    if idempotency_key:
+        previo = await run_in_threadpool(
+            database.buscar_idempotencia, idempotency_key, _vencimiento_idempotencia(utils.obtener_hora_chile())
+        )
+        if previo:
+            return _respuesta_repetida(idempotency_key, previo[1], huella, previo[0])
+
+    # Backpressure: si ya hay demasiados PDFs por generar, la tablet reintenta después
+    if await run_in_threadpool(database.contar_etapas_pendientes, "pdf") >= config.RENDER_MAX_COLA:
+        raise HTTPException(
+            status_code=503,
+            detail="Servidor ocupado generando reportes. Reintente en unos segundos.",
+            headers={"Retry-After": str(config.RENDER_RETRY_AFTER)}
+        )
 
     try:
         # 0. Actualizar email
         if email_cliente:
-            database.agregar_cliente(cliente, email_cliente)
+            # Solo cambia la versión (ETag) si el email era otro
+            if await run_in_threadpool(database.agregar_cliente, cliente, email_cliente):
+                cache_maestros.invalidar("clientes")
             config.CORREOS_POR_CLIENTE[cliente] = email_cliente
 
         usuarios_parsed = json.loads(datos_usuarios)
-        temp_dir = config.TEMP_FOLDER
-        if not os.path.exists(temp_dir): os.makedirs(temp_dir)
+        # Límite de bytes compartido por todas las fotos y firmas de esta visita
+        presupuesto = recepcion.PresupuestoSubida()
 
-        # 1. Guardar Fotos
+        # 1. Guardar Fotos (streaming al almacén de media, nombre = SHA-256 del contenido)
         rutas_fotos_servidor = []
+        archivos_media = []
         if fotos:
             for foto in fotos:
-                clean_name = os.path.basename(foto.filename)
-                ruta_dest = f"{temp_dir}/{clean_name}"
-                with open(ruta_dest, "wb") as buffer:
-                    shutil.copyfileobj(foto.file, buffer)
-                rutas_fotos_servidor.append(os.path.abspath(ruta_dest))
-                archivos_para_borrar.append(os.path.abspath(ruta_dest))
-
-        # 2. Guardar Firmas
+                ruta_dest, sha, tamano = await recepcion.guardar_upload(foto, presupuesto)
+                rutas_fotos_servidor.append(ruta_dest)
+                archivos_media.append((sha, os.path.relpath(ruta_dest, config.MEDIA_DIR), tamano))
+
+        # 2. Guardar Firmas (se mapean por el nombre que envió la tablet)
         rutas_firmas_servidor = {} 
         if firmas_usuarios:
             for firma in firmas_usuarios:
                 clean_name = os.path.basename(firma.filename)
-                ruta_dest = f"{temp_dir}/{clean_name}"
-                with open(ruta_dest, "wb") as buffer:
-                    shutil.copyfileobj(firma.file, buffer)
-                rutas_firmas_servidor[clean_name] = os.path.abspath(ruta_dest)
-                archivos_para_borrar.append(os.path.abspath(ruta_dest))
+                ruta_dest, sha, tamano = await recepcion.guardar_upload(firma, presupuesto)
+                rutas_firmas_servidor[clean_name] = ruta_dest
+                archivos_media.append((sha, os.path.relpath(ruta_dest, config.MEDIA_DIR), tamano))
 
         # 3. Mapear rutas
         contador_fotos = 0
@@ -220,67 +530,62 @@ async def crear_reporte(
                 else:
                     usuario['firma'] = None
 
-        # 4. Generar PDF
-        path_firma_tec = None 
-        pdf_path = pdf_generator.generar_pdf(
-            cliente=cliente,
-            tecnico=tecnico,
-            obs=obs,
-            path_firma=path_firma_tec,
-            datos_usuarios=usuarios_parsed 
-        )
-        if pdf_path:
-            archivos_para_borrar.append(pdf_path)
-
-        # 5. SUBIR A SHAREPOINT
-        ok_sp, msg_sp, web_url = utils.subir_archivo_sharepoint(pdf_path, cliente)
-
-        # 6. CREAR ITEM EN LISTA
-        msg_lista = "Lista omitida (sin URL)"
-        if ok_sp and web_url:
-            datos_lista = {
-                "titulo": f"Visita {cliente} - {tecnico}",
-                "cliente": cliente,
-                "tecnico": tecnico,
-                "fecha": datetime.now().strftime("%Y-%m-%d %H:%M"),
-                "link": web_url
-            }
-            try:
-                ok_lista, msg_lista = utils.crear_item_lista(datos_lista)
-            except:
-                msg_lista = "Error escribiendo en lista"
-
-        # 7. ENVIAR CORREOS
-        ok_email, msg_email = utils.enviar_correo_graph(pdf_path, cliente, tecnico, email_tecnico)
-
-        # 8. Guardar en BD Local
-        fecha_actual = utils.obtener_hora_chile().strftime('%Y-%m-%d %H:%M:%S')
-        server_id = database.guardar_reporte(
+        # 4. Guardar en BD Local junto con sus etapas pendientes
+        ahora = utils.obtener_hora_chile()
+        fecha_actual = ahora.strftime('%Y-%m-%d %H:%M:%S')
+        datos_reporte = dict(
             fecha=fecha_actual,
             cliente=cliente,
             tecnico=tecnico,
             obs=obs,
             fotos_json=json.dumps(rutas_fotos_servidor),
-            pdf_path=pdf_path,
             detalles_json=json.dumps(usuarios_parsed),
-            estado_envio=1 if ok_email else 0
+            email_tecnico=email_tecnico,
+            archivos=archivos_media
         )
+        if idempotency_key:
+            # Dos reintentos simultáneos: la transacción deja pasar solo al primero
+            vence = _vencimiento_idempotencia(ahora)
+            server_id, huella_original, repetido = await run_in_threadpool(
+                database.encolar_reporte_idempotente, idempotency_key, huella, vence, **datos_reporte
+            )
+            if repetido:
+                return _respuesta_repetida(idempotency_key, huella_original, huella, server_id)
+        else:
+            server_id = await run_in_threadpool(database.encolar_reporte, **datos_reporte)
 
-        # 9. PROGRAMAR LIMPIEZA
-        background_tasks.add_task(eliminar_archivos_temporales, archivos_para_borrar)
+        # 5. Avisar al worker (PDF -> SharePoint -> Lista / Email)
+        pipeline.notificar()
 
         return {
             "status": "success",
             "server_id": server_id,
-            "pdf_generated": pdf_path,
-            "message": f"Email: {msg_email} | SP: {msg_sp}"
+            "job_id": server_id,
+            "message": "Reporte recibido. Se procesará en segundo plano."
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/reporte/{reporte_id}/estado")
+def estado_reporte(reporte_id: int):
+    etapas = database.obtener_etapas_reporte(reporte_id)
+    if not etapas:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    detalle = [
+        {"etapa": e[0], "estado": e[1], "intentos": e[2], "mensaje": e[3], "actualizado": e[4]}
+        for e in etapas
+    ]
+    estados = [e["estado"] for e in detalle]
+    if all(x == 'ok' for x in estados): general = "completado"
+    elif 'error' in estados: general = "error"
+    else: general = "en_proceso"
+    return {"job_id": reporte_id, "estado": general, "etapas": detalle}
+
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 8000))
@@ -0,0 +1,294 @@
+import datetime
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import config
+import database
+import utils
+
+# ==========================================
+# RESPALDOS DE LA BASE EN SHAREPOINT
+# ==========================================
+# Dos tipos de respaldo, ambos comprimidos con gzip en bloques (nunca enteros
+# en memoria) y subidos por sesión a SHAREPOINT_BACKUP_FOLDER:
+# - completo: copia con la API de backup de SQLite en pasos de
+#   BACKUP_PAGINAS_POR_PASO páginas, así la API sigue escribiendo durante la copia.
+# - incremental: solo las filas de las claves que cambiaron desde el respaldo
+#   anterior (registro `cambios_respaldo`, alimentado por triggers), en JSON
+#   por líneas. Su tamaño depende de la actividad del día, no del total.
+# Cada BACKUP_COMPLETO_DIAS se hace un completo; se conservan BACKUP_RETENCION
+# completos con sus incrementales. restaurar() arma una base nueva con el
+# último completo más los incrementales que le siguen.
+# Cada respaldo es un "trabajo" que corre en su propio hilo; /sistema/backup
+# devuelve su id y se consulta su estado aparte.
+
+TIPOS = ("completo", "incremental")
+_EXTENSION = {"completo": ".db.gz", "incremental": ".jsonl.gz"}
+_FORMATO_FECHA = '%Y-%m-%d_%H%M%S'
+_BLOQUE_GZIP = 1024 * 1024
+_MAX_TRABAJOS = 20  # trabajos terminados que se recuerdan para consultarlos
+
+_trabajos = {}  # id -> dict con el estado del trabajo
+_lock = threading.Lock()
+
+class _CopiaReiniciada(Exception):
+    pass
+
+def _base():
+    return os.path.splitext(os.path.basename(database.DB_NAME))[0]
+
+def _nombre(tipo, fecha):
+    return f"{_base()}_{tipo}_{fecha}{_EXTENSION[tipo]}"
+
+def _respaldos_en(nombres):
+    """[(fecha, tipo, nombre)] de esta base, del más antiguo al más nuevo."""
+    patron = re.compile(rf"^{re.escape(_base())}_({'|'.join(TIPOS)})_(\d{{4}}-\d{{2}}-\d{{2}}_\d{{6}})\.")
+    encontrados = []
+    for nombre in nombres:
+        m = patron.match(nombre)
+        if m: encontrados.append((m.group(2), m.group(1), nombre))
+    return sorted(encontrados)
+
+def _actualizar(trabajo, **campos):
+    with _lock:
+        trabajo.update(campos)
+
+def obtener_trabajo(trabajo_id):
+    with _lock:
+        trabajo = _trabajos.get(trabajo_id)
+        return dict(trabajo) if trabajo else None
+
+def _nuevo_trabajo(origen, tipo):
+    trabajo = {
+        "id": uuid.uuid4().hex[:12], "origen": origen, "tipo": tipo, "estado": "en_proceso", "fase": "copiando",
+        "progreso": 0, "archivo": None, "bytes": None, "mensaje": None,
+        "inicio": utils.obtener_hora_chile().strftime('%Y-%m-%d %H:%M:%S'), "fin": None,
+    }
+    _trabajos[trabajo["id"]] = trabajo
+    terminados = [t for t in _trabajos.values() if t["estado"] != "en_proceso"]
+    for t in terminados[:max(0, len(terminados) - _MAX_TRABAJOS)]:
+        del _trabajos[t["id"]]
+    return trabajo
+
+# --- PASOS DEL RESPALDO ---
+
+def _copiar(destino, trabajo):
+    """Copia la base en `destino` por pasos; si se reinicia demasiadas veces, de una vez."""
+    estado = {"restantes": None, "reinicios": 0}
+
+    def progreso(_, restantes, total):
+        if estado["restantes"] is not None and restantes > estado["restantes"]:
+            # Otra conexión escribió: SQLite volvió a empezar la copia
+            estado["reinicios"] += 1
+            if estado["reinicios"] >= config.BACKUP_MAX_REINICIOS:
+                raise _CopiaReiniciada()
+        estado["restantes"] = restantes
+        _actualizar(trabajo, progreso=(total - restantes) * 100 // max(total, 1))
+
+    try:
+        database.copiar_base(destino, config.BACKUP_PAGINAS_POR_PASO, config.BACKUP_PAUSA, progreso)
+    except _CopiaReiniciada:
+        print(f"   🔁 La base cambió {estado['reinicios']} veces durante la copia; se copia de una vez")
+        database.copiar_base(destino)
+
+def _comprimir(origen, destino):
+    with open(origen, 'rb') as f_in, gzip.open(destino, 'wb', compresslevel=config.BACKUP_NIVEL_GZIP) as f_out:
+        shutil.copyfileobj(f_in, f_out, _BLOQUE_GZIP)
+
+def tipo_automatico():
+    """'completo' si no hay uno o el último tiene más de BACKUP_COMPLETO_DIAS; si no, 'incremental'."""
+    ultimo = database.obtener_ultimo_respaldo("completo")
+    if not ultimo: return "completo"
+    fecha = datetime.datetime.strptime(ultimo[0], '%Y-%m-%d %H:%M:%S')
+    ahora = utils.obtener_hora_chile().replace(tzinfo=None)
+    return "completo" if ahora - fecha >= datetime.timedelta(days=config.BACKUP_COMPLETO_DIAS) else "incremental"
+
+def _respaldo_completo(carpeta, nombre, trabajo):
+    """Retorna (ruta del .db.gz, seq del registro que cubre)."""
+    copia = os.path.join(carpeta, "copia.db")
+    _copiar(copia, trabajo)
+    hasta = database.secuencia_respaldo(copia)
+    _actualizar(trabajo, fase="comprimiendo", progreso=100)
+    comprimido = os.path.join(carpeta, nombre)
+    _comprimir(copia, comprimido)
+    os.remove(copia)
+    return comprimido, hasta
+
+def _respaldo_incremental(carpeta, nombre, trabajo):
+    """Retorna (ruta del .jsonl.gz o None si no hubo cambios, seq del registro que cubre)."""
+    comprimido = os.path.join(carpeta, nombre)
+    with gzip.open(comprimido, 'wt', encoding='utf-8', compresslevel=config.BACKUP_NIVEL_GZIP) as f:
+        escribir = lambda d: f.write(json.dumps(d, ensure_ascii=False, separators=(",", ":")) + "\n")
+        desde, hasta, entradas = database.exportar_cambios_respaldo(escribir)
+    _actualizar(trabajo, progreso=100)
+    return (comprimido if entradas else None), hasta
+
+def _podar():
+    """
+    Deja los BACKUP_RETENCION completos más nuevos y los incrementales posteriores
+    al más antiguo de ellos. Retorna cuántos archivos borró.
+    """
+    archivos = utils.listar_backups_sharepoint()
+    respaldos = _respaldos_en(archivos)
+    completos = [fecha for fecha, tipo, _ in respaldos if tipo == "completo"]
+    if not completos: return 0
+    corte = completos[-config.BACKUP_RETENCION] if len(completos) >= config.BACKUP_RETENCION else completos[0]
+    viejos = [archivos[nombre] for fecha, _, nombre in respaldos if fecha < corte]
+    return utils.borrar_backups_sharepoint(viejos) if viejos else 0
+
+def ejecutar_backup(trabajo=None, origen="manual", tipo=None):
+    """
+    Respalda la base en SharePoint (en este hilo). `tipo` es 'completo',
+    'incremental' o None (tipo_automatico()). Retorna (ok, mensaje).
+    `trabajo` es el dict de estado cuando lo lanza iniciar_backup().
+    """
+    if trabajo is None:
+        with _lock:
+            trabajo = _nuevo_trabajo(origen, tipo or tipo_automatico())
+    tipo = trabajo["tipo"]
+    ahora = utils.obtener_hora_chile()
+    nombre = _nombre(tipo, ahora.strftime(_FORMATO_FECHA))
+    carpeta = tempfile.mkdtemp(prefix="backup_")
+    inicio = time.time()
+    try:
+        print(f"💾 Respaldo {tipo} {trabajo['id']}: leyendo base...")
+        if tipo == "completo":
+            ruta, hasta = _respaldo_completo(carpeta, nombre, trabajo)
+        else:
+            ruta, hasta = _respaldo_incremental(carpeta, nombre, trabajo)
+        if ruta is None:
+            msg = "Sin cambios desde el último respaldo"
+            _actualizar(trabajo, estado="ok", fase=None, mensaje=msg)
+            print(f"✅ {msg}")
+            return True, msg
+        tamano = os.path.getsize(ruta)
+
+        _actualizar(trabajo, fase="subiendo", archivo=nombre, bytes=tamano)
+        ok, msg = utils.subir_backup_sharepoint(ruta)
+        if not ok:
+            raise RuntimeError(msg)
+        # Recién subido se descarta del registro lo que este respaldo ya cubre
+        database.registrar_respaldo(tipo, nombre, hasta, tamano, ahora.strftime('%Y-%m-%d %H:%M:%S'))
+
+        _actualizar(trabajo, fase="podando")
+        try:
+            borrados = _podar()
+        except Exception as e:
+            # El respaldo ya quedó arriba; la poda se reintenta en el próximo
+            print(f"   ⚠️ No se pudieron podar respaldos antiguos: {e}")
+            borrados = 0
+
+        msg = f"Respaldo {nombre} ({tamano} bytes) subido en {time.time() - inicio:.1f} s"
+        if borrados: msg += f"; {borrados} antiguos eliminados"
+        _actualizar(trabajo, estado="ok", fase=None, mensaje=msg)
+        print(f"✅ {msg}")
+        return True, msg
+    except Exception as e:
+        _actualizar(trabajo, estado="error", mensaje=f"Error respaldo: {e}")
+        print(f"❌ Respaldo {trabajo['id']} falló: {e}")
+        return False, f"Error respaldo: {e}"
+    finally:
+        _actualizar(trabajo, fin=utils.obtener_hora_chile().strftime('%Y-%m-%d %H:%M:%S'))
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+def iniciar_backup(origen="manual", tipo=None):
+    """
+    Lanza un respaldo en segundo plano y retorna (trabajo, nuevo). Si ya hay uno
+    en curso no se lanza otro: se retorna ese con nuevo=False.
+    """
+    tipo = tipo or tipo_automatico()
+    with _lock:
+        for t in _trabajos.values():
+            if t["estado"] == "en_proceso":
+                return dict(t), False
+        trabajo = _nuevo_trabajo(origen, tipo)
+        copia = dict(trabajo)
+    threading.Thread(target=ejecutar_backup, args=(trabajo,), name=f"backup-{trabajo['id']}", daemon=True).start()
+    return copia, True
+
+# --- RESTAURACIÓN ---
+
+def _entradas(rutas, cursor):
+    """Entradas de los incrementales en orden, saltando lo que la base ya incluye."""
+    for ruta in rutas:
+        with gzip.open(ruta, 'rt', encoding='utf-8') as f:
+            cabecera = json.loads(f.readline())
+            if cabecera["hasta"] <= cursor: continue
+            if cabecera["desde"] > cursor:
+                raise RuntimeError(f"Falta un respaldo incremental antes de {os.path.basename(ruta)} "
+                                   f"(la base llega a {cursor}, el incremental parte en {cabecera['desde']})")
+            if cabecera["version"] > len(database.MIGRACIONES):
+                raise RuntimeError(f"{os.path.basename(ruta)} es de un esquema más nuevo que este código")
+            print(f"   ↪ Aplicando {os.path.basename(ruta)}")
+            for linea in f:
+                yield json.loads(linea)
+            cursor = cabecera["hasta"]
+
+def restaurar(destino, carpeta=None, hasta=None):
+    """
+    Arma en `destino` (no debe existir) la base del último respaldo completo más sus
+    incrementales, tomados de `carpeta` o, sin carpeta, descargados de SharePoint.
+    `hasta` ('AAAA-MM-DD_HHMMSS') ignora los respaldos posteriores a esa fecha.
+    Retorna (respaldo base, incrementales leídos, claves aplicadas).
+    """
+    if os.path.exists(destino):
+        raise FileExistsError(f"{destino} ya existe")
+    temporal = tempfile.mkdtemp(prefix="restaurar_")
+    anterior = database.DB_NAME
+    try:
+        if carpeta:
+            archivos = {n: os.path.join(carpeta, n) for n in os.listdir(carpeta)}
+        else:
+            archivos = utils.listar_backups_sharepoint()
+        respaldos = [r for r in _respaldos_en(archivos) if hasta is None or r[0] <= hasta]
+        completos = [r for r in respaldos if r[1] == "completo"]
+        if not completos:
+            raise RuntimeError("No hay respaldos completos para restaurar")
+        fecha_base, _, base = completos[-1]
+        incrementales = [n for fecha, tipo, n in respaldos if tipo == "incremental" and fecha > fecha_base]
+
+        rutas = []
+        for nombre in [base] + incrementales:
+            if carpeta:
+                rutas.append(archivos[nombre])
+            else:
+                print(f"   📥 Descargando {nombre}")
+                rutas.append(os.path.join(temporal, nombre))
+                utils.descargar_backup_sharepoint(archivos[nombre], rutas[-1])
+
+        print(f"♻️ Restaurando {base} + {len(incrementales)} incrementales en {destino}")
+        with gzip.open(rutas[0], 'rb') as f_in, open(destino, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, _BLOQUE_GZIP)
+        database.cerrar_conexion()
+        database.DB_NAME = destino
+        database.migrar()
+        aplicadas = database.aplicar_cambios_respaldo(_entradas(rutas[1:], database.secuencia_respaldo()))
+        return base, len(incrementales), aplicadas
+    finally:
+        database.cerrar_conexion()
+        database.DB_NAME = anterior
+        shutil.rmtree(temporal, ignore_errors=True)
+
+# --- RESPALDOS PROGRAMADOS ---
+
+def _bucle(detener):
+    while not detener.wait(config.BACKUP_INTERVALO):
+        trabajo, nuevo = iniciar_backup("programado")
+        if not nuevo:
+            print(f"⚠️ Respaldo programado omitido: {trabajo['id']} sigue en curso")
+
+_detener = threading.Event()
+
+def iniciar_programador():
+    if config.BACKUP_INTERVALO <= 0: return
+    _detener.clear()
+    threading.Thread(target=_bucle, args=(_detener,), name="backup-programado", daemon=True).start()
+
+def detener_programador():
+    _detener.set()
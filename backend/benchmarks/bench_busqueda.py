@@ -0,0 +1,86 @@
+"""
+Benchmark de la búsqueda de texto: recorrer obtener_historial() buscando en
+observaciones y detalles_usuarios con Python (lo que se hacía antes) frente al
+índice FTS5 reportes_fts (migración v10).
+
+Crea una base sintética (200.000 reportes por defecto) en un directorio temporal.
+
+Uso (desde backend/):
+    python benchmarks/bench_busqueda.py [reportes] [repeticiones]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+
+CLIENTES = [f"Cliente {i:03d}" for i in range(200)]
+TECNICOS = [f"Tecnico {i:02d}" for i in range(12)]
+TRABAJOS = ["Borrar Temporales (%temp%)", "Antivirus", "Actualizaciones", "Limpieza física", "Cambio de disco",
+            "Respaldo de correo", "Configuración de impresora", "Reinstalación de Office"]
+OBSERVACIONES = ["Sin observaciones", "Equipo lento, se recomienda más RAM", "Impresora atascada en bodega",
+                 "Se deja pendiente licencia", "Usuario no disponible", "Ruido en ventilador del servidor"]
+
+BUSQUEDAS = ["impresora", "disco", "ventilador servidor", "licencia"]
+
+def _poblar(reportes):
+    random.seed(24)
+    lote = 20_000
+    for inicio in range(0, reportes, lote):
+        with database.transaccion() as cur:
+            for _ in range(min(lote, reportes - inicio)):
+                usuarios = [{"nombre": f"Usuario {random.randint(1, 500)}", "atendido": True,
+                             "trabajo": ", ".join(random.sample(TRABAJOS, 2)), "fotos": [], "firma": None}
+                            for _ in range(random.randint(1, 4))]
+                detalles = json.dumps(usuarios, ensure_ascii=False)
+                cur.execute("""
+                    INSERT INTO reportes (fecha, cliente, tecnico, observaciones, imagen_path, pdf_path, detalles_usuarios, email_enviado)
+                    VALUES (?, ?, ?, ?, '[]', '', ?, 1)
+                """, (f"2026-{random.randint(1, 12):02d}-{random.randint(1, 28):02d} 10:00:00", random.choice(CLIENTES),
+                      random.choice(TECNICOS), random.choice(OBSERVACIONES), detalles))
+                database._guardar_detalle(cur, cur.lastrowid, detalles, "[]")
+
+def _escaneo(texto):
+    palabras = texto.lower().split()
+    encontrados = []
+    for fila in database.obtener_historial():
+        contenido = f"{fila[2]} {fila[3]} {fila[4]} {fila[7]}".lower()
+        if all(p in contenido for p in palabras):
+            encontrados.append(fila[0])
+    return encontrados
+
+def _fts(texto):
+    return database.buscar_texto(database.consulta_fts(texto), limite=20)
+
+def _medir(fn, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        fn()
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos) * 1000
+
+def main():
+    reportes = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        database.migrar()
+        inicio = time.perf_counter()
+        _poblar(reportes)
+        print(f"{reportes} reportes generados en {time.perf_counter() - inicio:.1f} s")
+
+        print(f"{'búsqueda':<22}{'escaneo Python':>16}{'FTS5 (20 primeros)':>21}{'coincidencias':>15}")
+        for texto in BUSQUEDAS:
+            escaneo = _medir(lambda: _escaneo(texto), repeticiones)
+            fts = _medir(lambda: _fts(texto), repeticiones)
+            total = _fts(texto)[0]
+            print(f"{texto:<22}{escaneo:>13.1f} ms{fts:>18.1f} ms{total:>15}")
+        database.cerrar_conexion()
+
+if __name__ == "__main__":
+    main()
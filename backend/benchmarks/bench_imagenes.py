@@ -0,0 +1,56 @@
+"""
+Benchmark: tamaño del PDF y tiempo de render con y sin la preparación de fotos.
+
+Uso (desde backend/):
+    python benchmarks/bench_imagenes.py [usuarios] [fotos_por_usuario]
+
+Usa las fotos de ejemplo de temp_uploads/.
+"""
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+import pdf_generator
+
+def _datos(usuarios, fotos_por_usuario):
+    fotos = sorted(glob.glob(os.path.join(config.BASE_DIR, "temp_uploads", "*.jpg")))
+    if not fotos:
+        sys.exit("No hay fotos de ejemplo en temp_uploads/")
+    datos = []
+    for i in range(usuarios):
+        datos.append({
+            "nombre": f"Usuario {i + 1}",
+            "atendido": True,
+            "trabajo": ", ".join(config.TAREAS_MANTENIMIENTO[:4]),
+            "fotos": [fotos[(i * fotos_por_usuario + j) % len(fotos)] for j in range(fotos_por_usuario)],
+            "firma": None,
+        })
+    return datos
+
+def _medir(datos, optimizar, destino):
+    inicio = time.perf_counter()
+    ruta = pdf_generator.generar_pdf("Benchmark", "Tecnico", "Obs", None, datos, optimizar_imagenes=optimizar)
+    segundos = time.perf_counter() - inicio
+    shutil.move(ruta, destino)
+    return segundos, os.path.getsize(destino)
+
+def main():
+    usuarios = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    fotos_por_usuario = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    datos = _datos(usuarios, fotos_por_usuario)
+    total_fotos = usuarios * fotos_por_usuario
+    print(f"{usuarios} usuarios x {fotos_por_usuario} fotos = {total_fotos} fotos "
+          f"(DPI={config.IMAGENES_DPI}, calidad={config.IMAGENES_CALIDAD}, procesos={config.IMAGENES_PROCESOS})")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for etiqueta, optimizar in [("original", False), ("optimizado", True)]:
+            seg, tam = _medir(datos, optimizar, os.path.join(tmp, f"{etiqueta}.pdf"))
+            print(f"  {etiqueta:<11} {seg:7.2f} s   {tam / 1024 / 1024:7.2f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark de las consultas de database.py antes y después de la migración de
+índices (v2) y de las métricas materializadas (v5).
+
+Crea una base sintética (1.000.000 de reportes por defecto) en un directorio
+temporal con el esquema de la versión 1 (sin índices), mide las consultas,
+aplica la migración de índices, vuelve a medir, aplica el resto y mide las
+funciones de métricas que ahora leen las tablas metricas_*.
+
+Uso (desde backend/):
+    python benchmarks/bench_indices.py [reportes] [repeticiones]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+
+CLIENTES = [f"Cliente {i:03d}" for i in range(200)]
+TECNICOS = [f"Tecnico {i:02d}" for i in range(12)]
+
+def _poblar(reportes):
+    random.seed(11)
+    detalle = json.dumps([{"nombre": f"Usuario {i}", "atendido": True, "trabajo": "Borrar Temporales (%temp%), Antivirus",
+                           "fotos": [], "firma": None} for i in range(3)])
+    with database.transaccion() as cur:
+        cur.executemany("INSERT INTO clientes (nombre, email) VALUES (?, ?)", [(c, "x@y.cl") for c in CLIENTES])
+        cur.executemany("INSERT INTO tecnicos (nombre) VALUES (?)", [(t,) for t in TECNICOS])
+        cur.executemany("INSERT INTO usuarios (nombre, cliente_nombre) VALUES (?, ?)",
+                        [(f"Usuario {i}", c) for c in CLIENTES for i in range(50)])
+    lote = 50_000
+    for inicio in range(0, reportes, lote):
+        filas = []
+        for _ in range(min(lote, reportes - inicio)):
+            anio, mes, dia = random.randint(2021, 2026), random.randint(1, 12), random.randint(1, 28)
+            filas.append((f"{anio}-{mes:02d}-{dia:02d} 10:00:00", random.choice(CLIENTES), random.choice(TECNICOS),
+                          "Sin observaciones", "[]", "", detalle, 0 if random.random() < 0.02 else 1))
+        with database.transaccion() as cur:
+            cur.executemany("""
+                INSERT INTO reportes (fecha, cliente, tecnico, observaciones, imagen_path, pdf_path, detalles_usuarios, email_enviado)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, filas)
+
+def _kpis_escaneo():
+    # obtener_kpis_generales tal como era antes de las métricas materializadas
+    database._consultar_uno("SELECT COUNT(*) FROM reportes")
+    database._consultar_uno("SELECT COUNT(*) FROM reportes WHERE email_enviado = 0")
+    database._consultar_uno("SELECT cliente, COUNT(*) as c FROM reportes GROUP BY cliente ORDER BY c DESC LIMIT 1")
+
+# Las métricas se miden con su SQL original (GROUP BY sobre reportes) en las dos
+# primeras columnas y con la función actual de database.py en la tercera
+CONSULTAS = [
+    ("usuarios_por_cliente", lambda: database.obtener_usuarios_por_cliente("Cliente 042"), None),
+    ("reportes_pendientes", database.obtener_reportes_pendientes, None),
+    ("kpis_generales", _kpis_escaneo, database.obtener_kpis_generales),
+    ("evolucion_mensual", lambda: database._consultar(
+        "SELECT substr(fecha, 1, 7) as mes, COUNT(*) FROM reportes GROUP BY mes ORDER BY mes DESC LIMIT 6"),
+        database.obtener_evolucion_mensual),
+    ("datos_clientes", lambda: database._consultar(
+        "SELECT cliente, COUNT(*) FROM reportes GROUP BY cliente ORDER BY COUNT(*) DESC"),
+        database.obtener_datos_clientes),
+    ("datos_tecnicos", lambda: database._consultar(
+        "SELECT tecnico, COUNT(*) FROM reportes GROUP BY tecnico ORDER BY COUNT(*) DESC"),
+        database.obtener_datos_tecnicos),
+]
+
+def _medir(repeticiones, materializadas=False):
+    resultados = {}
+    for nombre, escaneo, actual in CONSULTAS:
+        fn = (actual or escaneo) if materializadas else escaneo
+        tiempos = []
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            fn()
+            tiempos.append(time.perf_counter() - inicio)
+        resultados[nombre] = min(tiempos) * 1000
+    return resultados
+
+def main():
+    reportes = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        database.migrar(hasta=1)
+        inicio = time.perf_counter()
+        _poblar(reportes)
+        print(f"{reportes} reportes generados en {time.perf_counter() - inicio:.1f} s")
+
+        antes = _medir(repeticiones)
+        inicio = time.perf_counter()
+        database.migrar(hasta=2)
+        print(f"Migración de índices: {time.perf_counter() - inicio:.1f} s")
+        despues = _medir(repeticiones)
+        inicio = time.perf_counter()
+        database.migrar()
+        print(f"Migraciones restantes (incluye cálculo inicial de métricas): {time.perf_counter() - inicio:.1f} s")
+        materializadas = _medir(repeticiones, materializadas=True)
+
+        print(f"{'consulta':<22}{'sin índices':>14}{'con índices':>14}{'materializadas':>17}")
+        for nombre, _, _ in CONSULTAS:
+            print(f"{nombre:<22}{antes[nombre]:>11.1f} ms{despues[nombre]:>11.1f} ms{materializadas[nombre]:>14.1f} ms")
+        database.cerrar_conexion()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Micro-benchmark del costo por página del PDF de visita.
+
+1. Encabezado/pie: N páginas con el encabezado actual (ruta del logo resuelta
+   una vez por proceso) vs. el encabezado anterior (os.path.exists de cada ruta
+   en cada página).
+2. Reporte completo: 20 usuarios con fotos; tiempo total y por página.
+
+Uso (desde backend/):
+    python benchmarks/bench_pdf_paginas.py [usuarios] [repeticiones]
+
+Si no existe assets/logo.png se usa un logo sintético de 600x240.
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PIL import Image
+import config
+import pdf_generator
+
+class PDFEncabezadoAnterior(pdf_generator.PDFReporte):
+    """Encabezado como era antes: busca el logo en disco en cada página."""
+    def header(self):
+        self.set_fill_color(5, 131, 242)
+        self.rect(0, 0, 210, 40, 'F')
+        self.set_fill_color(0, 86, 163)
+        self.rect(0, 40, 210, 2, 'F')
+        logo_final = None
+        for ruta in pdf_generator.RUTAS_LOGO:
+            if os.path.exists(ruta):
+                logo_final = ruta
+                break
+        if logo_final:
+            self.image(logo_final, x=10, y=8, h=24)
+        self.set_font('Helvetica', 'B', 20)
+        self.set_text_color(255, 255, 255)
+        self.set_xy(80, 12)
+        self.cell(120, 10, 'INFORME DE VISITA TÉCNICA', 0, 0, 'R')
+        self.set_font('Helvetica', '', 10)
+        self.set_xy(80, 22)
+        self.cell(120, 10, 'Departamento de Soporte IT', 0, 0, 'R')
+        self.ln(35)
+
+def _paginas(clase, paginas, documentos):
+    inicio = time.perf_counter()
+    for _ in range(documentos):
+        pdf = clase(orientation='P', unit='mm', format='A4')
+        pdf.alias_nb_pages()
+        for _ in range(paginas):
+            pdf.add_page()
+        pdf.output()
+    return (time.perf_counter() - inicio) / (paginas * documentos) * 1000
+
+def _reporte(usuarios):
+    fotos = sorted(glob.glob(os.path.join(config.BASE_DIR, "temp_uploads", "*.jpg")))
+    return [{
+        "nombre": f"Usuario {i + 1}",
+        "atendido": True,
+        "trabajo": ", ".join(config.TAREAS_MANTENIMIENTO),
+        "fotos": [fotos[(i * 3 + j) % len(fotos)] for j in range(3)] if fotos else [],
+        "firma": None,
+    } for i in range(usuarios)]
+
+def main():
+    # fpdf2 avisa por el parámetro 'ln' de cell() que usa el encabezado
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    usuarios = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not any(os.path.exists(r) for r in pdf_generator.RUTAS_LOGO):
+            logo = os.path.join(tmp, "logo.png")
+            Image.new("RGBA", (600, 240), (255, 255, 255, 200)).save(logo)
+            pdf_generator.RUTAS_LOGO = [logo]
+            pdf_generator.reiniciar_cache_logo()
+
+        print(f"Encabezado/pie, {repeticiones} documentos x 10 páginas:")
+        print(f"  anterior   {_paginas(PDFEncabezadoAnterior, 10, repeticiones):6.2f} ms/página")
+        print(f"  actual     {_paginas(pdf_generator.PDFReporte, 10, repeticiones):6.2f} ms/página")
+
+        datos = _reporte(usuarios)
+        tiempos, paginas = [], 0
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            ruta = pdf_generator.generar_pdf("Benchmark", "Tecnico", "Obs", None, datos)
+            tiempos.append(time.perf_counter() - inicio)
+            with open(ruta, "rb") as f:
+                paginas = f.read().count(b"/Type /Page\n")
+            os.remove(ruta)
+        mejor = min(tiempos)
+        print(f"Reporte de {usuarios} usuarios con fotos ({paginas} páginas, mejor de {repeticiones}):")
+        print(f"  total {mejor:6.2f} s   {mejor / max(paginas, 1) * 1000:6.1f} ms/página")
+
+if __name__ == "__main__":
+    main()
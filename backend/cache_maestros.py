@@ -0,0 +1,63 @@
+import json
+import threading
+import uuid
+from fastapi.responses import Response
+
+# ==========================================
+# CACHÉ DE DATOS MAESTROS (ETag / 304)
+# ==========================================
+# Las tablets consultan /clientes, /tecnicos y /usuarios* en cada sync.
+# Cada tabla tiene un contador de versión en memoria; el ETag es
+# "<tabla>-<arranque>-<versión>". Si la tablet envía ese mismo ETag en
+# If-None-Match se responde 304 sin tocar SQLite; si no, se devuelve el JSON
+# ya serializado en caché. Los endpoints que escriben llaman a invalidar().
+
+# Cambia en cada arranque: un ETag de un proceso anterior nunca coincide
+_ARRANQUE = uuid.uuid4().hex[:8]
+
+_versiones = {"clientes": 0, "tecnicos": 0, "usuarios": 0}
+_cache = {}  # (tabla, clave) -> (versión, cuerpo JSON en bytes)
+_lock = threading.Lock()
+
+def invalidar(*tablas):
+    """Sube la versión de las tablas y descarta sus respuestas en caché."""
+    with _lock:
+        for tabla in tablas:
+            _versiones[tabla] += 1
+        for k in [k for k in _cache if k[0] in tablas]:
+            del _cache[k]
+
+def _etag(tabla, version):
+    return f'"{tabla}-{_ARRANQUE}-{version}"'
+
+def _coincide(if_none_match, etag):
+    if not if_none_match: return False
+    for candidato in if_none_match.split(","):
+        candidato = candidato.strip()
+        if candidato.startswith("W/"): candidato = candidato[2:]
+        if candidato in ("*", etag): return True
+    return False
+
+def responder(request, tabla, generar, clave=None):
+    """
+    Respuesta JSON de `generar()` para una lectura que depende de `tabla`.
+    `clave` distingue respuestas de la misma tabla (p. ej. usuarios de un cliente).
+    """
+    with _lock:
+        version = _versiones[tabla]
+        entrada = _cache.get((tabla, clave))
+    etag = _etag(tabla, version)
+    cabeceras = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if _coincide(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cabeceras)
+
+    if entrada and entrada[0] == version:
+        cuerpo = entrada[1]
+    else:
+        cuerpo = json.dumps(generar(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        with _lock:
+            # Si hubo una escritura mientras se leía, no se guarda (la versión ya cambió)
+            if _versiones[tabla] == version:
+                _cache[(tabla, clave)] = (version, cuerpo)
+    return Response(content=cuerpo, media_type="application/json", headers=cabeceras)
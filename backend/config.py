@@ -8,6 +8,8 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Definimos la carpeta temporal para subidas (se borra sola, no necesita persistencia)
 TEMP_FOLDER = os.path.join(BASE_DIR, "temp_uploads")
+# PDFs generados: uno por reporte (Reporte_<id>_...), así dos renders nunca pisan el mismo archivo
+PDF_FOLDER = os.path.join(BASE_DIR, "pdf_reportes")
 
 # --- CONFIGURACIÓN DE BASE DE DATOS (PERSISTENCIA) ---
 # Detectamos si estamos corriendo en Render mediante la variable de entorno
@@ -32,9 +34,14 @@ else:
     DB_PATH = os.path.join(BASE_DIR, "visitas.db")
     print(f"--> MODO LOCAL. Usando DB en: {DB_PATH}")
 
+# Ajustes de SQLite (ver database._configurar)
+DB_BUSY_TIMEOUT_MS = 5000      # espera por un lock antes de fallar con "database is locked"
+DB_CACHE_KB = 16 * 1024        # caché de páginas por conexión
+
 # Asegurar que existan los directorios temporales necesarios al iniciar
 if not os.path.exists(TEMP_FOLDER):
     os.makedirs(TEMP_FOLDER)
+os.makedirs(PDF_FOLDER, exist_ok=True)
 
 # ==========================================
 # 2. CREDENCIALES MICROSOFT GRAPH (SEGURAS)
@@ -43,6 +50,18 @@ GRAPH_CLIENT_ID = os.getenv("GRAPH_CLIENT_ID", "TU_CLIENT_ID_LOCAL")
 GRAPH_CLIENT_SECRET = os.getenv("GRAPH_CLIENT_SECRET", "TU_SECRET_LOCAL")
 GRAPH_TENANT_ID = os.getenv("GRAPH_TENANT_ID", "TU_TENANT_ID_LOCAL")
 GRAPH_USER_EMAIL = os.getenv("GRAPH_USER_EMAIL", "soporte@tecnocomp.cl")
+# Segundos antes de 'expires_in' en que se renueva el token cacheado
+GRAPH_TOKEN_MARGEN = 300
+# Cliente HTTP compartido (graph.py): conexiones keep-alive, timeouts y reintentos
+GRAPH_POOL_TAMANO = 10
+# Peticiones a Graph en vuelo a la vez en todo el proceso (pipeline, respaldos,
+# precarga). No mayor que el pool, así toda petición reutiliza una conexión abierta
+GRAPH_CONCURRENCIA = int(os.getenv("GRAPH_CONCURRENCIA", "8"))
+GRAPH_TIMEOUT = (5, 30)            # (conexión, lectura) en segundos
+GRAPH_TIMEOUT_SUBIDA = (5, 120)    # subidas de archivos
+GRAPH_MAX_REINTENTOS = 4
+GRAPH_ESPERA_BASE = 1.0            # se duplica en cada reintento
+GRAPH_ESPERA_MAXIMA = 60.0         # tope, también para Retry-After
 
 # ==========================================
 # 3. SHAREPOINT (ARCHIVOS Y LISTAS)
@@ -51,11 +70,111 @@ SHAREPOINT_HOST_NAME = "tecnocompcomputacion.sharepoint.com"
 SHAREPOINT_SITE_PATH = "/sites/Pruueba" 
 SHAREPOINT_DRIVE_NAME = "Documentos"
 SHAREPOINT_BACKUP_FOLDER = "Backups_DB"
+# Segundos que se reutilizan los IDs de sitio/biblioteca antes de volver a consultarlos
+SHAREPOINT_CACHE_TTL = 6 * 3600
+# Graph solo acepta PUT simple hasta 4 MB; sobre eso se usa createUploadSession
+SHAREPOINT_LIMITE_PUT_SIMPLE = 4 * 1024 * 1024
+# Tamaño de bloque de la sesión de subida (Graph exige múltiplos de 320 KiB)
+SHAREPOINT_TAMANO_BLOQUE = 10 * 320 * 1024
+SHAREPOINT_MAX_REANUDACIONES = 5
 
 # IDs para la Lista de SharePoint
 SHAREPOINT_SITE_ID = "tecnocompcomputacion.sharepoint.com,f67a6766-495c-41e7-8caa-eb89b1801758,661e71e7-fee3-4a98-8c3e-323b2dd43bbe"
 SHAREPOINT_LIST_ID = "803eb871-8bcc-4561-bd91-599876787eb9"
 
+# ==========================================
+# 3.1 PIPELINE DE ENTREGA DE REPORTES
+# ==========================================
+# Etapas que el worker ejecuta por cada reporte recibido (en este orden)
+PIPELINE_ETAPAS = ["pdf", "sharepoint", "lista", "email"]
+# Etapa que debe terminar en 'ok' antes de poder ejecutar cada una
+PIPELINE_DEPENDENCIAS = {"sharepoint": "pdf", "lista": "sharepoint", "email": "pdf"}
+# Intentos máximos por etapa antes de marcarla como 'error'
+PIPELINE_MAX_INTENTOS = int(os.getenv("PIPELINE_MAX_INTENTOS", "5"))
+# Espera base (segundos) entre reintentos; se duplica en cada intento fallido
+PIPELINE_ESPERA_BASE = float(os.getenv("PIPELINE_ESPERA_BASE", "30"))
+PIPELINE_ESPERA_MAXIMA = float(os.getenv("PIPELINE_ESPERA_MAXIMA", "3600"))
+# Variación aleatoria de la espera (±20%): tras una caída de Graph los
+# reintentos no vuelven todos en el mismo segundo
+PIPELINE_JITTER = 0.2
+# Cada cuánto (segundos) el worker revisa la cola si no lo despiertan antes
+PIPELINE_INTERVALO = float(os.getenv("PIPELINE_INTERVALO", "2"))
+# Etapas que se ejecutan a la vez (hilos del worker)
+PIPELINE_HILOS = int(os.getenv("PIPELINE_HILOS", "4"))
+# Máximo simultáneo por tipo de etapa (un lote de correos cuenta como una)
+PIPELINE_MAX_POR_ETAPA = {"pdf": 2, "sharepoint": 2, "lista": 2, "email": 1}
+
+# Render de PDF en procesos aparte (0 = en el mismo hilo del worker)
+RENDER_PROCESOS = int(os.getenv("RENDER_PROCESOS", "2"))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "120"))
+# Con más PDFs esperando que esto, /reporte/crear responde 503 + Retry-After
+RENDER_MAX_COLA = int(os.getenv("RENDER_MAX_COLA", "50"))
+RENDER_RETRY_AFTER = 30
+
+# ==========================================
+# 3.2 RECEPCIÓN DE ARCHIVOS (FOTOS Y FIRMAS)
+# ==========================================
+RECEPCION_MAX_ARCHIVO = int(os.getenv("RECEPCION_MAX_ARCHIVO", str(15 * 1024 * 1024)))
+RECEPCION_MAX_PETICION = int(os.getenv("RECEPCION_MAX_PETICION", str(100 * 1024 * 1024)))
+RECEPCION_TAMANO_BLOQUE = 64 * 1024
+# Cuánto tiempo se recuerda una Idempotency-Key de POST /reporte/crear
+IDEMPOTENCIA_TTL_HORAS = int(os.getenv("IDEMPOTENCIA_TTL_HORAS", str(7 * 24)))
+# Carga masiva de clientes/técnicos/usuarios (/clientes/lote, etc.)
+LOTE_MAX_FILAS = int(os.getenv("LOTE_MAX_FILAS", "5000"))
+
+# ==========================================
+# 3.3 FOTOS EN EL PDF
+# ==========================================
+# Reducir y recomprimir las fotos antes de embeberlas en el PDF
+IMAGENES_OPTIMIZAR = os.getenv("IMAGENES_OPTIMIZAR", "1") == "1"
+IMAGENES_DPI = int(os.getenv("IMAGENES_DPI", "200"))
+IMAGENES_CALIDAD = int(os.getenv("IMAGENES_CALIDAD", "80"))
+# Procesos para preparar fotos en paralelo (1 = sin pool)
+IMAGENES_PROCESOS = int(os.getenv("IMAGENES_PROCESOS", str(min(4, os.cpu_count() or 1))))
+# Con menos fotos que esto no compensa levantar el pool
+IMAGENES_MIN_PARALELO = 4
+
+# ==========================================
+# 3.4 ALMACÉN DE FOTOS Y FIRMAS
+# ==========================================
+# En el mismo disco que la DB (en Render, el disco persistente): los reportes
+# guardan rutas a estos archivos y el PDF se puede regenerar cuando sea.
+MEDIA_DIR = os.getenv("MEDIA_DIR", os.path.join(os.path.dirname(DB_PATH), "media"))
+MEDIA_MINIATURA_PX = 320
+# Un archivo sin reportes que lo usen se borra recién tras este tiempo
+# (cubre una subida cuyo reporte aún no se registra)
+MEDIA_GC_GRACIA = int(os.getenv("MEDIA_GC_GRACIA", str(24 * 3600)))
+MEDIA_GC_INTERVALO = 6 * 3600
+
+# ==========================================
+# 3.5 CORREO DE REPORTES
+# ==========================================
+# Correos pendientes que el pipeline envía juntos en un POST /$batch (máx. 20)
+CORREO_LOTE = int(os.getenv("CORREO_LOTE", "20"))
+# Tamaño máximo del JSON de un $batch (los PDF van en base64 dentro)
+CORREO_LOTE_MAX_BYTES = 4 * 1024 * 1024
+# PDFs más grandes se adjuntan con upload session en vez de base64 (Graph: 3 MB)
+CORREO_ADJUNTO_INLINE_MAX = 2 * 1024 * 1024
+
+# ==========================================
+# 3.6 RESPALDOS DE LA BASE EN SHAREPOINT
+# ==========================================
+# Páginas copiadas por paso de la API de backup de SQLite y pausa entre pasos
+# (las escrituras de la API siguen entrando entre un paso y otro)
+BACKUP_PAGINAS_POR_PASO = 1024
+BACKUP_PAUSA = 0.005
+# Si la base cambia durante la copia SQLite reinicia el backup; tras estos
+# reinicios se copia de una vez (en WAL eso tampoco bloquea a los escritores)
+BACKUP_MAX_REINICIOS = 3
+BACKUP_NIVEL_GZIP = 6
+# Cada cuánto se respalda automáticamente (0 = solo manual). Los respaldos
+# programados son incrementales (solo lo modificado desde el anterior) y cada
+# BACKUP_COMPLETO_DIAS se hace uno completo, base de los siguientes.
+BACKUP_INTERVALO = int(os.getenv("BACKUP_INTERVALO", str(24 * 3600)))
+BACKUP_COMPLETO_DIAS = int(os.getenv("BACKUP_COMPLETO_DIAS", "7"))
+# Respaldos completos que se conservan (con los incrementales que dependen de ellos)
+BACKUP_RETENCION = int(os.getenv("BACKUP_RETENCION", "4"))
+
 # ==========================================
 # 4. CONFIGURACIÓN GENERAL Y ESTILOS
 # ==========================================
@@ -0,0 +1,243 @@
+import base64
+import datetime
+import json
+import os
+import time
+import config
+import graph
+
+# ==========================================
+# ENVÍO DE CORREOS DE REPORTE (GRAPH)
+# ==========================================
+# enviar_lote() agrupa hasta LIMITE_LOTE correos en un solo POST /$batch
+# (límite de Graph: 20 peticiones). Los que Graph rechaza con 429 dentro
+# del lote se reenvían tras su Retry-After. Los PDF que superan
+# CORREO_ADJUNTO_INLINE_MAX no van en base64 dentro del JSON: se crea un
+# borrador, el adjunto se sube con una upload session y luego se envía.
+
+LIMITE_LOTE = 20
+
+def _url_usuario():
+    return f"/users/{config.GRAPH_USER_EMAIL}"
+
+def _html_correo(cliente, tecnico):
+    color = config.COLOR_PRIMARIO
+    html_body = f"""
+    <!DOCTYPE html>
+    <html>
+    <body style="margin:0; padding:0; font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f4f4f4;">
+        <table width="100%" border="0" cellspacing="0" cellpadding="0">
+            <tr>
+                <td align="center" style="padding: 20px;">
+                    <table width="600" border="0" cellspacing="0" cellpadding="0" style="background-color: #ffffff; border-radius: 8px; overflow: hidden; box-shadow: 0 4px 10px rgba(0,0,0,0.1);">
+                        <tr>
+                            <td bgcolor="{color}" style="padding: 30px; text-align: center; color: #ffffff;">
+                                <h1 style="margin:0; font-size: 24px; font-weight: 600;">REPORTE TÉCNICO</h1>
+                                <p style="margin:5px 0 0; font-size: 14px; opacity: 0.9;">Servicio de Visita en Terreno</p>
+                            </td>
+                        </tr>
+                        <tr>
+                            <td style="padding: 40px 30px; color: #333333;">
+                                <p style="font-size: 16px; margin-bottom: 20px;">Estimados <strong>{cliente}</strong>,</p>
+                                <p style="line-height: 1.6; color: #555;">
+                                    Se ha completado satisfactoriamente la visita técnica programada. A continuación, se detallan los datos del servicio realizado por nuestro especialista.
+                                </p>
+                                
+                                <table width="100%" border="0" cellspacing="0" cellpadding="10" style="margin: 20px 0; background-color: #f9f9f9; border-left: 4px solid {color};">
+                                    <tr>
+                                        <td width="30%" style="font-weight: bold; color: #777;">TÉCNICO:</td>
+                                        <td style="font-weight: 600; color: #333;">{tecnico}</td>
+                                    </tr>
+                                    <tr>
+                                        <td style="font-weight: bold; color: #777;">FECHA:</td>
+                                        <td style="font-weight: 600; color: #333;">{datetime.datetime.now().strftime('%d/%m/%Y')}</td>
+                                    </tr>
+                                    <tr>
+                                        <td style="font-weight: bold; color: #777;">ESTADO:</td>
+                                        <td style="color: #27ae60; font-weight: bold;">✅ Finalizado con Éxito</td>
+                                    </tr>
+                                </table>
+
+                                <p style="text-align: center; font-size: 14px; color: #888; margin-top: 30px;">
+                                    📎 El informe completo se encuentra adjunto en formato PDF.
+                                </p>
+                            </td>
+                        </tr>
+                        <tr>
+                            <td bgcolor="#eeeeee" style="padding: 20px; text-align: center; font-size: 12px; color: #999;">
+                                <p style="margin: 0;">&copy; {datetime.datetime.now().year} {config.EMPRESA_NOMBRE}</p>
+                                <p style="margin: 5px 0 0;">Por favor, no responder a este correo automático.</p>
+                            </td>
+                        </tr>
+                    </table>
+                </td>
+            </tr>
+        </table>
+    </body>
+    </html>
+    """
+    return html_body
+
+def _mensaje(trabajo, destinatario):
+    """Mensaje de Graph sin adjuntos."""
+    # Si hay email técnico va en copia
+    cc_destinatarios = []
+    if trabajo.get('email_tecnico'):
+        cc_destinatarios.append({"emailAddress": {"address": trabajo['email_tecnico']}})
+    return {
+        "subject": f"📍 Reporte Visita - {trabajo['cliente']}",
+        "body": {"contentType": "HTML", "content": _html_correo(trabajo['cliente'], trabajo['tecnico'])},
+        "toRecipients": [{"emailAddress": {"address": destinatario}}],
+        "ccRecipients": cc_destinatarios,
+    }
+
+def _validar(trabajo):
+    """Retorna (destinatario, error)."""
+    ruta_pdf = trabajo.get('ruta_pdf')
+    if not ruta_pdf or not os.path.exists(ruta_pdf): return None, "PDF no existe."
+    destinatario = trabajo.get('email_cliente') or config.CORREOS_POR_CLIENTE.get(trabajo['cliente'], "")
+    if not destinatario: return None, f"No hay correo para {trabajo['cliente']}"
+    return destinatario, None
+
+def _cuerpo_sendmail(trabajo, destinatario):
+    with open(trabajo['ruta_pdf'], "rb") as f:
+        pdf_content = base64.b64encode(f.read()).decode("utf-8")
+    mensaje = _mensaje(trabajo, destinatario)
+    mensaje["attachments"] = [{
+        "@odata.type": "#microsoft.graph.fileAttachment",
+        "name": os.path.basename(trabajo['ruta_pdf']),
+        "contentType": "application/pdf",
+        "contentBytes": pdf_content
+    }]
+    return {"message": mensaje, "saveToSentItems": "true"}
+
+# --- ADJUNTOS GRANDES (borrador + upload session) ---
+
+def _enviar_con_sesion(trabajo, destinatario):
+    r = graph.solicitar("POST", f"{_url_usuario()}/messages", json=_mensaje(trabajo, destinatario))
+    if r.status_code != 201: return False, f"Error creando borrador: {r.text}"
+    id_mensaje = r.json()['id']
+    try:
+        r = graph.solicitar(
+            "POST", f"{_url_usuario()}/messages/{id_mensaje}/attachments/createUploadSession",
+            json={"AttachmentItem": {
+                "attachmentType": "file",
+                "name": os.path.basename(trabajo['ruta_pdf']),
+                "size": os.path.getsize(trabajo['ruta_pdf']),
+                "contentType": "application/pdf"
+            }}
+        )
+        if r.status_code != 201: raise RuntimeError(f"Error creando sesión de adjunto: {r.text}")
+        r = graph.subir_por_bloques(r.json()['uploadUrl'], trabajo['ruta_pdf'])
+        if r is None or r.status_code not in [200, 201]:
+            raise RuntimeError(f"Error subiendo adjunto: {getattr(r, 'text', r)}")
+        r = graph.solicitar("POST", f"{_url_usuario()}/messages/{id_mensaje}/send")
+        if r.status_code != 202: raise RuntimeError(f"Error enviando borrador: {r.text}")
+        return True, "Correo enviado (adjunto por sesión)"
+    except Exception as e:
+        # No dejar borradores huérfanos en el buzón
+        try: graph.solicitar("DELETE", f"{_url_usuario()}/messages/{id_mensaje}")
+        except Exception: pass
+        return False, f"Excepción Email: {e}"
+
+# --- ENVÍO ---
+
+def _enviar_batch(items):
+    """
+    POST /$batch con `items` = [(id, cuerpo_sendmail)]. Retorna
+    ({id: (ok, mensaje)}, {id: segundos}) con los resultados y los throttled.
+    """
+    peticiones = [{
+        "id": str(id_trabajo),
+        "method": "POST",
+        "url": f"{_url_usuario()}/sendMail",
+        "headers": {"Content-Type": "application/json"},
+        "body": cuerpo
+    } for id_trabajo, cuerpo in items]
+    r = graph.solicitar("POST", "/$batch", json={"requests": peticiones})
+    if r.status_code != 200:
+        error = f"Error $batch {r.status_code}: {r.text[:300]}"
+        return {str(i): (False, error) for i, _ in items}, {}
+
+    resultados, throttled = {}, {}
+    for resp in r.json().get("responses", []):
+        estado = resp.get("status")
+        if estado == 202:
+            resultados[resp["id"]] = (True, "Correo enviado")
+        elif estado in (429, 503):
+            retry_after = (resp.get("headers") or {}).get("Retry-After")
+            try: throttled[resp["id"]] = min(float(retry_after), config.GRAPH_ESPERA_MAXIMA)
+            except (TypeError, ValueError): throttled[resp["id"]] = config.GRAPH_ESPERA_BASE
+        else:
+            resultados[resp["id"]] = (False, f"Error Email {estado}: {json.dumps(resp.get('body'))[:300]}")
+    return resultados, throttled
+
+def _lotes(items):
+    """Parte `items` en grupos de hasta LIMITE_LOTE y CORREO_LOTE_MAX_BYTES."""
+    lote, tamano = [], 0
+    for item in items:
+        peso = len(json.dumps(item[1]))
+        if lote and (len(lote) >= LIMITE_LOTE or tamano + peso > config.CORREO_LOTE_MAX_BYTES):
+            yield lote
+            lote, tamano = [], 0
+        lote.append(item)
+        tamano += peso
+    if lote: yield lote
+
+def enviar_lote(trabajos):
+    """
+    `trabajos`: [{"id", "ruta_pdf", "cliente", "tecnico", "email_tecnico", "email_cliente"}].
+    Retorna {id: (ok, mensaje)} para todos los trabajos.
+    """
+    resultados = {}
+    inline = []
+    for t in trabajos:
+        destinatario, error = _validar(t)
+        if error:
+            resultados[t['id']] = (False, error)
+        elif os.path.getsize(t['ruta_pdf']) > config.CORREO_ADJUNTO_INLINE_MAX:
+            try: resultados[t['id']] = _enviar_con_sesion(t, destinatario)
+            except Exception as e: resultados[t['id']] = (False, f"Excepción Email: {e}")
+        else:
+            inline.append((t['id'], _cuerpo_sendmail(t, destinatario)))
+
+    por_id = {str(i): i for i, _ in inline}
+    pendientes = inline
+    for intento in range(config.GRAPH_MAX_REINTENTOS + 1):
+        if not pendientes: break
+        reintentar, espera = [], 0
+        for lote in _lotes(pendientes):
+            try:
+                ok_lote, throttled = _enviar_batch(lote)
+            except Exception as e:
+                ok_lote, throttled = {str(i): (False, f"Excepción Email: {e}") for i, _ in lote}, {}
+            for clave, res in ok_lote.items():
+                resultados[por_id[clave]] = res
+            reintentar += [item for item in lote if str(item[0]) in throttled]
+            espera = max([espera] + list(throttled.values()))
+        pendientes = reintentar
+        if pendientes and intento < config.GRAPH_MAX_REINTENTOS:
+            print(f"⚠️ Graph limitó {len(pendientes)} correos del lote. Reintento en {espera:.1f}s")
+            time.sleep(espera)
+    for id_trabajo, _ in pendientes:
+        resultados[id_trabajo] = (False, "Graph limitó el envío (429)")
+    # Respuestas que Graph no devolvió
+    for t in trabajos:
+        resultados.setdefault(t['id'], (False, "Sin respuesta en el $batch"))
+    return resultados
+
+def enviar_correo(ruta_pdf, cliente, tecnico, email_tecnico=None, email_cliente=None):
+    """Un solo correo (sin $batch). Retorna (ok, mensaje)."""
+    trabajo = {"id": 0, "ruta_pdf": ruta_pdf, "cliente": cliente, "tecnico": tecnico,
+               "email_tecnico": email_tecnico, "email_cliente": email_cliente}
+    destinatario, error = _validar(trabajo)
+    if error: return False, error
+    if not graph.obtener_token(): return False, "Error Auth Azure"
+    if os.path.getsize(ruta_pdf) > config.CORREO_ADJUNTO_INLINE_MAX:
+        return _enviar_con_sesion(trabajo, destinatario)
+    try:
+        r = graph.solicitar("POST", f"{_url_usuario()}/sendMail", json=_cuerpo_sendmail(trabajo, destinatario))
+        if r.status_code == 202: return True, "Correo enviado"
+        return False, f"Error Email: {r.text}"
+    except Exception as e:
+        return False, f"Excepción Email: {e}"
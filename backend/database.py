@@ -1,17 +1,113 @@
 import sqlite3
 import json
+import re
+import threading
+from contextlib import contextmanager
 import config
 
 DB_NAME = config.DB_PATH if hasattr(config, 'DB_PATH') else "visitas.db"
 
+# --- CONEXIONES (una por hilo, reutilizada) ---
+# Cada hilo (threadpool de FastAPI, worker del pipeline) mantiene abierta su
+# propia conexión ya configurada. No se cierran después de cada consulta.
+_local = threading.local()
+
+def _configurar(con):
+    # WAL: lectores y un escritor trabajan a la vez sin "database is locked"
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA busy_timeout={config.DB_BUSY_TIMEOUT_MS}")
+    con.execute("PRAGMA foreign_keys=ON")
+    con.execute(f"PRAGMA cache_size=-{config.DB_CACHE_KB}")
+
 def conectar():
-    return sqlite3.connect(DB_NAME)
+    """Conexión de este hilo (no cerrarla). Fuera de `transaccion()` trabaja en autocommit."""
+    con = getattr(_local, "con", None)
+    if con is None or getattr(_local, "db", None) != DB_NAME:
+        if con is not None:
+            con.close()
+        con = sqlite3.connect(DB_NAME, timeout=config.DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        _configurar(con)
+        _local.con, _local.db = con, DB_NAME
+    return con
 
-def inicializar_db():
+def cerrar_conexion():
+    """Cierra la conexión del hilo actual (p. ej. al terminar un script)."""
+    con = getattr(_local, "con", None)
+    if con is not None:
+        con.close()
+        _local.con = None
+
+def copiar_base(destino, paginas=-1, pausa=0.25, progreso=None):
+    """
+    Copia consistente de la base en el archivo `destino` con la API de backup de
+    SQLite, de a `paginas` páginas con `pausa` segundos entre pasos. Usa conexiones
+    propias para no interferir con las transacciones de este hilo.
+    `progreso(estado, restantes, total)` es el callback de sqlite3.Connection.backup.
+    """
+    origen = sqlite3.connect(DB_NAME, timeout=config.DB_BUSY_TIMEOUT_MS / 1000)
+    copia = sqlite3.connect(destino)
+    try:
+        origen.backup(copia, pages=paginas, progress=progreso, sleep=pausa)
+    finally:
+        copia.close()
+        origen.close()
+
+@contextmanager
+def transaccion():
+    """
+    `with transaccion() as cur:` -> BEGIN IMMEDIATE ... COMMIT (ROLLBACK si hay excepción).
+    Si ya hay una transacción abierta en este hilo, se une a ella.
+    """
     con = conectar()
-    cur = con.cursor()
-    
-    # --- CREACIÓN DE TABLAS ---
+    if con.in_transaction:
+        yield con.cursor()
+        return
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con.cursor()
+    except BaseException:
+        # SQLite puede haber deshecho la transacción por su cuenta (SQLITE_FULL, IOERR...)
+        if con.in_transaction: con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+
+@contextmanager
+def lectura():
+    """
+    `with lectura() as cur:` -> BEGIN (diferido) ... COMMIT. Varias consultas ven la
+    misma foto de la base sin tomar el lock de escritura (en WAL no bloquea a nadie).
+    Si ya hay una transacción abierta en este hilo, se une a ella.
+    """
+    con = conectar()
+    if con.in_transaction:
+        yield con.cursor()
+        return
+    con.execute("BEGIN")
+    try:
+        yield con.cursor()
+    finally:
+        if con.in_transaction: con.execute("COMMIT")
+
+def _consultar(sql, params=()):
+    return conectar().execute(sql, params).fetchall()
+
+def _consultar_uno(sql, params=()):
+    return conectar().execute(sql, params).fetchone()
+
+# ==========================================
+# MIGRACIONES VERSIONADAS (PRAGMA user_version)
+# ==========================================
+# Cada función lleva el esquema de la versión N-1 a la N. `migrar()` aplica
+# en orden las que faltan, cada una en su propia transacción junto con el
+# nuevo user_version. Para cambiar el esquema se AGREGA una migración al final
+# de MIGRACIONES; nunca se editan las ya publicadas.
+
+def _columnas(cur, tabla):
+    return {fila[1] for fila in cur.execute(f"PRAGMA table_info({tabla})").fetchall()}
+
+def _m001_esquema_base(cur):
+    # Idempotente: las bases creadas antes de user_version ya tienen parte de esto
     cur.execute("""
         CREATE TABLE IF NOT EXISTS reportes (
             id INTEGER PRIMARY KEY AUTOINCREMENT, 
@@ -41,25 +137,524 @@ def inicializar_db():
             FOREIGN KEY(cliente_nombre) REFERENCES clientes(nombre) ON DELETE CASCADE
         )
     """)
+    # Estado de cada etapa del pipeline de entrega (pdf, sharepoint, lista, email)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS etapas_reporte (
+            reporte_id INTEGER,
+            etapa TEXT,
+            estado TEXT DEFAULT 'pendiente',
+            depende_de TEXT,
+            intentos INTEGER DEFAULT 0,
+            proximo_intento REAL DEFAULT 0,
+            mensaje TEXT,
+            actualizado TEXT,
+            PRIMARY KEY (reporte_id, etapa)
+        )
+    """)
 
-    # --- MIGRACIONES DE COLUMNAS (Para evitar errores si ya existen) ---
+    # Columnas agregadas a reportes con el tiempo
     columnas_reportes = [
         ("pdf_path", "TEXT"),
         ("detalles_usuarios", "TEXT"),
         ("email_enviado", "INTEGER DEFAULT 0"),
         ("latitud", "TEXT"),
-        ("longitud", "TEXT")
+        ("longitud", "TEXT"),
+        ("email_tecnico", "TEXT"),
+        ("sharepoint_url", "TEXT")
     ]
-    
+    existentes = _columnas(cur, "reportes")
     for col, tipo in columnas_reportes:
-        try: 
+        if col not in existentes:
             cur.execute(f"ALTER TABLE reportes ADD COLUMN {col} {tipo}")
-        except: pass
+
+def _m002_indices(cur):
+    # obtener_usuarios_por_cliente: WHERE cliente_nombre = ? ORDER BY nombre
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_cliente ON usuarios(cliente_nombre, nombre)")
+    # GROUP BY cliente / tecnico (métricas): recorren el índice, no la tabla con los JSON
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_cliente ON reportes(cliente)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_tecnico ON reportes(tecnico)")
+    # obtener_evolucion_mensual: índice sobre la MISMA expresión substr(fecha, 1, 7)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_mes ON reportes(substr(fecha, 1, 7))")
+    # Pendientes de correo: índice parcial, solo contiene las filas con email_enviado = 0
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reportes_pendientes ON reportes(id) WHERE email_enviado = 0")
+    # Cola del pipeline
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_etapas_cola ON etapas_reporte(estado, proximo_intento)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_etapas_tipo ON etapas_reporte(etapa, estado)")
+
+# Tablas maestras que sincronizan las tablets: tabla -> (columna clave, columnas)
+TABLAS_SYNC = {
+    "clientes": ("nombre", ["nombre", "email"]),
+    "tecnicos": ("nombre", ["nombre"]),
+    "usuarios": ("id", ["id", "nombre", "cliente_nombre"]),
+}
+
+def _m003_registro_cambios(cur):
+    # Cada alta/modificación/baja en las tablas maestras deja una fila con `seq`
+    # creciente (la escriben los triggers, en la misma transacción del cambio).
+    # Las bajas quedan como 'delete' (tombstone) para que la tablet las aplique.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cambios (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tabla TEXT NOT NULL,
+            clave TEXT NOT NULL,
+            operacion TEXT NOT NULL,
+            datos TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cambios_clave ON cambios(tabla, clave, seq)")
+    for tabla, (clave, columnas) in TABLAS_SYNC.items():
+        datos_new = "json_object(" + ", ".join(f"'{c}', NEW.{c}" for c in columnas) + ")"
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_cambios_insert AFTER INSERT ON {tabla} BEGIN
+                INSERT INTO cambios (tabla, clave, operacion, datos) VALUES ('{tabla}', NEW.{clave}, 'upsert', {datos_new});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_cambios_update AFTER UPDATE ON {tabla} BEGIN
+                INSERT INTO cambios (tabla, clave, operacion, datos)
+                    SELECT '{tabla}', OLD.{clave}, 'delete', NULL WHERE OLD.{clave} IS NOT NEW.{clave};
+                INSERT INTO cambios (tabla, clave, operacion, datos) VALUES ('{tabla}', NEW.{clave}, 'upsert', {datos_new});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_cambios_delete AFTER DELETE ON {tabla} BEGIN
+                INSERT INTO cambios (tabla, clave, operacion, datos) VALUES ('{tabla}', OLD.{clave}, 'delete', NULL);
+            END
+        """)
+
+def _m004_usuarios_unicos(cur):
+    # Antes se permitían duplicados (nombre, cliente): se conserva el más antiguo.
+    # Los borrados pasan por los triggers y llegan a las tablets como 'delete'.
+    cur.execute("""
+        DELETE FROM usuarios WHERE id NOT IN (
+            SELECT MIN(id) FROM usuarios GROUP BY cliente_nombre, nombre
+        )
+    """)
+    # Reemplaza a idx_usuarios_cliente (mismas columnas, ahora UNIQUE)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_usuarios_unico ON usuarios(cliente_nombre, nombre)")
+    cur.execute("DROP INDEX IF EXISTS idx_usuarios_cliente")
+
+# --- Métricas materializadas ---
+# Conteos por cliente, técnico y mes (más el total y los pendientes de correo)
+# mantenidos por triggers sobre `reportes`: cualquier INSERT/UPDATE/DELETE los
+# ajusta en su misma transacción, sin importar qué función lo hizo.
+
+def _sql_metricas(fila, signo):
+    """Sentencias que suman (signo 1) o restan (signo -1) la fila OLD/NEW de las métricas."""
+    pendiente = f"({fila}.email_enviado IS 0)"
+    grupos = [
+        ("metricas_clientes", "cliente", f"IFNULL({fila}.cliente, '')", True),
+        ("metricas_tecnicos", "tecnico", f"IFNULL({fila}.tecnico, '')", False),
+        ("metricas_meses", "mes", f"IFNULL(substr({fila}.fecha, 1, 7), '')", False),
+    ]
+    sentencias = []
+    for tabla, clave, valor, con_pendientes in grupos:
+        if signo > 0:
+            if con_pendientes:
+                sentencias.append(f"""
+                    INSERT INTO {tabla} ({clave}, reportes, pendientes) VALUES ({valor}, 1, {pendiente})
+                    ON CONFLICT({clave}) DO UPDATE SET reportes = reportes + 1, pendientes = pendientes + excluded.pendientes""")
+            else:
+                sentencias.append(f"""
+                    INSERT INTO {tabla} ({clave}, reportes) VALUES ({valor}, 1)
+                    ON CONFLICT({clave}) DO UPDATE SET reportes = reportes + 1""")
+        else:
+            extra = f", pendientes = pendientes - {pendiente}" if con_pendientes else ""
+            sentencias.append(f"UPDATE {tabla} SET reportes = reportes - 1{extra} WHERE {clave} = {valor}")
+            sentencias.append(f"DELETE FROM {tabla} WHERE {clave} = {valor} AND reportes <= 0")
+    op = "+" if signo > 0 else "-"
+    sentencias.append(f"UPDATE metricas_totales SET reportes = reportes {op} 1, pendientes = pendientes {op} {pendiente}")
+    return ";\n".join(sentencias) + ";"
+
+def _reconstruir_metricas(cur):
+    for tabla in ("metricas_clientes", "metricas_tecnicos", "metricas_meses", "metricas_totales"):
+        cur.execute(f"DELETE FROM {tabla}")
+    cur.execute("""
+        INSERT INTO metricas_clientes (cliente, reportes, pendientes)
+        SELECT IFNULL(cliente, ''), COUNT(*), SUM(email_enviado IS 0) FROM reportes GROUP BY 1
+    """)
+    cur.execute("INSERT INTO metricas_tecnicos (tecnico, reportes) SELECT IFNULL(tecnico, ''), COUNT(*) FROM reportes GROUP BY 1")
+    cur.execute("INSERT INTO metricas_meses (mes, reportes) SELECT IFNULL(substr(fecha, 1, 7), ''), COUNT(*) FROM reportes GROUP BY 1")
+    cur.execute("""
+        INSERT INTO metricas_totales (id, reportes, pendientes)
+        SELECT 1, COUNT(*), IFNULL(SUM(email_enviado IS 0), 0) FROM reportes
+    """)
+
+def _m005_metricas(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS metricas_clientes (cliente TEXT PRIMARY KEY, reportes INTEGER NOT NULL, pendientes INTEGER NOT NULL)")
+    cur.execute("CREATE TABLE IF NOT EXISTS metricas_tecnicos (tecnico TEXT PRIMARY KEY, reportes INTEGER NOT NULL)")
+    cur.execute("CREATE TABLE IF NOT EXISTS metricas_meses (mes TEXT PRIMARY KEY, reportes INTEGER NOT NULL)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS metricas_totales (
+            id INTEGER PRIMARY KEY CHECK (id = 1), reportes INTEGER NOT NULL, pendientes INTEGER NOT NULL
+        )
+    """)
+    # Rankings (cliente top, gráficos) sin ordenar la tabla completa
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_metricas_clientes_reportes ON metricas_clientes(reportes)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_metricas_tecnicos_reportes ON metricas_tecnicos(reportes)")
+
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_reportes_metricas_insert AFTER INSERT ON reportes BEGIN {_sql_metricas('NEW', 1)} END")
+    cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_reportes_metricas_delete AFTER DELETE ON reportes BEGIN {_sql_metricas('OLD', -1)} END")
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_reportes_metricas_update
+        AFTER UPDATE OF fecha, cliente, tecnico, email_enviado ON reportes BEGIN
+            {_sql_metricas('OLD', -1)}
+            {_sql_metricas('NEW', 1)}
+        END
+    """)
+    _reconstruir_metricas(cur)
+
+# --- Detalle normalizado de cada visita ---
+# detalles_usuarios/imagen_path siguen siendo la fuente para el PDF; estas
+# tablas hijas permiten consultar por usuario, tarea o foto sin parsear JSON.
+
+def _tareas(trabajo):
+    # Mismo criterio que el PDF: la tablet envía las tareas separadas por coma
+    return [t.strip() for t in (trabajo or "").split(",") if t.strip()]
+
+def _guardar_detalle(cur, reporte_id, detalles_json, fotos_json):
+    """(Re)escribe reporte_usuarios, reporte_tareas y reporte_fotos desde los JSON del reporte."""
+    cur.execute("DELETE FROM reporte_usuarios WHERE reporte_id = ?", (reporte_id,))
+    cur.execute("DELETE FROM reporte_fotos WHERE reporte_id = ?", (reporte_id,))
+    try:
+        usuarios = json.loads(detalles_json or "[]")
+        fotos = json.loads(fotos_json or "[]")
+    except ValueError:
+        return
+    if not isinstance(usuarios, list): usuarios = []
+    if not isinstance(fotos, list): fotos = []
+
+    fotos_con_usuario = set()
+    for posicion, u in enumerate(usuarios):
+        if not isinstance(u, dict): continue
+        atendido = 1 if u.get("atendido") else 0
+        cur.execute("""
+            INSERT INTO reporte_usuarios (reporte_id, posicion, nombre, atendido, motivo, trabajo, firma)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (reporte_id, posicion, u.get("nombre"), atendido, u.get("motivo"), u.get("trabajo"), u.get("firma")))
+        usuario_id = cur.lastrowid
+        if atendido:
+            cur.executemany(
+                "INSERT INTO reporte_tareas (reporte_id, usuario_id, tarea) VALUES (?, ?, ?)",
+                [(reporte_id, usuario_id, t) for t in _tareas(u.get("trabajo"))]
+            )
+        fotos_usuario = [f for f in (u.get("fotos") or []) if isinstance(f, str)]
+        fotos_con_usuario.update(fotos_usuario)
+        cur.executemany(
+            "INSERT INTO reporte_fotos (reporte_id, usuario_id, posicion, ruta) VALUES (?, ?, ?, ?)",
+            [(reporte_id, usuario_id, i, f) for i, f in enumerate(fotos_usuario)]
+        )
+    # Fotos de la visita que no quedaron asociadas a ningún usuario
+    sueltas = [f for f in fotos if isinstance(f, str) and f not in fotos_con_usuario]
+    cur.executemany(
+        "INSERT INTO reporte_fotos (reporte_id, usuario_id, posicion, ruta) VALUES (?, NULL, ?, ?)",
+        [(reporte_id, i, f) for i, f in enumerate(sueltas)]
+    )
+
+def _m006_detalle_normalizado(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS reporte_usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reporte_id INTEGER NOT NULL REFERENCES reportes(id) ON DELETE CASCADE,
+            posicion INTEGER,
+            nombre TEXT,
+            atendido INTEGER,
+            motivo TEXT,
+            trabajo TEXT,
+            firma TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS reporte_tareas (
+            reporte_id INTEGER NOT NULL REFERENCES reportes(id) ON DELETE CASCADE,
+            usuario_id INTEGER NOT NULL REFERENCES reporte_usuarios(id) ON DELETE CASCADE,
+            tarea TEXT NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS reporte_fotos (
+            reporte_id INTEGER NOT NULL REFERENCES reportes(id) ON DELETE CASCADE,
+            usuario_id INTEGER REFERENCES reporte_usuarios(id) ON DELETE CASCADE,
+            posicion INTEGER,
+            ruta TEXT NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reporte_usuarios_reporte ON reporte_usuarios(reporte_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reporte_usuarios_nombre ON reporte_usuarios(nombre, reporte_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reporte_tareas_usuario ON reporte_tareas(usuario_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reporte_tareas_tarea ON reporte_tareas(tarea, reporte_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reporte_fotos_reporte ON reporte_fotos(reporte_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reporte_fotos_usuario ON reporte_fotos(usuario_id)")
+
+    # Backfill de los reportes existentes, por lotes para no cargar todos los JSON a la vez
+    ultimo = 0
+    while True:
+        filas = cur.execute(
+            "SELECT id, detalles_usuarios, imagen_path FROM reportes WHERE id > ? ORDER BY id LIMIT 1000", (ultimo,)
+        ).fetchall()
+        if not filas: break
+        for reporte_id, detalles, fotos in filas:
+            _guardar_detalle(cur, reporte_id, detalles, fotos)
+        ultimo = filas[-1][0]
+
+def _m007_almacen_media(cur):
+    # Un archivo por contenido (ver media.py); `refs` = reportes que lo usan
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            sha256 TEXT PRIMARY KEY,
+            ruta TEXT NOT NULL,
+            bytes INTEGER,
+            refs INTEGER NOT NULL DEFAULT 0,
+            creado TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS reporte_media (
+            reporte_id INTEGER NOT NULL REFERENCES reportes(id) ON DELETE CASCADE,
+            sha256 TEXT NOT NULL REFERENCES media(sha256),
+            PRIMARY KEY (reporte_id, sha256)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reporte_media_sha ON reporte_media(sha256)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_media_sin_refs ON media(sha256) WHERE refs = 0")
+    # El contador se mantiene en la misma transacción que asocia o borra el reporte
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reporte_media_insert AFTER INSERT ON reporte_media BEGIN
+            UPDATE media SET refs = refs + 1 WHERE sha256 = NEW.sha256;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reporte_media_delete AFTER DELETE ON reporte_media BEGIN
+            UPDATE media SET refs = refs - 1 WHERE sha256 = OLD.sha256;
+        END
+    """)
+
+def _m008_idempotencia(cur):
+    # Idempotency-Key de POST /reporte/crear -> reporte ya creado con esa clave
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            clave TEXT PRIMARY KEY,
+            reporte_id INTEGER NOT NULL REFERENCES reportes(id) ON DELETE CASCADE,
+            huella TEXT NOT NULL,
+            creado TEXT NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotencia_creado ON idempotencia(creado)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotencia_reporte ON idempotencia(reporte_id)")
+
+# --- Registro para respaldos incrementales ---
+# Tablas que viajan en los respaldos incrementales: tabla -> columnas que
+# identifican un grupo de filas (la PK, o una columna indexada si no la tiene).
+# Las metricas_* no van: se recalculan al restaurar.
+TABLAS_RESPALDO = {
+    "clientes": ["nombre"],
+    "tecnicos": ["id"],
+    "usuarios": ["id"],
+    "reportes": ["id"],
+    "etapas_reporte": ["reporte_id", "etapa"],
+    "reporte_usuarios": ["id"],
+    "reporte_tareas": ["usuario_id"],
+    "reporte_fotos": ["reporte_id"],
+    "media": ["sha256"],
+    "reporte_media": ["reporte_id", "sha256"],
+    "idempotencia": ["clave"],
+    "cambios": ["seq"],
+}
+
+def _m009_registro_respaldo(cur):
+    # Una fila por clave modificada desde el último respaldo (no por cambio):
+    # los triggers la borran y la vuelven a insertar con el `seq` más nuevo. El
+    # respaldo incremental lee el estado actual de esas claves.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cambios_respaldo (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tabla TEXT NOT NULL,
+            clave TEXT NOT NULL
+        )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_cambios_respaldo_clave ON cambios_respaldo(tabla, clave)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS respaldos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            archivo TEXT NOT NULL,
+            hasta INTEGER NOT NULL,
+            bytes INTEGER,
+            fecha TEXT NOT NULL
+        )
+    """)
+    _crear_triggers_respaldo(cur)
+
+def _sql_marcar_respaldo(tabla, clave, condicion="1"):
+    # DELETE + INSERT y no INSERT OR REPLACE: la política de conflicto de la
+    # sentencia externa (p. ej. el upsert de agregar_cliente) reemplaza a la del
+    # trigger, y el REPLACE terminaba en "UNIQUE constraint failed"
+    return f"""
+        DELETE FROM cambios_respaldo WHERE tabla = '{tabla}' AND clave = {clave} AND {condicion};
+        INSERT INTO cambios_respaldo (tabla, clave) SELECT '{tabla}', {clave} WHERE {condicion};
+    """
+
+def _crear_triggers_respaldo(cur):
+    for tabla, columnas in TABLAS_RESPALDO.items():
+        clave_new = "json_array(" + ", ".join(f"NEW.{c}" for c in columnas) + ")"
+        clave_old = "json_array(" + ", ".join(f"OLD.{c}" for c in columnas) + ")"
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_respaldo_insert AFTER INSERT ON {tabla} BEGIN
+                {_sql_marcar_respaldo(tabla, clave_new)}
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_respaldo_update AFTER UPDATE ON {tabla} BEGIN
+                {_sql_marcar_respaldo(tabla, clave_old, f"{clave_old} IS NOT {clave_new}")}
+                {_sql_marcar_respaldo(tabla, clave_new)}
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_respaldo_delete AFTER DELETE ON {tabla} BEGIN
+                {_sql_marcar_respaldo(tabla, clave_old)}
+            END
+        """)
+
+# --- Búsqueda de texto (FTS5) ---
+# Una fila por reporte (rowid = reportes.id) con sus textos; trabajo, motivo y
+# usuarios juntan los de todos los usuarios atendidos. Los triggers la mantienen
+# al día con cualquier escritura en reportes o reporte_usuarios.
+
+_FTS_USUARIOS = """
+    trabajo = (SELECT group_concat(trabajo, ' ') FROM reporte_usuarios WHERE reporte_id = {id}),
+    motivo = (SELECT group_concat(motivo, ' ') FROM reporte_usuarios WHERE reporte_id = {id}),
+    usuarios = (SELECT group_concat(nombre, ' ') FROM reporte_usuarios WHERE reporte_id = {id})
+"""
+
+def _reconstruir_busqueda(cur):
+    cur.execute("DELETE FROM reportes_fts")
+    cur.execute("""
+        INSERT INTO reportes_fts (rowid, cliente, tecnico, observaciones, trabajo, motivo, usuarios)
+        SELECT r.id, r.cliente, r.tecnico, r.observaciones, u.trabajo, u.motivo, u.usuarios
+        FROM reportes r LEFT JOIN (
+            SELECT reporte_id, group_concat(trabajo, ' ') AS trabajo, group_concat(motivo, ' ') AS motivo,
+                   group_concat(nombre, ' ') AS usuarios
+            FROM reporte_usuarios GROUP BY reporte_id
+        ) u ON u.reporte_id = r.id
+    """)
+    cur.execute("INSERT INTO reportes_fts (reportes_fts) VALUES ('optimize')")
+
+def _m010_busqueda(cur):
+    # remove_diacritics: "tecnico" encuentra "técnico"; prefix: índices para "antiv*"
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS reportes_fts USING fts5(
+            cliente, tecnico, observaciones, trabajo, motivo, usuarios,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reportes_fts_insert AFTER INSERT ON reportes BEGIN
+            INSERT INTO reportes_fts (rowid, cliente, tecnico, observaciones) VALUES (NEW.id, NEW.cliente, NEW.tecnico, NEW.observaciones);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reportes_fts_update AFTER UPDATE OF cliente, tecnico, observaciones ON reportes BEGIN
+            UPDATE reportes_fts SET cliente = NEW.cliente, tecnico = NEW.tecnico, observaciones = NEW.observaciones
+            WHERE rowid = NEW.id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reportes_fts_delete AFTER DELETE ON reportes BEGIN
+            DELETE FROM reportes_fts WHERE rowid = OLD.id;
+        END
+    """)
+    for evento, fila in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_reporte_usuarios_fts_{evento.lower()} AFTER {evento} ON reporte_usuarios BEGIN
+                UPDATE reportes_fts SET {_FTS_USUARIOS.format(id=f"{fila}.reporte_id")} WHERE rowid = {fila}.reporte_id;
+            END
+        """)
+    _reconstruir_busqueda(cur)
+
+def _crear_triggers_cambios(cur):
+    # Como _m003, pero cada trigger borra antes las entradas anteriores de la misma
+    # clave: obtener_cambios_desde solo usa la última por clave (MAX(seq)), así que
+    # el resultado es el mismo para cualquier cursor y `cambios` queda en una fila
+    # por clave (las bajas quedan como tombstone mientras la clave no reaparezca)
+    for tabla, (clave, columnas) in TABLAS_SYNC.items():
+        datos_new = "json_object(" + ", ".join(f"'{c}', NEW.{c}" for c in columnas) + ")"
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_cambios_insert AFTER INSERT ON {tabla} BEGIN
+                DELETE FROM cambios WHERE tabla = '{tabla}' AND clave = NEW.{clave};
+                INSERT INTO cambios (tabla, clave, operacion, datos) VALUES ('{tabla}', NEW.{clave}, 'upsert', {datos_new});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_cambios_update AFTER UPDATE ON {tabla} BEGIN
+                DELETE FROM cambios WHERE tabla = '{tabla}' AND clave = OLD.{clave} AND OLD.{clave} IS NOT NEW.{clave};
+                INSERT INTO cambios (tabla, clave, operacion, datos)
+                    SELECT '{tabla}', OLD.{clave}, 'delete', NULL WHERE OLD.{clave} IS NOT NEW.{clave};
+                DELETE FROM cambios WHERE tabla = '{tabla}' AND clave = NEW.{clave};
+                INSERT INTO cambios (tabla, clave, operacion, datos) VALUES ('{tabla}', NEW.{clave}, 'upsert', {datos_new});
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_cambios_delete AFTER DELETE ON {tabla} BEGIN
+                DELETE FROM cambios WHERE tabla = '{tabla}' AND clave = OLD.{clave};
+                INSERT INTO cambios (tabla, clave, operacion, datos) VALUES ('{tabla}', OLD.{clave}, 'delete', NULL);
+            END
+        """)
+
+def _m011_triggers_respaldo(cur):
+    # Bases que ya aplicaron la v9 con los triggers INSERT OR REPLACE
+    for tabla in TABLAS_RESPALDO:
+        for evento in ("insert", "update", "delete"):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{tabla}_respaldo_{evento}")
+    _crear_triggers_respaldo(cur)
+
+def _m012_compactar_cambios(cur):
+    # `cambios` crecía con cada escritura; desde aquí guarda solo la última entrada por clave
+    for evento in ("insert", "update", "delete"):
+        for tabla in TABLAS_SYNC:
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{tabla}_cambios_{evento}")
+    _crear_triggers_cambios(cur)
+    cur.execute("DELETE FROM cambios WHERE seq NOT IN (SELECT MAX(seq) FROM cambios GROUP BY tabla, clave)")
+
+MIGRACIONES = [
+    _m001_esquema_base,
+    _m002_indices,
+    _m003_registro_cambios,
+    _m004_usuarios_unicos,
+    _m005_metricas,
+    _m006_detalle_normalizado,
+    _m007_almacen_media,
+    _m008_idempotencia,
+    _m009_registro_respaldo,
+    _m010_busqueda,
+    _m011_triggers_respaldo,
+    _m012_compactar_cambios,
+]
+
+def version_esquema():
+    return _consultar_uno("PRAGMA user_version")[0]
+
+def migrar(hasta=None):
+    """Aplica las migraciones pendientes (hasta la versión `hasta`, o todas). Retorna la versión final."""
+    objetivo = len(MIGRACIONES) if hasta is None else hasta
+    version = version_esquema()
+    while version < objetivo:
+        migracion = MIGRACIONES[version]
+        with transaccion() as cur:
+            migracion(cur)
+            cur.execute(f"PRAGMA user_version = {version + 1}")
+        version += 1
+        print(f"🗄️ Migración {version} aplicada: {migracion.__name__}")
+    if version > len(MIGRACIONES):
+        print(f"⚠️ La base está en la versión {version}, más nueva que este código ({len(MIGRACIONES)})")
+    return version
+
+def inicializar_db():
+    migrar()
 
     # --- DATOS POR DEFECTO (ELIMINADO) ---
     # He comentado estas líneas para evitar que los datos borrados reaparezcan.
     # Si quieres iniciar con datos vacíos, esto es lo correcto.
-    
+
     # cur.execute("SELECT COUNT(*) FROM tecnicos")
     # if cur.fetchone()[0] == 0:
     #     cur.executemany("INSERT OR IGNORE INTO tecnicos (nombre) VALUES (?)", [("Francisco Alfaro",), ("David Quezada",)])
@@ -68,44 +663,30 @@ def inicializar_db():
     # if cur.fetchone()[0] == 0:
     #     for cli, email in config.CORREOS_POR_CLIENTE.items():
     #         cur.execute("INSERT OR IGNORE INTO clientes (nombre, email) VALUES (?, ?)", (cli, email))
-            
+
     # cur.execute("SELECT COUNT(*) FROM usuarios")
     # if cur.fetchone()[0] == 0:
     #     for cli, lista_users in config.USUARIOS_POR_CLIENTE.items():
     #         for u in lista_users:
     #             cur.execute("INSERT INTO usuarios (nombre, cliente_nombre) VALUES (?, ?)", (u, cli))
 
-    con.commit()
-    con.close()
-
 # --- FUNCIONES TÉCNICOS ---
 
 def obtener_tecnicos():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT nombre FROM tecnicos ORDER BY nombre ASC")
-    lista = [row[0] for row in cur.fetchall()]
-    con.close()
-    return lista
+    return [row[0] for row in _consultar("SELECT nombre FROM tecnicos ORDER BY nombre ASC")]
 
 def agregar_nuevo_tecnico(nombre):
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("INSERT INTO tecnicos (nombre) VALUES (?)", (nombre,))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("INSERT INTO tecnicos (nombre) VALUES (?)", (nombre,))
         return True
     except: 
         return False
 
 def eliminar_tecnico(nombre):
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("DELETE FROM tecnicos WHERE nombre = ?", (nombre,))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("DELETE FROM tecnicos WHERE nombre = ?", (nombre,))
         return True
     except: 
         return False
@@ -113,204 +694,750 @@ def eliminar_tecnico(nombre):
 # --- FUNCIONES CLIENTES ---
 
 def obtener_clientes():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT nombre, email FROM clientes ORDER BY nombre ASC")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _consultar("SELECT nombre, email FROM clientes ORDER BY nombre ASC")
 
 def obtener_nombres_clientes():
     return [c[0] for c in obtener_clientes()]
 
 def agregar_cliente(nombre, email):
+    """True si creó el cliente o le cambió el email; False si ya estaba igual o hubo error."""
     if not nombre: return False
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("INSERT OR REPLACE INTO clientes (nombre, email) VALUES (?, ?)", (nombre, email))
-        con.commit()
-        con.close()
-        return True
+        # UPSERT y no INSERT OR REPLACE: con foreign_keys=ON el REPLACE borra la fila
+        # y el ON DELETE CASCADE se llevaría a todos los usuarios del cliente.
+        # El WHERE evita reescribir (y registrar en `cambios`) un email que no cambió:
+        # /reporte/crear llama aquí en cada visita que trae email_cliente
+        with transaccion() as cur:
+            cur.execute("""
+                INSERT INTO clientes (nombre, email) VALUES (?, ?)
+                ON CONFLICT(nombre) DO UPDATE SET email = excluded.email WHERE clientes.email IS NOT excluded.email
+            """, (nombre, email))
+            return cur.rowcount > 0
     except Exception as e: 
         print(f"Error agregando cliente DB: {e}")
         return False
 
 def eliminar_cliente(nombre):
     try:
-        con = conectar()
-        cur = con.cursor()
-        # Primero borramos usuarios asociados para mantener integridad
-        cur.execute("DELETE FROM usuarios WHERE cliente_nombre = ?", (nombre,))
-        cur.execute("DELETE FROM clientes WHERE nombre = ?", (nombre,))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            # Primero borramos usuarios asociados para mantener integridad
+            cur.execute("DELETE FROM usuarios WHERE cliente_nombre = ?", (nombre,))
+            cur.execute("DELETE FROM clientes WHERE nombre = ?", (nombre,))
         return True
     except: 
         return False
 
 def obtener_correo_cliente(nombre_cliente):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT email FROM clientes WHERE nombre = ?", (nombre_cliente,))
-    res = cur.fetchone()
-    con.close()
+    res = _consultar_uno("SELECT email FROM clientes WHERE nombre = ?", (nombre_cliente,))
     return res[0] if res else ""
 
 # --- FUNCIONES USUARIOS ---
 
 def obtener_usuarios_por_cliente(cliente_nombre):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT nombre FROM usuarios WHERE cliente_nombre = ? ORDER BY nombre ASC", (cliente_nombre,))
-    lista = [row[0] for row in cur.fetchall()]
-    con.close()
-    return lista
+    filas = _consultar("SELECT nombre FROM usuarios WHERE cliente_nombre = ? ORDER BY nombre ASC", (cliente_nombre,))
+    return [row[0] for row in filas]
+
+def obtener_todos_usuarios():
+    return _consultar("SELECT nombre, cliente_nombre FROM usuarios")
 
 def agregar_usuario(nombre, cliente_nombre):
+    """
+    True si se creó, False si ya existía o hubo un error de base.
+    Si el cliente no existe (FK) lanza sqlite3.IntegrityError: el llamador debe informarlo.
+    """
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("INSERT INTO usuarios (nombre, cliente_nombre) VALUES (?, ?)", (nombre, cliente_nombre))
-        con.commit()
-        con.close()
-        return True
-    except: 
+        with transaccion() as cur:
+            cur.execute("""
+                INSERT INTO usuarios (nombre, cliente_nombre) VALUES (?, ?)
+                ON CONFLICT(cliente_nombre, nombre) DO NOTHING
+            """, (nombre, cliente_nombre))
+            return cur.rowcount > 0
+    except sqlite3.IntegrityError:
+        raise
+    except Exception:
         return False
 
 def eliminar_usuario(nombre, cliente_nombre):
     try: 
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("DELETE FROM usuarios WHERE nombre = ? AND cliente_nombre = ?", (nombre, cliente_nombre))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("DELETE FROM usuarios WHERE nombre = ? AND cliente_nombre = ?", (nombre, cliente_nombre))
         return True
     except: 
         return False
 
+# --- CARGA MASIVA (JSON / CSV) ---
+# Todo el lote va en UNA transacción: se consulta qué filas ya existen, se
+# aplica con executemany y se devuelve el resultado de cada fila:
+# 'creado', 'actualizado', 'sin_cambios', 'duplicado' (repetida en el lote) o 'error: ...'.
+
+def _limpiar(valor):
+    return str(valor).strip() if valor is not None else ""
+
+def _marcar_duplicados(claves, resultados):
+    """Si una clave se repite en el lote gana la última aparición. Retorna {clave: índice}."""
+    ultima = {}
+    for i, clave in enumerate(claves):
+        if clave is None: continue
+        if clave in ultima: resultados[ultima[clave]] = "duplicado"
+        ultima[clave] = i
+    return ultima
+
+def importar_clientes(filas):
+    """`filas`: lista de (nombre, email). Upsert por nombre; retorna lista de resultados."""
+    filas = [(_limpiar(n), _limpiar(e)) for n, e in filas]
+    resultados = [None] * len(filas)
+    claves = []
+    for i, (nombre, _) in enumerate(filas):
+        if not nombre:
+            resultados[i] = "error: nombre vacío"
+        claves.append(nombre or None)
+    ultima = _marcar_duplicados(claves, resultados)
+
+    with transaccion() as cur:
+        existentes = dict(cur.execute(
+            "SELECT nombre, email FROM clientes WHERE nombre IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(ultima)),)
+        ).fetchall())
+        for nombre, i in ultima.items():
+            if nombre not in existentes: resultados[i] = "creado"
+            elif existentes[nombre] != filas[i][1]: resultados[i] = "actualizado"
+            else: resultados[i] = "sin_cambios"
+        # El WHERE evita reescribir (y registrar en `cambios`) filas que no cambiaron
+        cur.executemany("""
+            INSERT INTO clientes (nombre, email) VALUES (?, ?)
+            ON CONFLICT(nombre) DO UPDATE SET email = excluded.email WHERE email IS NOT excluded.email
+        """, [filas[i] for i in ultima.values() if resultados[i] != "sin_cambios"])
+    return resultados
+
+def importar_tecnicos(nombres):
+    """`nombres`: lista de nombres. Retorna lista de resultados ('creado' / 'sin_cambios')."""
+    nombres = [_limpiar(n) for n in nombres]
+    resultados = [None if n else "error: nombre vacío" for n in nombres]
+    ultima = _marcar_duplicados([n or None for n in nombres], resultados)
+
+    with transaccion() as cur:
+        existentes = {row[0] for row in cur.execute(
+            "SELECT nombre FROM tecnicos WHERE nombre IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(ultima)),)
+        )}
+        for nombre, i in ultima.items():
+            resultados[i] = "sin_cambios" if nombre in existentes else "creado"
+        cur.executemany(
+            "INSERT INTO tecnicos (nombre) VALUES (?) ON CONFLICT(nombre) DO NOTHING",
+            [(n,) for n in ultima if n not in existentes]
+        )
+    return resultados
+
+def importar_usuarios(filas):
+    """`filas`: lista de (nombre, cliente). El cliente debe existir. Retorna lista de resultados."""
+    filas = [(_limpiar(n), _limpiar(c)) for n, c in filas]
+    resultados = [None] * len(filas)
+    claves = []
+    for i, (nombre, cliente) in enumerate(filas):
+        if not nombre or not cliente:
+            resultados[i] = "error: nombre y cliente son obligatorios"
+            claves.append(None)
+        else:
+            claves.append((cliente, nombre))
+    ultima = _marcar_duplicados(claves, resultados)
+
+    with transaccion() as cur:
+        clientes = {row[0] for row in cur.execute(
+            "SELECT nombre FROM clientes WHERE nombre IN (SELECT value FROM json_each(?))",
+            (json.dumps(list({c for c, _ in ultima})),)
+        )}
+        existentes = set(cur.execute("""
+            SELECT u.cliente_nombre, u.nombre FROM json_each(?) j
+            JOIN usuarios u ON u.cliente_nombre = json_extract(j.value, '$[0]') AND u.nombre = json_extract(j.value, '$[1]')
+        """, (json.dumps([list(k) for k in ultima]),)).fetchall())
+        nuevos = []
+        for (cliente, nombre), i in ultima.items():
+            if cliente not in clientes:
+                resultados[i] = f"error: cliente '{cliente}' no existe"
+            elif (cliente, nombre) in existentes:
+                resultados[i] = "sin_cambios"
+            else:
+                resultados[i] = "creado"
+                nuevos.append((nombre, cliente))
+        cur.executemany("""
+            INSERT INTO usuarios (nombre, cliente_nombre) VALUES (?, ?)
+            ON CONFLICT(cliente_nombre, nombre) DO NOTHING
+        """, nuevos)
+    return resultados
+
+# --- SINCRONIZACIÓN INCREMENTAL (TABLETS) ---
+
+def obtener_cambios_desde(cursor_desde):
+    """
+    Cambios en clientes/tecnicos/usuarios con seq > `cursor_desde`, solo el último
+    por fila. Sin cursor o con cursor 0 (primera sincronización) se envía la foto
+    completa: las filas anteriores a la migración v3 no tienen entrada en `cambios`.
+    Retorna (cursor_nuevo, completo, {tabla: {"upsert": [...], "delete": [...]}}).
+    """
+    resultado = {tabla: {"upsert": [], "delete": []} for tabla in TABLAS_SYNC}
+    # Cursor y datos se leen en la misma foto para no perder cambios intermedios
+    with lectura() as cur:
+        cursor_nuevo = cur.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0]
+        # Cursor desconocido (p. ej. base restaurada de un respaldo): se reenvía todo
+        completo = not cursor_desde or cursor_desde > cursor_nuevo
+        if completo:
+            for tabla, (clave, columnas) in TABLAS_SYNC.items():
+                for fila in cur.execute(f"SELECT {', '.join(columnas)} FROM {tabla} ORDER BY {clave}"):
+                    resultado[tabla]["upsert"].append(dict(zip(columnas, fila)))
+            return cursor_nuevo, completo, resultado
+
+        filas = cur.execute("""
+            SELECT tabla, clave, operacion, datos FROM cambios
+            WHERE seq IN (SELECT MAX(seq) FROM cambios WHERE seq > ? AND seq <= ? GROUP BY tabla, clave)
+            ORDER BY seq
+        """, (cursor_desde, cursor_nuevo)).fetchall()
+    for tabla, clave, operacion, datos in filas:
+        if tabla not in resultado: continue
+        if operacion == "delete":
+            resultado[tabla]["delete"].append(int(clave) if TABLAS_SYNC[tabla][0] == "id" else clave)
+        else:
+            resultado[tabla]["upsert"].append(json.loads(datos))
+    return cursor_nuevo, completo, resultado
+
 # --- FUNCIONES REPORTES (CRUD y ELIMINACIÓN) ---
 
 def eliminar_reporte(id_reporte):
     try:
-        con = conectar()
-        cur = con.cursor()
-        cur.execute("DELETE FROM reportes WHERE id = ?", (id_reporte,))
-        filas_afectadas = cur.rowcount
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("DELETE FROM etapas_reporte WHERE reporte_id = ?", (id_reporte,))
+            cur.execute("DELETE FROM reportes WHERE id = ?", (id_reporte,))
+            filas_afectadas = cur.rowcount
         return filas_afectadas > 0
     except Exception as e:
         print(f"Error eliminando reporte: {e}")
         return False
 
 def obtener_conteo_reportes():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT COUNT(*) FROM reportes")
-    total = cur.fetchone()[0]
-    con.close()
-    return total
+    return _consultar_uno("SELECT COUNT(*) FROM reportes")[0]
 
 def obtener_historial():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT id, fecha, cliente, tecnico, observaciones, pdf_path, email_enviado, detalles_usuarios, imagen_path FROM reportes ORDER BY id DESC")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _consultar("SELECT id, fecha, cliente, tecnico, observaciones, pdf_path, email_enviado, detalles_usuarios, imagen_path FROM reportes ORDER BY id DESC")
 
 def obtener_reporte_por_id(id_reporte):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT id, fecha, cliente, tecnico, observaciones, pdf_path, email_enviado, detalles_usuarios, imagen_path FROM reportes WHERE id = ?", (id_reporte,))
-    dato = cur.fetchone()
-    con.close()
-    return dato
+    return _consultar_uno("SELECT id, fecha, cliente, tecnico, observaciones, pdf_path, email_enviado, detalles_usuarios, imagen_path FROM reportes WHERE id = ?", (id_reporte,))
+
+# Columnas livianas del listado; detalles_usuarios e imagen_path (JSON grandes) solo a pedido
+COLUMNAS_LISTADO = ["id", "fecha", "cliente", "tecnico", "observaciones", "email_enviado", "sharepoint_url", "latitud", "longitud"]
+COLUMNAS_DETALLE = COLUMNAS_LISTADO + ["pdf_path", "email_tecnico", "detalles_usuarios", "imagen_path"]
+
+def buscar_reportes(cliente=None, tecnico=None, desde=None, hasta=None, email_enviado=None,
+                    antes_de=None, limite=50, completo=False):
+    """
+    Página de reportes del más nuevo al más antiguo, con paginación por id (keyset):
+    `antes_de` es el último id de la página anterior. `desde`/`hasta` comparan contra
+    `fecha` ('YYYY-MM-DD HH:MM:SS'); `hasta` es exclusivo.
+    Retorna (lista de dicts, cursor_siguiente o None).
+    """
+    columnas = COLUMNAS_DETALLE if completo else COLUMNAS_LISTADO
+    condiciones, params = [], []
+    if antes_de is not None:
+        condiciones.append("id < ?"); params.append(antes_de)
+    if cliente:
+        condiciones.append("cliente = ?"); params.append(cliente)
+    if tecnico:
+        condiciones.append("tecnico = ?"); params.append(tecnico)
+    if desde:
+        condiciones.append("fecha >= ?"); params.append(desde)
+    if hasta:
+        condiciones.append("fecha < ?"); params.append(hasta)
+    if email_enviado is not None:
+        condiciones.append("email_enviado = ?"); params.append(1 if email_enviado else 0)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    # Se pide una fila extra solo para saber si hay página siguiente
+    filas = _consultar(
+        f"SELECT {', '.join(columnas)} FROM reportes {where} ORDER BY id DESC LIMIT ?",
+        (*params, limite + 1)
+    )
+    items = [dict(zip(columnas, fila)) for fila in filas[:limite]]
+    siguiente = items[-1]["id"] if len(filas) > limite else None
+    return items, siguiente
+
+def consulta_fts(texto):
+    """
+    Arma una consulta FTS5 segura desde lo que escribe el usuario: cada palabra
+    como prefijo ("antiv" -> antivirus) y el texto entre comillas como frase.
+    Todas deben aparecer. Retorna "" si no quedó ninguna palabra.
+    """
+    partes = []
+    for frase, palabra in re.findall(r'"([^"]*)"|([^\s"]+)', texto or ""):
+        tokens = re.findall(r"\w+", frase or palabra)
+        if not tokens: continue
+        if frase: partes.append('"' + " ".join(tokens) + '"')
+        else: partes.extend(f'"{t}"*' for t in tokens)
+    return " ".join(partes)
+
+def buscar_texto(consulta, cliente=None, tecnico=None, desde=None, hasta=None, limite=20, desplazamiento=0):
+    """
+    Reportes que coinciden con `consulta` (ver consulta_fts), del más al menos relevante
+    (bm25; cliente y técnico pesan más). Cada item trae las columnas del listado más
+    `puntaje` y `fragmento` (texto alrededor de la coincidencia, marcada con [ ]).
+    `desde`/`hasta` como en buscar_reportes. Retorna (total, items).
+    """
+    condiciones, params = ["reportes_fts MATCH ?"], [consulta]
+    if cliente:
+        condiciones.append("r.cliente = ?"); params.append(cliente)
+    if tecnico:
+        condiciones.append("r.tecnico = ?"); params.append(tecnico)
+    if desde:
+        condiciones.append("r.fecha >= ?"); params.append(desde)
+    if hasta:
+        condiciones.append("r.fecha < ?"); params.append(hasta)
+    where = " AND ".join(condiciones)
+    total = _consultar_uno(f"""
+        SELECT COUNT(*) FROM reportes_fts JOIN reportes r ON r.id = reportes_fts.rowid WHERE {where}
+    """, params)[0]
+    filas = _consultar(f"""
+        SELECT {', '.join('r.' + c for c in COLUMNAS_LISTADO)},
+               -bm25(reportes_fts, 3.0, 2.0, 1.0, 1.0, 1.0, 1.5) AS puntaje,
+               snippet(reportes_fts, -1, '[', ']', '…', 12)
+        FROM reportes_fts JOIN reportes r ON r.id = reportes_fts.rowid
+        WHERE {where}
+        ORDER BY puntaje DESC, r.id DESC
+        LIMIT ? OFFSET ?
+    """, (*params, limite, desplazamiento))
+    columnas = COLUMNAS_LISTADO + ["puntaje", "fragmento"]
+    return total, [dict(zip(columnas, fila)) for fila in filas]
+
+def reconstruir_busqueda():
+    """Rehace el índice reportes_fts desde reportes y reporte_usuarios."""
+    with transaccion() as cur:
+        _reconstruir_busqueda(cur)
+    return _consultar_uno("SELECT COUNT(*) FROM reportes_fts")[0]
+
+def obtener_reporte_detalle(id_reporte):
+    fila = _consultar_uno(f"SELECT {', '.join(COLUMNAS_DETALLE)} FROM reportes WHERE id = ?", (id_reporte,))
+    return dict(zip(COLUMNAS_DETALLE, fila)) if fila else None
 
 def obtener_datos_clientes():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT cliente, COUNT(*) FROM reportes GROUP BY cliente ORDER BY COUNT(*) DESC")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _consultar("SELECT cliente, reportes FROM metricas_clientes ORDER BY reportes DESC")
 
 def obtener_datos_tecnicos():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT tecnico, COUNT(*) FROM reportes GROUP BY tecnico ORDER BY COUNT(*) DESC")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    return _consultar("SELECT tecnico, reportes FROM metricas_tecnicos ORDER BY reportes DESC")
 
 def actualizar_estado_email(id_reporte, estado):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("UPDATE reportes SET email_enviado = ? WHERE id = ?", (estado, id_reporte))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("UPDATE reportes SET email_enviado = ? WHERE id = ?", (estado, id_reporte))
+
+def marcar_emails_enviados(ids_reportes):
+    """email_enviado = 1 para varios reportes (resultado de un $batch) en una transacción."""
+    with transaccion() as cur:
+        cur.executemany("UPDATE reportes SET email_enviado = 1 WHERE id = ?", [(i,) for i in ids_reportes])
 
 def guardar_reporte(fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, lat="", lon=""):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("""
-        INSERT INTO reportes (fecha, cliente, tecnico, observaciones, imagen_path, pdf_path, detalles_usuarios, email_enviado, latitud, longitud) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, lat, lon))
-    con.commit()
-    inserted_id = cur.lastrowid 
-    con.close()
+    with transaccion() as cur:
+        cur.execute("""
+            INSERT INTO reportes (fecha, cliente, tecnico, observaciones, imagen_path, pdf_path, detalles_usuarios, email_enviado, latitud, longitud) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, lat, lon))
+        inserted_id = cur.lastrowid 
+        _guardar_detalle(cur, inserted_id, detalles_json, fotos_json)
     return inserted_id 
 
 def actualizar_reporte(id_reporte, fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio):
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("""
-        UPDATE reportes 
-        SET fecha=?, cliente=?, tecnico=?, observaciones=?, imagen_path=?, pdf_path=?, detalles_usuarios=?, email_enviado=?
-        WHERE id=?
-    """, (fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, id_reporte))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE reportes 
+            SET fecha=?, cliente=?, tecnico=?, observaciones=?, imagen_path=?, pdf_path=?, detalles_usuarios=?, email_enviado=?
+            WHERE id=?
+        """, (fecha, cliente, tecnico, obs, fotos_json, pdf_path, detalles_json, estado_envio, id_reporte))
+        if cur.rowcount:
+            _guardar_detalle(cur, id_reporte, detalles_json, fotos_json)
 
 def obtener_reportes_pendientes():
+    # Pendiente = etapa 'email' sin completar. Los reportes antiguos (sin etapas)
+    # siguen dependiendo del flag email_enviado.
+    # Dos ramas para que cada una use su índice (idx_reportes_pendientes / idx_etapas_tipo)
+    return _consultar("""
+        SELECT r.id, r.pdf_path, r.cliente, r.tecnico
+        FROM reportes r
+        WHERE r.email_enviado = 0
+          AND NOT EXISTS (SELECT 1 FROM etapas_reporte e WHERE e.reporte_id = r.id AND e.etapa = 'email')
+        UNION ALL
+        SELECT r.id, r.pdf_path, r.cliente, r.tecnico
+        FROM etapas_reporte e JOIN reportes r ON r.id = e.reporte_id
+        WHERE e.etapa = 'email' AND e.estado != 'ok'
+        ORDER BY 1
+    """)
+
+# --- PIPELINE DE ENTREGA (ETAPAS POR REPORTE) ---
+
+def encolar_reporte(fecha, cliente, tecnico, obs, fotos_json, detalles_json, email_tecnico="", lat="", lon="", archivos=None):
+    """
+    Guarda el reporte y crea sus etapas en estado 'pendiente' en una sola transacción.
+    `archivos`: [(sha256, ruta_relativa, bytes)] del almacén de media que usa el reporte.
+    Retorna el id del reporte, que funciona también como id del trabajo.
+    """
+    with transaccion() as cur:
+        cur.execute("""
+            INSERT INTO reportes (fecha, cliente, tecnico, observaciones, imagen_path, pdf_path, detalles_usuarios, email_enviado, latitud, longitud, email_tecnico) 
+            VALUES (?, ?, ?, ?, ?, '', ?, 0, ?, ?, ?)
+        """, (fecha, cliente, tecnico, obs, fotos_json, detalles_json, lat, lon, email_tecnico or ""))
+        reporte_id = cur.lastrowid
+        _guardar_detalle(cur, reporte_id, detalles_json, fotos_json)
+        if archivos:
+            _asociar_media(cur, reporte_id, archivos, fecha)
+        cur.executemany(
+            "INSERT INTO etapas_reporte (reporte_id, etapa, depende_de, actualizado) VALUES (?, ?, ?, ?)",
+            [(reporte_id, etapa, config.PIPELINE_DEPENDENCIAS.get(etapa), fecha) for etapa in config.PIPELINE_ETAPAS]
+        )
+    return reporte_id
+
+def buscar_idempotencia(clave, vence_antes_de):
+    """(reporte_id, huella) de una Idempotency-Key usada desde `vence_antes_de`, o None (vencida = nueva)."""
+    return _consultar_uno(
+        "SELECT reporte_id, huella FROM idempotencia WHERE clave = ? AND creado >= ?", (clave, vence_antes_de)
+    )
+
+def encolar_reporte_idempotente(clave, huella, vence_antes_de, **datos):
+    """
+    encolar_reporte() asociado a una Idempotency-Key, en la misma transacción.
+    Si la clave ya existe no crea nada: retorna (reporte_id_original, huella_original, True).
+    Si no, retorna (reporte_id_nuevo, huella, False). Aprovecha para borrar
+    claves creadas antes de `vence_antes_de`.
+    """
+    with transaccion() as cur:
+        cur.execute("DELETE FROM idempotencia WHERE creado < ?", (vence_antes_de,))
+        existente = cur.execute("SELECT reporte_id, huella FROM idempotencia WHERE clave = ?", (clave,)).fetchone()
+        if existente:
+            return existente[0], existente[1], True
+        reporte_id = encolar_reporte(**datos)
+        cur.execute(
+            "INSERT INTO idempotencia (clave, reporte_id, huella, creado) VALUES (?, ?, ?, ?)",
+            (clave, reporte_id, huella, datos["fecha"])
+        )
+    return reporte_id, huella, False
+
+def encolar_correos_pendientes(fecha):
+    """
+    Reportes antiguos con email_enviado = 0 y sin etapas (anteriores al pipeline):
+    les crea las etapas 'pdf' y 'email' para que el worker regenere el PDF y
+    los envíe en lotes. Retorna cuántos reportes encoló.
+    """
+    with transaccion() as cur:
+        ids = [row[0] for row in cur.execute("""
+            SELECT id FROM reportes
+            WHERE email_enviado = 0 AND id NOT IN (SELECT reporte_id FROM etapas_reporte)
+        """)]
+        cur.executemany(
+            "INSERT INTO etapas_reporte (reporte_id, etapa, depende_de, actualizado) VALUES (?, ?, ?, ?)",
+            [(i, etapa, config.PIPELINE_DEPENDENCIAS.get(etapa), fecha) for i in ids for etapa in ("pdf", "email")]
+        )
+    return len(ids)
+
+def obtener_reporte_trabajo(id_reporte):
+    """Datos que necesita el worker para ejecutar cualquier etapa de un reporte."""
+    row = _consultar_uno("""
+        SELECT id, fecha, cliente, tecnico, observaciones, imagen_path, pdf_path,
+               detalles_usuarios, email_tecnico, sharepoint_url
+        FROM reportes WHERE id = ?
+    """, (id_reporte,))
+    if not row: return None
+    claves = ["id", "fecha", "cliente", "tecnico", "observaciones", "imagen_path", "pdf_path",
+              "detalles_usuarios", "email_tecnico", "sharepoint_url"]
+    return dict(zip(claves, row))
+
+def actualizar_pdf_reporte(id_reporte, pdf_path):
+    with transaccion() as cur:
+        cur.execute("UPDATE reportes SET pdf_path = ? WHERE id = ?", (pdf_path, id_reporte))
+
+def actualizar_url_sharepoint(id_reporte, web_url):
+    with transaccion() as cur:
+        cur.execute("UPDATE reportes SET sharepoint_url = ? WHERE id = ?", (web_url, id_reporte))
+
+def obtener_etapas_reporte(id_reporte):
+    datos = _consultar("""
+        SELECT etapa, estado, intentos, mensaje, actualizado
+        FROM etapas_reporte WHERE reporte_id = ?
+    """, (id_reporte,))
+    orden = {etapa: i for i, etapa in enumerate(config.PIPELINE_ETAPAS)}
+    return sorted(datos, key=lambda fila: orden.get(fila[0], len(orden)))
+
+def obtener_etapas_listas(ahora, limite=10, etapa=None, excluir=None):
+    """
+    Etapas 'pendiente' cuyo reintento ya venció y cuya etapa previa (depende_de)
+    terminó en 'ok'. Retorna [(reporte_id, etapa), ...] de la más antigua a la más nueva.
+    `etapa` limita a un tipo de etapa; `excluir` deja fuera uno.
+    """
+    filtro, params = "", [ahora]
+    if etapa:
+        filtro += " AND e.etapa = ?"; params.append(etapa)
+    if excluir:
+        filtro += " AND e.etapa != ?"; params.append(excluir)
+    return _consultar(f"""
+        SELECT e.reporte_id, e.etapa
+        FROM etapas_reporte e
+        LEFT JOIN etapas_reporte previa ON previa.reporte_id = e.reporte_id AND previa.etapa = e.depende_de
+        WHERE e.estado = 'pendiente' AND e.proximo_intento <= ?{filtro}
+          AND (e.depende_de IS NULL OR previa.estado = 'ok')
+        ORDER BY e.reporte_id ASC
+        LIMIT ?
+    """, (*params, limite))
+
+def tomar_etapa(id_reporte, etapa, fecha):
+    """Marca la etapa 'en_proceso' solo si sigue pendiente. True si este worker la tomó."""
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE etapas_reporte SET estado = 'en_proceso', actualizado = ?
+            WHERE reporte_id = ? AND etapa = ? AND estado = 'pendiente'
+        """, (fecha, id_reporte, etapa))
+        return cur.rowcount == 1
+
+def finalizar_etapa(id_reporte, etapa, estado, mensaje, fecha, proximo_intento=0):
+    """Registra el resultado de un intento. `estado`: 'ok', 'pendiente' (reintento) o 'error'."""
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE etapas_reporte
+            SET estado = ?, intentos = intentos + 1, mensaje = ?, actualizado = ?, proximo_intento = ?
+            WHERE reporte_id = ? AND etapa = ?
+        """, (estado, mensaje, fecha, proximo_intento, id_reporte, etapa))
+
+def obtener_intentos_etapa(id_reporte, etapa):
+    res = _consultar_uno("SELECT intentos FROM etapas_reporte WHERE reporte_id = ? AND etapa = ?", (id_reporte, etapa))
+    return res[0] if res else 0
+
+def contar_etapas_pendientes(etapa):
+    """Etapas aún no terminadas ('pendiente' o 'en_proceso') de un tipo."""
+    return _consultar_uno("SELECT COUNT(*) FROM etapas_reporte WHERE etapa = ? AND estado IN ('pendiente', 'en_proceso')", (etapa,))[0]
+
+def reabrir_etapa(id_reporte, etapa, mensaje, fecha):
+    """Vuelve a dejar pendiente una etapa ya terminada (p. ej. 'pdf' si el archivo se perdió)."""
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE etapas_reporte SET estado = 'pendiente', intentos = 0, proximo_intento = 0, mensaje = ?, actualizado = ?
+            WHERE reporte_id = ? AND etapa = ? AND estado != 'en_proceso'
+        """, (mensaje, fecha, id_reporte, etapa))
+        return cur.rowcount > 0
+
+def reencolar_fallidas(fecha, id_reporte=None, etapa=None):
+    """
+    Etapas en 'error' (agotaron sus intentos) vuelven a 'pendiente' con los
+    intentos en cero. Sin filtros reencola todas. Retorna cuántas reencoló.
+    """
+    condiciones, params = ["estado = 'error'"], [fecha]
+    if id_reporte is not None:
+        condiciones.append("reporte_id = ?"); params.append(id_reporte)
+    if etapa:
+        condiciones.append("etapa = ?"); params.append(etapa)
+    with transaccion() as cur:
+        cur.execute(f"""
+            UPDATE etapas_reporte
+            SET estado = 'pendiente', intentos = 0, proximo_intento = 0, mensaje = 'Reencolada manualmente', actualizado = ?
+            WHERE {' AND '.join(condiciones)}
+        """, params)
+        return cur.rowcount
+
+def obtener_etapas_fallidas(limite=100):
+    """Etapas en 'error' (dead letter), de la más reciente a la más antigua."""
+    return _consultar("""
+        SELECT e.reporte_id, r.cliente, r.fecha, e.etapa, e.intentos, e.mensaje, e.actualizado
+        FROM etapas_reporte e LEFT JOIN reportes r ON r.id = e.reporte_id
+        WHERE e.estado = 'error'
+        ORDER BY e.actualizado DESC
+        LIMIT ?
+    """, (limite,))
+
+def obtener_resumen_etapas():
+    """[(etapa, estado, cantidad)] de toda la cola."""
+    return _consultar("SELECT etapa, estado, COUNT(*) FROM etapas_reporte GROUP BY etapa, estado")
+
+def liberar_etapas_en_proceso():
+    """Al arrancar el worker: lo que quedó 'en_proceso' (caída del proceso) vuelve a la cola."""
+    with transaccion() as cur:
+        cur.execute("UPDATE etapas_reporte SET estado = 'pendiente' WHERE estado = 'en_proceso'")
+        return cur.rowcount
+
+# --- RESPALDOS INCREMENTALES (ver backup.py) ---
+
+def _condicion_clave(columnas):
+    return " AND ".join(f"{c} = ?" for c in columnas)
+
+def secuencia_respaldo(ruta=None):
+    """Último `seq` del registro de respaldo, de la base actual o de la copia en `ruta`."""
+    sql = "SELECT seq FROM sqlite_sequence WHERE name = 'cambios_respaldo'"
+    if ruta is None:
+        fila = _consultar_uno(sql)
+    else:
+        con = sqlite3.connect(ruta)
+        try: fila = con.execute(sql).fetchone()
+        finally: con.close()
+    return fila[0] if fila else 0
+
+def obtener_ultimo_respaldo(tipo=None):
+    """(fecha, hasta, archivo) del último respaldo subido (de ese tipo) o None."""
+    if tipo:
+        return _consultar_uno("SELECT fecha, hasta, archivo FROM respaldos WHERE tipo = ? ORDER BY id DESC LIMIT 1", (tipo,))
+    return _consultar_uno("SELECT fecha, hasta, archivo FROM respaldos ORDER BY id DESC LIMIT 1")
+
+def registrar_respaldo(tipo, archivo, hasta, tamano, fecha):
+    """Anota un respaldo ya subido y descarta del registro lo que quedó cubierto por él."""
+    with transaccion() as cur:
+        cur.execute("INSERT INTO respaldos (tipo, archivo, hasta, bytes, fecha) VALUES (?, ?, ?, ?, ?)",
+                    (tipo, archivo, hasta, tamano, fecha))
+        cur.execute("DELETE FROM cambios_respaldo WHERE seq <= ?", (hasta,))
+
+def exportar_cambios_respaldo(escribir):
+    """
+    Pasa a `escribir(dict)` lo modificado desde el último respaldo: una cabecera
+    {"desde", "hasta", "version"} y luego una entrada {"t", "k", "c", "f"} por clave
+    (tabla, valores de la clave, columnas y filas actuales; sin filas = se borró).
+    Lee todo en una misma instantánea. Retorna (desde, hasta, entradas).
+    """
+    con = sqlite3.connect(DB_NAME, timeout=config.DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    try:
+        con.execute("BEGIN")
+        desde = con.execute("SELECT COALESCE(MAX(hasta), 0) FROM respaldos").fetchone()[0]
+        hasta = max(desde, con.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios_respaldo").fetchone()[0])
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        escribir({"desde": desde, "hasta": hasta, "version": version})
+        claves = con.execute("""
+            SELECT tabla, clave FROM cambios_respaldo WHERE seq > ? AND seq <= ? ORDER BY tabla, seq
+        """, (desde, hasta)).fetchall()
+        for tabla, clave in claves:
+            valores = json.loads(clave)
+            cur = con.execute(f"SELECT * FROM {tabla} WHERE {_condicion_clave(TABLAS_RESPALDO[tabla])}", valores)
+            escribir({"t": tabla, "k": valores, "c": [d[0] for d in cur.description], "f": [list(f) for f in cur]})
+        con.execute("COMMIT")
+        return desde, hasta, len(claves)
+    finally:
+        con.close()
+
+def aplicar_cambios_respaldo(entradas):
+    """
+    Restauración: aplica sobre la base actual las entradas de exportar_cambios_respaldo
+    (por clave, borra sus filas e inserta las del respaldo). Triggers y claves foráneas
+    se suspenden mientras tanto, porque las filas ya traen sus efectos (refs, registro
+    de cambios); al final se recalculan las métricas y el índice de búsqueda.
+    Todo en una transacción.
+    Retorna cuántas claves aplicó.
+    """
     con = conectar()
-    cur = con.cursor()
-    cur.execute("SELECT id, pdf_path, cliente, tecnico FROM reportes WHERE email_enviado = 0")
-    datos = cur.fetchall()
-    con.close()
-    return datos
+    con.execute("PRAGMA foreign_keys=OFF")
+    try:
+        with transaccion() as cur:
+            triggers = cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+            for nombre, _ in triggers:
+                cur.execute(f"DROP TRIGGER {nombre}")
+            aplicadas = 0
+            for e in entradas:
+                tabla, columnas = e["t"], e["c"]
+                if tabla not in TABLAS_RESPALDO or not all(c.isidentifier() for c in columnas):
+                    raise ValueError(f"Entrada de respaldo inválida: {tabla}")
+                cur.execute(f"DELETE FROM {tabla} WHERE {_condicion_clave(TABLAS_RESPALDO[tabla])}", e["k"])
+                if e["f"]:
+                    cur.executemany(
+                        f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join('?' * len(columnas))})", e["f"]
+                    )
+                aplicadas += 1
+            for _, sql in triggers:
+                cur.execute(sql)
+            _reconstruir_metricas(cur)
+            _reconstruir_busqueda(cur)
+            # La base restaurada empieza su propia cadena: el próximo respaldo es completo
+            cur.execute("DELETE FROM respaldos")
+            cur.execute("DELETE FROM cambios_respaldo")
+        return aplicadas
+    finally:
+        con.execute("PRAGMA foreign_keys=ON")
+
+# --- ALMACÉN DE MEDIA (ver media.py) ---
+
+def _asociar_media(cur, reporte_id, archivos, fecha):
+    cur.executemany(
+        "INSERT INTO media (sha256, ruta, bytes, creado) VALUES (?, ?, ?, ?) ON CONFLICT(sha256) DO NOTHING",
+        [(sha, ruta, tamano, fecha) for sha, ruta, tamano in archivos]
+    )
+    cur.executemany(
+        "INSERT INTO reporte_media (reporte_id, sha256) VALUES (?, ?) ON CONFLICT DO NOTHING",
+        [(reporte_id, sha) for sha, _, _ in archivos]
+    )
+
+def obtener_media(sha):
+    """(ruta_relativa, bytes, refs) o None."""
+    return _consultar_uno("SELECT ruta, bytes, refs FROM media WHERE sha256 = ?", (sha,))
+
+def obtener_media_sin_referencias():
+    return _consultar("SELECT sha256, ruta FROM media WHERE refs = 0")
+
+def obtener_shas_media():
+    return {row[0] for row in _consultar("SELECT sha256 FROM media")}
+
+def eliminar_media(sha):
+    """Borra la fila solo si sigue sin referencias. Retorna True si la borró."""
+    with transaccion() as cur:
+        cur.execute("DELETE FROM media WHERE sha256 = ? AND refs = 0", (sha,))
+        return cur.rowcount > 0
+
+# --- CONSULTAS SOBRE EL DETALLE NORMALIZADO ---
+
+def _filtros_visita(cliente=None, desde=None, hasta=None):
+    condiciones, params = [], []
+    if cliente:
+        condiciones.append("r.cliente = ?"); params.append(cliente)
+    if desde:
+        condiciones.append("r.fecha >= ?"); params.append(desde)
+    if hasta:
+        condiciones.append("r.fecha < ?"); params.append(hasta)
+    return condiciones, params
+
+def obtener_atenciones_usuarios(cliente=None, usuario=None, desde=None, hasta=None):
+    """Por (cliente, usuario): veces atendido, no atendido y última visita."""
+    condiciones, params = _filtros_visita(cliente, desde, hasta)
+    if usuario:
+        condiciones.append("ru.nombre = ?"); params.append(usuario)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    return _consultar(f"""
+        SELECT r.cliente, ru.nombre, SUM(ru.atendido), SUM(1 - ru.atendido), MAX(r.fecha)
+        FROM reporte_usuarios ru JOIN reportes r ON r.id = ru.reporte_id
+        {where}
+        GROUP BY r.cliente, ru.nombre
+        ORDER BY r.cliente, ru.nombre
+    """, params)
+
+def obtener_conteo_tareas(cliente=None, desde=None, hasta=None):
+    """Por tarea: cuántas veces se realizó y en cuántas visitas distintas."""
+    condiciones, params = _filtros_visita(cliente, desde, hasta)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    return _consultar(f"""
+        SELECT rt.tarea, COUNT(*), COUNT(DISTINCT rt.reporte_id)
+        FROM reporte_tareas rt JOIN reportes r ON r.id = rt.reporte_id
+        {where}
+        GROUP BY rt.tarea
+        ORDER BY COUNT(*) DESC
+    """, params)
+
+def obtener_fotos_reporte(id_reporte):
+    return _consultar("""
+        SELECT ru.nombre, rf.posicion, rf.ruta
+        FROM reporte_fotos rf LEFT JOIN reporte_usuarios ru ON ru.id = rf.usuario_id
+        WHERE rf.reporte_id = ?
+        ORDER BY ru.posicion IS NULL, ru.posicion, rf.posicion
+    """, (id_reporte,))
 
 # --- NUEVAS FUNCIONES PARA MÉTRICAS ---
+# Leen las tablas metricas_* (ver _m005_metricas), no recorren `reportes`
 
 def obtener_kpis_generales():
-    con = conectar()
-    cur = con.cursor()
-    
-    cur.execute("SELECT COUNT(*) FROM reportes")
-    total = cur.fetchone()[0]
+    total, pendientes = _consultar_uno("SELECT reportes, pendientes FROM metricas_totales WHERE id = 1") or (0, 0)
     
-    cur.execute("SELECT COUNT(*) FROM reportes WHERE email_enviado = 0")
-    pendientes = cur.fetchone()[0]
-    
-    cur.execute("SELECT cliente, COUNT(*) as c FROM reportes GROUP BY cliente ORDER BY c DESC LIMIT 1")
-    top_cli = cur.fetchone()
+    top_cli = _consultar_uno("SELECT cliente, reportes FROM metricas_clientes ORDER BY reportes DESC LIMIT 1")
     cliente_top = f"{top_cli[0]} ({top_cli[1]})" if top_cli else "N/A"
     
-    con.close()
     return total, pendientes, cliente_top
 
-def obtener_evolucion_mensual():
-    con = conectar()
-    cur = con.cursor()
-    cur.execute("""
-        SELECT substr(fecha, 1, 7) as mes, COUNT(*) 
-        FROM reportes 
-        GROUP BY mes 
-        ORDER BY mes DESC 
-        LIMIT 6
-    """)
-    datos = cur.fetchall() 
-    con.close()
-    return datos[::-1]
\ No newline at end of file
+def obtener_evolucion_mensual(meses=6):
+    datos = _consultar("SELECT mes, reportes FROM metricas_meses ORDER BY mes DESC LIMIT ?", (meses,))
+    return datos[::-1]
+
+def obtener_pendientes_por_cliente():
+    return _consultar("SELECT cliente, pendientes FROM metricas_clientes WHERE pendientes > 0 ORDER BY pendientes DESC")
+
+def reconstruir_metricas():
+    """Recalcula las tablas metricas_* desde `reportes` (respaldo restaurado, datos cargados a mano, etc.)."""
+    with transaccion() as cur:
+        _reconstruir_metricas(cur)
+    return obtener_kpis_generales()
\ No newline at end of file
@@ -0,0 +1,228 @@
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import config
+
+# ==========================================
+# CLIENTE COMPARTIDO DE MICROSOFT GRAPH
+# ==========================================
+# Una sola requests.Session por proceso (conexiones keep-alive reutilizadas),
+# token cacheado, timeouts por llamada y reintentos con espera exponencial
+# que respetan el Retry-After de Graph en 429/503. Como máximo
+# GRAPH_CONCURRENCIA peticiones en vuelo; las esperas entre reintentos no
+# ocupan cupo.
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+
+# Códigos que Graph documenta como transitorios
+_ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+# En POST (no idempotente) solo se reintenta si Graph rechazó explícitamente la petición
+_ESTADOS_RECHAZO = {429, 503}
+_METODOS_IDEMPOTENTES = {"GET", "PUT", "DELETE", "HEAD"}
+
+_sesion = None
+_sesion_lock = threading.Lock()
+_limite = threading.BoundedSemaphore(config.GRAPH_CONCURRENCIA)
+
+def obtener_sesion():
+    global _sesion
+    if _sesion is None:
+        with _sesion_lock:
+            if _sesion is None:
+                s = requests.Session()
+                adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=config.GRAPH_POOL_TAMANO, max_retries=0)
+                s.mount("https://", adaptador)
+                _sesion = s
+    return _sesion
+
+# --- TOKEN (client_credentials, cacheado por proceso) ---
+_token_lock = threading.Lock()
+_token_cache = {"token": None, "expira": 0.0}
+
+def _solicitar_token():
+    """POST client_credentials. Retorna (token, segundos_de_vida) o (None, 0)."""
+    url = f"https://login.microsoftonline.com/{config.GRAPH_TENANT_ID}/oauth2/v2.0/token"
+    data = {
+        'grant_type': 'client_credentials',
+        'client_id': config.GRAPH_CLIENT_ID,
+        'client_secret': config.GRAPH_CLIENT_SECRET,
+        'scope': 'https://graph.microsoft.com/.default'
+    }
+    try:
+        r = obtener_sesion().post(url, data=data, timeout=config.GRAPH_TIMEOUT)
+        js = r.json()
+        if 'access_token' in js:
+            return js['access_token'], float(js.get('expires_in', 3599))
+        print(f"Error Token: {js}")
+        return None, 0
+    except Exception as e:
+        print(f"Excepción Token: {e}")
+        return None, 0
+
+def _token_vigente():
+    if _token_cache["token"] and time.time() < _token_cache["expira"] - config.GRAPH_TOKEN_MARGEN:
+        return _token_cache["token"]
+    return None
+
+def obtener_token():
+    token = _token_vigente()
+    if token: return token
+    # Solo un hilo renueva; el resto espera y reutiliza el token nuevo
+    with _token_lock:
+        token = _token_vigente()
+        if token: return token
+        token, expires_in = _solicitar_token()
+        if token:
+            _token_cache["token"] = token
+            _token_cache["expira"] = time.time() + expires_in
+        return token
+
+def invalidar_token(token=None):
+    """Descarta el token cacheado (p. ej. tras un 401). Si se indica `token`, solo si sigue siendo ese."""
+    with _token_lock:
+        if token is None or _token_cache["token"] == token:
+            _token_cache["token"] = None
+            _token_cache["expira"] = 0.0
+
+# --- PETICIONES CON REINTENTO ---
+
+def _espera(intento, respuesta=None):
+    """Segundos a esperar antes del siguiente intento (Retry-After si Graph lo envía)."""
+    if respuesta is not None:
+        retry_after = respuesta.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), config.GRAPH_ESPERA_MAXIMA)
+            except ValueError:
+                pass
+    espera = config.GRAPH_ESPERA_BASE * (2 ** intento)
+    return min(espera + random.uniform(0, espera / 2), config.GRAPH_ESPERA_MAXIMA)
+
+def solicitar(metodo, url, headers=None, timeout=None, autenticar=True, **kwargs):
+    """
+    Hace una petición a Graph por la sesión compartida y retorna la Response final.
+    - Agrega el Bearer token (salvo autenticar=False, p. ej. URLs de upload session).
+    - 401: invalida el token y reintenta una vez con uno nuevo.
+    - 429/5xx y errores de conexión: reintenta hasta GRAPH_MAX_REINTENTOS.
+    `url` puede ser relativa a GRAPH_URL ("/sites/...").
+    Lanza la última excepción de red si ningún intento obtuvo respuesta.
+    """
+    metodo = metodo.upper()
+    if url.startswith("/"): url = GRAPH_URL + url
+    idempotente = metodo in _METODOS_IDEMPOTENTES
+    # Si el cuerpo es un archivo, se rebobina antes de cada reintento
+    cuerpo = kwargs.get("data")
+    pos_cuerpo = cuerpo.tell() if hasattr(cuerpo, "seek") else None
+
+    ya_renovado = False
+    intento = 0
+    while True:
+        h = dict(headers or {})
+        token = None
+        if autenticar:
+            token = obtener_token()
+            if not token:
+                raise RuntimeError("No se pudo autenticar con Graph")
+            h['Authorization'] = f'Bearer {token}'
+        if pos_cuerpo is not None:
+            cuerpo.seek(pos_cuerpo)
+
+        try:
+            with _limite:
+                r = obtener_sesion().request(metodo, url, headers=h, timeout=timeout or config.GRAPH_TIMEOUT, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # Un timeout de lectura en POST pudo haberse ejecutado: no se repite
+            seguro = idempotente or isinstance(e, requests.ConnectTimeout)
+            if not seguro or intento >= config.GRAPH_MAX_REINTENTOS:
+                raise
+            espera = _espera(intento)
+            print(f"⚠️ Graph {metodo} sin respuesta ({e.__class__.__name__}). Reintento en {espera:.1f}s")
+            time.sleep(espera)
+            intento += 1
+            continue
+
+        if r.status_code == 401 and autenticar and not ya_renovado:
+            invalidar_token(token)
+            ya_renovado = True
+            continue
+
+        reintentable = _ESTADOS_REINTENTABLES if idempotente else _ESTADOS_RECHAZO
+        if r.status_code in reintentable and intento < config.GRAPH_MAX_REINTENTOS:
+            espera = _espera(intento, r)
+            print(f"⚠️ Graph {metodo} respondió {r.status_code}. Reintento en {espera:.1f}s")
+            time.sleep(espera)
+            intento += 1
+            continue
+
+        return r
+
+# --- SUBIDA POR BLOQUES (upload sessions de OneDrive/SharePoint y Outlook) ---
+
+def _siguiente_byte(js, por_defecto):
+    rangos = js.get('nextExpectedRanges') or []
+    if not rangos: return por_defecto
+    return int(rangos[0].split('-')[0])
+
+def _progreso_log(enviados, total):
+    print(f"   📤 {enviados}/{total} bytes ({enviados * 100 // max(total, 1)}%)")
+
+def _json_o_vacio(r):
+    try: return r.json()
+    except ValueError: return {}
+
+def subir_por_bloques(upload_url, ruta_local, progreso=None):
+    """
+    Sube `ruta_local` a una upload session ya creada, en bloques de
+    SHAREPOINT_TAMANO_BLOQUE leídos del disco. Si un bloque falla, consulta a la
+    sesión qué byte espera y reanuda desde ahí (hasta SHAREPOINT_MAX_REANUDACIONES
+    veces). Retorna la Response final de Graph.
+    """
+    progreso = progreso or _progreso_log
+    total = os.path.getsize(ruta_local)
+    inicio = 0
+    reanudaciones = 0
+    with open(ruta_local, 'rb') as f:
+        while True:
+            f.seek(inicio)
+            bloque = f.read(config.SHAREPOINT_TAMANO_BLOQUE)
+            fin = inicio + len(bloque) - 1
+            r, error = None, None
+            try:
+                # La uploadUrl ya viene firmada: no lleva Bearer token
+                r = solicitar(
+                    "PUT", upload_url, autenticar=False, data=bloque,
+                    headers={
+                        'Content-Type': 'application/octet-stream',
+                        'Content-Length': str(len(bloque)),
+                        'Content-Range': f'bytes {inicio}-{fin}/{total}'
+                    },
+                    timeout=config.GRAPH_TIMEOUT_SUBIDA
+                )
+            except Exception as e:
+                error = e
+
+            if r is not None and r.status_code in [200, 201, 202]:
+                # OneDrive responde 202 a los bloques intermedios; Outlook, 200
+                if fin + 1 >= total:
+                    progreso(total, total)
+                    return r
+                inicio = _siguiente_byte(_json_o_vacio(r), fin + 1)
+                progreso(inicio, total)
+                continue
+
+            # Bloque fallido: se pregunta a la sesión desde dónde seguir
+            if reanudaciones >= config.SHAREPOINT_MAX_REANUDACIONES:
+                try: solicitar("DELETE", upload_url, autenticar=False)
+                except Exception: pass
+                if error: raise error
+                return r
+            reanudaciones += 1
+            r_estado = solicitar("GET", upload_url, autenticar=False)
+            if r_estado.status_code != 200:
+                # La sesión expiró o fue cancelada
+                return r_estado
+            inicio = _siguiente_byte(r_estado.json(), inicio)
+            print(f"   🔁 Reanudando subida desde byte {inicio} (intento {reanudaciones})")
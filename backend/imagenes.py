@@ -0,0 +1,96 @@
+import os
+import hashlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageOps
+import config
+
+# ==========================================
+# PREPARACIÓN DE FOTOS PARA EL PDF
+# ==========================================
+# Las fotos de la tablet llegan a 12 MP pero en el PDF se dibujan en celdas de
+# 45x35 mm. Antes de embeberlas se corrige la orientación EXIF, se reducen a
+# la resolución que la celda realmente necesita y se recomprimen en JPEG.
+
+MM_POR_PULGADA = 25.4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _pixeles(mm, dpi):
+    return max(1, round(mm / MM_POR_PULGADA * dpi))
+
+def _ruta_salida(ruta, destino_dir, ancho_mm, alto_mm, dpi, calidad):
+    # El nombre depende del archivo y de los parámetros: reusar si ya se preparó igual
+    clave = f"{os.path.abspath(ruta)}|{ancho_mm}|{alto_mm}|{dpi}|{calidad}"
+    nombre = hashlib.sha1(clave.encode("utf-8")).hexdigest()[:20] + ".jpg"
+    return os.path.join(destino_dir or os.path.dirname(os.path.abspath(ruta)), nombre)
+
+def preparar_foto(ruta, destino_dir=None, ancho_mm=45, alto_mm=35, dpi=None, calidad=None):
+    """
+    Retorna la ruta de una copia JPEG lista para una celda de `ancho_mm` x `alto_mm`.
+    Nunca agranda: si la foto ya es pequeña solo se corrige orientación y se recomprime.
+    Si algo falla retorna la ruta original, para que el PDF se genere igual.
+    """
+    dpi = dpi or config.IMAGENES_DPI
+    calidad = calidad or config.IMAGENES_CALIDAD
+    salida = _ruta_salida(ruta, destino_dir, ancho_mm, alto_mm, dpi, calidad)
+    if os.path.exists(salida): return salida
+
+    objetivo = (_pixeles(ancho_mm, dpi), _pixeles(alto_mm, dpi))
+    try:
+        with Image.open(ruta) as img:
+            # JPEG: decodifica directo a 1/2, 1/4 u 1/8 si alcanza para el objetivo
+            img.draft("RGB", objetivo)
+            img = ImageOps.exif_transpose(img)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            # El PDF estira la imagen a la celda: se escala para cubrirla en ambos ejes
+            escala = max(objetivo[0] / img.width, objetivo[1] / img.height)
+            if escala < 1:
+                nuevo = (max(1, round(img.width * escala)), max(1, round(img.height * escala)))
+                img = img.resize(nuevo, Image.LANCZOS)
+            img.save(salida, "JPEG", quality=calidad, optimize=True)
+        return salida
+    except Exception as e:
+        print(f"⚠️ No se pudo preparar {ruta}: {e}")
+        return ruta
+
+def _preparar_args(args):
+    return preparar_foto(*args)
+
+def _obtener_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # 'spawn' como en render: con RENDER_PROCESOS=0 esto corre dentro del proceso
+            # de la API, que tiene hilos vivos, y fork podría heredar locks tomados
+            _pool = ProcessPoolExecutor(max_workers=config.IMAGENES_PROCESOS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def detener():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool: pool.shutdown(wait=False, cancel_futures=True)
+
+def preparar_fotos(rutas, destino_dir=None, ancho_mm=45, alto_mm=35, en_paralelo=True):
+    """
+    Prepara varias fotos (en un pool de procesos si son más de IMAGENES_MIN_PARALELO).
+    Retorna {ruta_original: ruta_preparada}.
+    """
+    unicas = [r for r in dict.fromkeys(rutas) if r and os.path.exists(r)]
+    args = [(r, destino_dir, ancho_mm, alto_mm) for r in unicas]
+    if en_paralelo and config.IMAGENES_PROCESOS > 1 and len(args) >= config.IMAGENES_MIN_PARALELO:
+        try:
+            preparadas = list(_obtener_pool().map(_preparar_args, args))
+        except BrokenProcessPool:
+            # Un proceso murió: se descarta el pool y esta vez se preparan en serie
+            detener()
+            preparadas = [_preparar_args(a) for a in args]
+    else:
+        preparadas = [_preparar_args(a) for a in args]
+    return dict(zip(unicas, preparadas))
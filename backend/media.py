@@ -0,0 +1,144 @@
+import os
+import time
+import threading
+from PIL import Image, ImageOps
+import config
+import database
+
+# ==========================================
+# ALMACÉN DE FOTOS Y FIRMAS (POR CONTENIDO)
+# ==========================================
+# Cada archivo se guarda una sola vez, con el SHA-256 de su contenido como
+# nombre y repartido en subcarpetas (objetos/ab/cd/abcd...jpg) para no tener
+# miles de archivos en un mismo directorio. La tabla `media` lleva cuántos
+# reportes usan cada archivo (refs, vía triggers sobre reporte_media);
+# recolectar_basura() borra los que quedaron sin reportes.
+
+# ubicar() y el recolector no se intercalan: un archivo que se reutiliza (utime)
+# no puede borrarse entre la comprobación de su mtime y el borrado
+_lock_almacen = threading.Lock()
+
+def _dir(*partes):
+    return os.path.join(config.MEDIA_DIR, *partes)
+
+def ruta_relativa(sha, ext):
+    return os.path.join("objetos", sha[:2], sha[2:4], sha + ext)
+
+def ruta_absoluta(relativa):
+    return os.path.abspath(_dir(relativa))
+
+def dir_parciales():
+    """Carpeta para las subidas en curso: mismo disco que objetos/ para que os.replace sea atómico."""
+    ruta = _dir("tmp")
+    os.makedirs(ruta, exist_ok=True)
+    return ruta
+
+def ubicar(ruta_parcial, sha, ext):
+    """Mueve una subida ya completa a su lugar definitivo. Retorna la ruta absoluta."""
+    final = ruta_absoluta(ruta_relativa(sha, ext))
+    with _lock_almacen:
+        if os.path.exists(final):
+            # Mismo contenido ya recibido antes: se reutiliza y se renueva su mtime
+            # para que el recolector no lo borre mientras se registra el reporte
+            os.remove(ruta_parcial)
+            os.utime(final)
+        else:
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            os.replace(ruta_parcial, final)
+    return final
+
+# --- MINIATURAS ---
+
+def _ruta_miniatura(sha):
+    return _dir("miniaturas", sha[:2], sha[2:4], f"{sha}_{config.MEDIA_MINIATURA_PX}.jpg")
+
+def obtener_miniatura(sha):
+    """Ruta de la miniatura JPEG del archivo (se genera la primera vez). None si no existe."""
+    fila = database.obtener_media(sha)
+    if not fila: return None
+    destino = _ruta_miniatura(sha)
+    if os.path.exists(destino): return destino
+    try:
+        with Image.open(ruta_absoluta(fila[0])) as img:
+            img.draft("RGB", (config.MEDIA_MINIATURA_PX, config.MEDIA_MINIATURA_PX))
+            img = ImageOps.exif_transpose(img)
+            if img.mode != "RGB": img = img.convert("RGB")
+            img.thumbnail((config.MEDIA_MINIATURA_PX, config.MEDIA_MINIATURA_PX))
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            parcial = f"{destino}.{threading.get_ident()}.tmp"
+            img.save(parcial, "JPEG", quality=80)
+            os.replace(parcial, destino)
+        return destino
+    except Exception as e:
+        print(f"⚠️ No se pudo generar miniatura de {sha}: {e}")
+        return None
+
+# --- RECOLECCIÓN DE BASURA ---
+
+def _antiguo(ruta, limite):
+    try: return os.path.getmtime(ruta) < limite
+    except OSError: return False
+
+def _borrar(ruta):
+    try:
+        if os.path.exists(ruta): os.remove(ruta)
+        return True
+    except OSError as e:
+        print(f"   ⚠️ Error borrando {ruta}: {e}")
+        return False
+
+def recolectar_basura(gracia=None):
+    """
+    Borra los archivos que ningún reporte usa hace más de `gracia` segundos:
+    filas de `media` con refs = 0, archivos sin fila (subidas cuyo reporte
+    nunca se registró) y subidas parciales abandonadas. Retorna cuántos borró.
+    """
+    limite = time.time() - (config.MEDIA_GC_GRACIA if gracia is None else gracia)
+    borrados = 0
+
+    for sha, relativa in database.obtener_media_sin_referencias():
+        ruta = ruta_absoluta(relativa)
+        # mtime, fila y archivo se revisan y borran bajo el mismo lock que ubicar();
+        # eliminar_media vuelve a comprobar refs = 0 y el archivo se borra tras su COMMIT
+        with _lock_almacen:
+            if os.path.exists(ruta) and not _antiguo(ruta, limite): continue
+            if not database.eliminar_media(sha): continue
+            _borrar(ruta)
+        _borrar(_ruta_miniatura(sha))
+        borrados += 1
+
+    registrados = database.obtener_shas_media()
+    for raiz, _, archivos in os.walk(_dir("objetos")):
+        for nombre in archivos:
+            sha = os.path.splitext(nombre)[0]
+            ruta = os.path.join(raiz, nombre)
+            if sha in registrados: continue
+            with _lock_almacen:
+                if not _antiguo(ruta, limite) or not _borrar(ruta): continue
+            _borrar(_ruta_miniatura(sha))
+            borrados += 1
+
+    for nombre in os.listdir(dir_parciales()):
+        ruta = os.path.join(dir_parciales(), nombre)
+        if _antiguo(ruta, limite) and _borrar(ruta):
+            borrados += 1
+
+    if borrados:
+        print(f"🧹 Almacén de fotos: {borrados} archivos sin uso eliminados")
+    return borrados
+
+def _bucle_gc(detener):
+    while not detener.wait(config.MEDIA_GC_INTERVALO):
+        try:
+            recolectar_basura()
+        except Exception as e:
+            print(f"⚠️ Error en recolección de fotos: {e}")
+
+_detener_gc = threading.Event()
+
+def iniciar_gc():
+    _detener_gc.clear()
+    threading.Thread(target=_bucle_gc, args=(_detener_gc,), name="media-gc", daemon=True).start()
+
+def detener_gc():
+    _detener_gc.set()
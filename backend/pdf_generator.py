@@ -1,9 +1,36 @@
+import datetime
 import os
 import tempfile
+import threading
 from fpdf import FPDF
 from fpdf.enums import XPos, YPos
+from fpdf.errors import FPDFException
 import config
 import utils
+import imagenes
+
+# --- RECURSOS ESTÁTICOS DEL ENCABEZADO (se resuelven una vez por proceso) ---
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RUTAS_LOGO = [
+    os.path.join(_BASE_DIR, "assets", "logo.png"),
+    os.path.join(_BASE_DIR, "assets", "logo2.png"),
+]
+_logo_cache = {}
+_logo_lock = threading.Lock()
+
+def _logo():
+    """
+    Ruta del primer logo que exista, o None. Se busca una vez por proceso y no
+    en cada página; dentro de un documento fpdf2 ya reutiliza la imagen cargada.
+    """
+    with _logo_lock:
+        if "ruta" not in _logo_cache:
+            _logo_cache["ruta"] = next((r for r in RUTAS_LOGO if os.path.exists(r)), None)
+        return _logo_cache["ruta"]
+
+def reiniciar_cache_logo():
+    with _logo_lock:
+        _logo_cache.clear()
 
 class PDFReporte(FPDF):
     def header(self):
@@ -13,19 +40,13 @@ class PDFReporte(FPDF):
         self.set_fill_color(0, 86, 163) # Azul Oscuro (borde inferior)
         self.rect(0, 40, 210, 2, 'F')
         
-        # 2. Logo (Misma lógica de rutas)
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        logo_path = os.path.join(base_dir, "assets", "logo.png")
-        logo2_path = os.path.join(base_dir, "assets", "logo2.png")
-        
-        logo_final = None
-        if os.path.exists(logo_path): logo_final = logo_path
-        elif os.path.exists(logo2_path): logo_final = logo2_path
-            
+        # 2. Logo (ruta resuelta una vez por proceso, ver _logo)
+        logo_final = _logo()
         if logo_final:
-            try: 
-                self.image(logo_final, x=10, y=8, h=24) 
-            except: pass
+            try:
+                self.image(logo_final, x=10, y=8, h=24)
+            except (OSError, ValueError, FPDFException) as e:
+                print(f"⚠️ No se pudo dibujar el logo {logo_final}: {e}")
             
         # 3. Título y Subtítulo
         self.set_font('Helvetica', 'B', 20)
@@ -44,7 +65,36 @@ class PDFReporte(FPDF):
         self.set_text_color(150, 150, 150)
         self.cell(0, 10, f'Tecnocomp Ltda - Pág {self.page_no()}/{{nb}}', 0, 0, 'C')
 
-def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios):
+def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios, optimizar_imagenes=None, reporte_id=None, fecha=None):
+    if optimizar_imagenes is None: optimizar_imagenes = config.IMAGENES_OPTIMIZAR
+    # Las fotos reducidas viven solo mientras se arma este PDF
+    with tempfile.TemporaryDirectory(prefix="fotos_pdf_") as dir_fotos:
+        fotos_pdf = {}
+        if optimizar_imagenes:
+            todas = [fp for u in datos_usuarios if u.get('atendido') for fp in (u.get('fotos') or [])]
+            fotos_pdf = imagenes.preparar_fotos(todas, destino_dir=dir_fotos)
+        return _generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios, fotos_pdf, reporte_id, fecha)
+
+def _fecha_visita(fecha):
+    """Fecha de la visita ('YYYY-mm-dd HH:MM:SS' tal como se guarda en reportes.fecha).
+    Sin fecha (benchmarks) se usa la hora actual de Chile."""
+    if fecha is None: return utils.obtener_hora_chile()
+    if isinstance(fecha, datetime.datetime): return fecha
+    return datetime.datetime.strptime(fecha, '%Y-%m-%d %H:%M:%S')
+
+def _ruta_salida(cliente, reporte_id, fecha_visita):
+    """Ruta final del PDF en config.PDF_FOLDER. Con reporte_id el nombre es fijo por reporte
+    (reintentar la etapa sobrescribe el mismo archivo); sin él (benchmarks) se agrega un sufijo único."""
+    nombre_clean = "".join([c for c in cliente if c.isalnum() or c in (' ','-','_')]).strip()
+    marca = fecha_visita.strftime('%Y%m%d_%H%M')
+    if reporte_id is not None:
+        return os.path.join(config.PDF_FOLDER, f"Reporte_{reporte_id}_{nombre_clean}_{marca}.pdf")
+    fd, ruta = tempfile.mkstemp(prefix=f"Reporte_{nombre_clean}_{marca}_", suffix=".pdf", dir=config.PDF_FOLDER)
+    os.close(fd)
+    return ruta
+
+def _generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios, fotos_pdf, reporte_id=None, fecha=None):
+    fecha_visita = _fecha_visita(fecha)
     pdf = PDFReporte(orientation='P', unit='mm', format='A4')
     pdf.alias_nb_pages()
     pdf.set_auto_page_break(auto=True, margin=15)
@@ -70,11 +120,11 @@ def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios):
 
     # Fila 1
     dato_inline("CLIENTE:", cliente, 15)
-    dato_inline("FECHA:", utils.obtener_hora_chile().strftime('%d/%m/%Y'), 120)
+    dato_inline("FECHA:", fecha_visita.strftime('%d/%m/%Y'), 120)
     pdf.ln(8)
     # Fila 2
     dato_inline("TÉCNICO:", tecnico, 15)
-    dato_inline("HORA:", utils.obtener_hora_chile().strftime('%H:%M hrs'), 120)
+    dato_inline("HORA:", fecha_visita.strftime('%H:%M hrs'), 120)
     
     pdf.ln(20)
 
@@ -171,7 +221,7 @@ def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios):
                         # Marco foto
                         pdf.set_draw_color(220, 220, 220)
                         pdf.rect(x_fotos-1, y_fotos-1, 47, 37) 
-                        pdf.image(fp, x=x_fotos, y=y_fotos, w=45, h=35)
+                        pdf.image(fotos_pdf.get(fp, fp), x=x_fotos, y=y_fotos, w=45, h=35)
                         x_fotos += 50
                         count += 1
                         if count >= 3: # Salto de línea cada 3 fotos
@@ -224,10 +274,15 @@ def generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios):
     # Si quieres poner un pie de página o firma del técnico al final
     pdf.ln(10)
 
-    # Guardar
-    temp_dir = tempfile.gettempdir()
-    nombre_clean = "".join([c for c in cliente if c.isalnum() or c in (' ','-','_')]).strip()
-    nombre_archivo = f"Reporte_{nombre_clean}_{utils.obtener_hora_chile().strftime('%Y%m%d_%H%M')}.pdf"
-    ruta = os.path.join(temp_dir, nombre_archivo)
-    pdf.output(ruta)
+    # Guardar: se escribe a un temporal del mismo directorio y se renombra, así nadie
+    # (SharePoint, correo) lee un PDF a medio escribir
+    ruta = _ruta_salida(cliente, reporte_id, fecha_visita)
+    fd, parcial = tempfile.mkstemp(suffix=".pdf.tmp", dir=config.PDF_FOLDER)
+    os.close(fd)
+    try:
+        pdf.output(parcial)
+        os.replace(parcial, ruta)
+    except Exception:
+        if os.path.exists(parcial): os.remove(parcial)
+        raise
     return ruta
\ No newline at end of file
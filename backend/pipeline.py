@@ -0,0 +1,269 @@
+import json
+import os
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import database
+import utils
+import render
+import correo
+import config
+
+# ==========================================
+# PIPELINE DE ENTREGA DE REPORTES
+# ==========================================
+# POST /reporte/crear solo guarda el reporte y sus etapas en SQLite.
+# Este worker (un hilo dentro del proceso de la API) drena la tabla
+# etapas_reporte: pdf -> sharepoint -> lista, y pdf -> email.
+# Cada etapa se reintenta por separado con espera exponencial.
+# Hasta PIPELINE_HILOS etapas corren a la vez; el PDF se renderiza en el
+# pool de procesos de `render`. Los correos listos se toman de a
+# CORREO_LOTE y se envían en un solo $batch de Graph (ver `correo`).
+# PIPELINE_MAX_POR_ETAPA limita cuántas de cada tipo corren a la vez.
+# Una etapa que agota PIPELINE_MAX_INTENTOS queda en 'error' (dead letter)
+# hasta que se reencola con POST /pipeline/reintentar.
+
+_despertar = threading.Event()
+_detener = threading.Event()
+_hilo = None
+_ejecutor = None
+_en_vuelo = set()
+_en_vuelo_lock = threading.Lock()
+
+def _ahora_str():
+    return utils.obtener_hora_chile().strftime('%Y-%m-%d %H:%M:%S')
+
+# --- EJECUCIÓN DE CADA ETAPA (retornan (ok, mensaje)) ---
+
+def _etapa_pdf(reporte):
+    usuarios = json.loads(reporte['detalles_usuarios'] or "[]")
+    pdf_path = render.renderizar_pdf(
+        cliente=reporte['cliente'],
+        tecnico=reporte['tecnico'],
+        obs=reporte['observaciones'],
+        path_firma=None,
+        datos_usuarios=usuarios,
+        reporte_id=reporte['id'],
+        fecha=reporte['fecha']
+    )
+    if not pdf_path: return False, "No se generó el PDF"
+    database.actualizar_pdf_reporte(reporte['id'], pdf_path)
+    return True, "PDF generado"
+
+def _pdf_disponible(reporte):
+    """
+    El PDF vive en config.PDF_FOLDER (uno por reporte, con su id en el nombre), que
+    no está en el disco persistente: un redeploy lo borra, y se elimina al terminar
+    la entrega. Si falta, se reabre la etapa 'pdf' (fotos y firmas siguen en el
+    almacén de media) y la etapa que lo necesitaba espera a que se regenere.
+    """
+    if reporte['pdf_path'] and os.path.exists(reporte['pdf_path']): return True
+    database.reabrir_etapa(reporte['id'], 'pdf', "PDF no disponible: se regenera", _ahora_str())
+    return False
+
+def _etapa_sharepoint(reporte):
+    if not _pdf_disponible(reporte): return False, "PDF no disponible; se regenera"
+    ok, msg, web_url = utils.subir_archivo_sharepoint(reporte['pdf_path'], reporte['cliente'])
+    if ok and not web_url:
+        return False, "SharePoint no devolvió URL"
+    if ok:
+        database.actualizar_url_sharepoint(reporte['id'], web_url)
+    return ok, msg
+
+def _etapa_lista(reporte):
+    datos_lista = {
+        "titulo": f"Visita {reporte['cliente']} - {reporte['tecnico']}",
+        "cliente": reporte['cliente'],
+        "tecnico": reporte['tecnico'],
+        "fecha": (reporte['fecha'] or "")[:16],
+        "link": reporte['sharepoint_url']
+    }
+    return utils.crear_item_lista(datos_lista)
+
+def _etapa_email(reporte):
+    if not _pdf_disponible(reporte): return False, "PDF no disponible; se regenera"
+    ok, msg = utils.enviar_correo_graph(
+        reporte['pdf_path'], reporte['cliente'], reporte['tecnico'],
+        reporte['email_tecnico'], database.obtener_correo_cliente(reporte['cliente'])
+    )
+    if ok:
+        database.actualizar_estado_email(reporte['id'], 1)
+    return ok, msg
+
+def _lote_email(reportes):
+    """Varios correos en un $batch. Retorna {reporte_id: (ok, mensaje)}."""
+    trabajos = [{
+        "id": r['id'],
+        "ruta_pdf": r['pdf_path'],
+        "cliente": r['cliente'],
+        "tecnico": r['tecnico'],
+        "email_tecnico": r['email_tecnico'],
+        "email_cliente": database.obtener_correo_cliente(r['cliente'])
+    } for r in reportes]
+    resultados = correo.enviar_lote(trabajos)
+    database.marcar_emails_enviados([i for i, (ok, _) in resultados.items() if ok])
+    return resultados
+
+EJECUTORES = {
+    "pdf": _etapa_pdf,
+    "sharepoint": _etapa_sharepoint,
+    "lista": _etapa_lista,
+    "email": _etapa_email,
+}
+
+# --- LIMPIEZA ---
+
+def _limpiar_si_termino(reporte_id):
+    # Solo el PDF es temporal (queda en SharePoint); fotos y firmas viven en el
+    # almacén de `media` y se borran con su recolector cuando ningún reporte las usa.
+    # El PDF se conserva mientras quede alguna etapa sin 'ok' (para reintentos)
+    etapas = database.obtener_etapas_reporte(reporte_id)
+    if etapas and all(e[1] == 'ok' for e in etapas):
+        reporte = database.obtener_reporte_trabajo(reporte_id)
+        if reporte and reporte['pdf_path']:
+            utils.eliminar_archivos_temporales([reporte['pdf_path']])
+
+# --- PROCESAMIENTO ---
+
+def _ejecutar_etapa(reporte_id, etapa):
+    """Un intento de una etapa ya tomada ('en_proceso'): la ejecuta y registra el resultado."""
+    reporte = database.obtener_reporte_trabajo(reporte_id)
+    try:
+        if not reporte:
+            ok, msg = False, "Reporte no existe"
+        else:
+            ok, msg = EJECUTORES[etapa](reporte)
+    except Exception as e:
+        traceback.print_exc()
+        ok, msg = False, f"Excepción {etapa}: {e}"
+    _registrar_resultado(reporte_id, etapa, ok, msg, reporte is not None)
+
+def _ejecutar_lote_email(reporte_ids):
+    """Como _ejecutar_etapa, pero para varias etapas 'email' ya tomadas, en un $batch."""
+    reportes = {i: database.obtener_reporte_trabajo(i) for i in reporte_ids}
+    listos = [r for r in reportes.values() if r and _pdf_disponible(r)]
+    try:
+        resultados = _lote_email(listos) if listos else {}
+    except Exception as e:
+        traceback.print_exc()
+        resultados = {r['id']: (False, f"Excepción email: {e}") for r in listos}
+    for r in reportes.values():
+        if r and r['id'] not in resultados:
+            resultados[r['id']] = (False, "PDF no disponible; se regenera")
+    for reporte_id, reporte in reportes.items():
+        ok, msg = resultados.get(reporte_id, (False, "Reporte no existe"))
+        _registrar_resultado(reporte_id, "email", ok, msg, reporte is not None)
+
+def _espera_reintento(intentos):
+    """Espera exponencial con tope y ±PIPELINE_JITTER de variación."""
+    espera = min(config.PIPELINE_ESPERA_BASE * (2 ** (intentos - 1)), config.PIPELINE_ESPERA_MAXIMA)
+    return espera * random.uniform(1 - config.PIPELINE_JITTER, 1 + config.PIPELINE_JITTER)
+
+def _registrar_resultado(reporte_id, etapa, ok, msg, existe=True):
+    if ok:
+        database.finalizar_etapa(reporte_id, etapa, 'ok', msg, _ahora_str())
+        print(f"✅ Reporte {reporte_id} [{etapa}]: {msg}")
+        _limpiar_si_termino(reporte_id)
+    else:
+        intentos = database.obtener_intentos_etapa(reporte_id, etapa) + 1
+        if intentos >= config.PIPELINE_MAX_INTENTOS or not existe:
+            database.finalizar_etapa(reporte_id, etapa, 'error', msg, _ahora_str())
+            print(f"❌ Reporte {reporte_id} [{etapa}] sin más reintentos: {msg}")
+        else:
+            espera = _espera_reintento(intentos)
+            database.finalizar_etapa(reporte_id, etapa, 'pendiente', msg, _ahora_str(), time.time() + espera)
+            print(f"⚠️ Reporte {reporte_id} [{etapa}] falló ({msg}). Reintento en {int(espera)}s")
+
+def procesar_etapa(reporte_id, etapa):
+    """Ejecuta un intento de la etapa en este hilo. Retorna False si otro worker ya la había tomado."""
+    if not database.tomar_etapa(reporte_id, etapa, _ahora_str()):
+        return False
+    _ejecutar_etapa(reporte_id, etapa)
+    return True
+
+def _ejecutar_en_hilo(clave, funcion, *args):
+    try:
+        funcion(*args)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        with _en_vuelo_lock:
+            _en_vuelo.discard(clave)
+        # Un hilo libre o una etapa terminada pueden habilitar más trabajo
+        _despertar.set()
+
+def _lanzar(clave, funcion, *args):
+    with _en_vuelo_lock:
+        _en_vuelo.add(clave)
+    _ejecutor.submit(_ejecutar_en_hilo, clave, funcion, *args)
+
+def _cupos():
+    """(hilos libres, {etapa: cupo libre según PIPELINE_MAX_POR_ETAPA})."""
+    with _en_vuelo_lock:
+        libres = config.PIPELINE_HILOS - len(_en_vuelo)
+        en_curso = {}
+        for etapa, _ in _en_vuelo:
+            en_curso[etapa] = en_curso.get(etapa, 0) + 1
+    maximos = config.PIPELINE_MAX_POR_ETAPA
+    return libres, {e: maximos.get(e, config.PIPELINE_HILOS) - en_curso.get(e, 0) for e in config.PIPELINE_ETAPAS}
+
+def drenar_cola():
+    """Toma etapas listas hasta llenar los hilos libres. Retorna cuántas tareas se lanzaron."""
+    libres, cupos = _cupos()
+    if libres <= 0: return 0
+    lanzadas = 0
+    ahora = time.time()
+
+    # Primero las etapas finales: termina los reportes empezados antes de abrir nuevos
+    for etapa in reversed(config.PIPELINE_ETAPAS):
+        cupo = min(libres, cupos[etapa])
+        if cupo <= 0: continue
+        if etapa == "email" and config.CORREO_LOTE > 1:
+            # Todos los correos listos (hasta CORREO_LOTE) ocupan un solo hilo
+            lote = [rid for rid, _ in database.obtener_etapas_listas(ahora, config.CORREO_LOTE, etapa="email")
+                    if database.tomar_etapa(rid, "email", _ahora_str())]
+            if lote:
+                _lanzar(("email", tuple(lote)), _ejecutar_lote_email, lote)
+                libres -= 1
+                lanzadas += 1
+            continue
+        for reporte_id, _ in database.obtener_etapas_listas(ahora, cupo, etapa=etapa):
+            if not database.tomar_etapa(reporte_id, etapa, _ahora_str()): continue
+            _lanzar((etapa, reporte_id), _ejecutar_etapa, reporte_id, etapa)
+            libres -= 1
+            lanzadas += 1
+    return lanzadas
+
+def _bucle():
+    while not _detener.is_set():
+        _despertar.clear()
+        try:
+            if drenar_cola() > 0:
+                continue
+        except Exception:
+            traceback.print_exc()
+        _despertar.wait(config.PIPELINE_INTERVALO)
+
+def notificar():
+    """Despierta al worker (por ejemplo, tras encolar un reporte nuevo)."""
+    _despertar.set()
+
+def iniciar_worker():
+    global _hilo, _ejecutor
+    if _hilo and _hilo.is_alive(): return
+    liberadas = database.liberar_etapas_en_proceso()
+    if liberadas:
+        print(f"🔁 {liberadas} etapas interrumpidas vuelven a la cola")
+    _detener.clear()
+    _ejecutor = ThreadPoolExecutor(max_workers=config.PIPELINE_HILOS, thread_name_prefix="etapa")
+    _hilo = threading.Thread(target=_bucle, name="pipeline-reportes", daemon=True)
+    _hilo.start()
+
+def detener_worker(timeout=10):
+    _detener.set()
+    _despertar.set()
+    if _hilo: _hilo.join(timeout)
+    if _ejecutor: _ejecutor.shutdown(wait=False)
+    render.detener()
@@ -0,0 +1,74 @@
+import hashlib
+import os
+import uuid
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+import config
+import media
+
+# ==========================================
+# RECEPCIÓN DE ARCHIVOS (FOTOS Y FIRMAS)
+# ==========================================
+# Cada UploadFile se lee por bloques y se escribe en un hilo aparte, así el
+# event loop no se bloquea con E/S de disco. El archivo termina en el
+# almacén de `media`, con el SHA-256 del contenido como nombre: dos tablets
+# que envían "1764866287204.jpg" distintos ya no se pisan, y el mismo
+# archivo reenviado cae en la misma ruta.
+
+EXTENSIONES_PERMITIDAS = {".jpg", ".jpeg", ".png", ".webp", ".heic"}
+_EXTENSION_POR_TIPO = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp", "image/heic": ".heic"}
+
+class PresupuestoSubida:
+    """Bytes restantes para todos los archivos de una misma petición."""
+    def __init__(self, limite=None):
+        self.restante = config.RECEPCION_MAX_PETICION if limite is None else limite
+
+    def consumir(self, n):
+        self.restante -= n
+        if self.restante < 0:
+            raise HTTPException(status_code=413, detail="La visita supera el tamaño máximo permitido")
+
+def _extension(upload):
+    ext = os.path.splitext(os.path.basename(upload.filename or ""))[1].lower()
+    if ext in EXTENSIONES_PERMITIDAS: return ext
+    return _EXTENSION_POR_TIPO.get(upload.content_type or "", ".bin")
+
+def _abrir_parcial(destino_dir):
+    os.makedirs(destino_dir, exist_ok=True)
+    ruta = os.path.join(destino_dir, f".parcial-{uuid.uuid4().hex}")
+    return ruta, open(ruta, "wb")
+
+def _cerrar_y_ubicar(f, ruta_parcial, sha, ext):
+    f.close()
+    return media.ubicar(ruta_parcial, sha, ext)
+
+def _descartar(f, ruta_parcial):
+    f.close()
+    if os.path.exists(ruta_parcial): os.remove(ruta_parcial)
+
+async def guardar_upload(upload, presupuesto):
+    """
+    Guarda un UploadFile en el almacén de media como <sha256><ext>.
+    Lanza HTTPException 413 si el archivo o la petición superan los límites.
+    Retorna (ruta_absoluta, sha256, bytes).
+    """
+    ruta_parcial, f = await run_in_threadpool(_abrir_parcial, media.dir_parciales())
+    h = hashlib.sha256()
+    tamano = 0
+    try:
+        while True:
+            bloque = await upload.read(config.RECEPCION_TAMANO_BLOQUE)
+            if not bloque: break
+            tamano += len(bloque)
+            if tamano > config.RECEPCION_MAX_ARCHIVO:
+                raise HTTPException(status_code=413, detail=f"Archivo '{upload.filename}' supera el tamaño máximo")
+            presupuesto.consumir(len(bloque))
+            h.update(bloque)
+            await run_in_threadpool(f.write, bloque)
+    except BaseException:
+        await run_in_threadpool(_descartar, f, ruta_parcial)
+        raise
+
+    sha = h.hexdigest()
+    ruta_final = await run_in_threadpool(_cerrar_y_ubicar, f, ruta_parcial, sha, _extension(upload))
+    return ruta_final, sha, tamano
@@ -0,0 +1,80 @@
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+import config
+import imagenes
+import pdf_generator
+
+# ==========================================
+# SERVICIO DE RENDER DE PDF (POOL DE PROCESOS)
+# ==========================================
+# fpdf2 y Pillow son CPU puro: en un hilo del proceso de la API compiten por
+# el GIL con el event loop de uvicorn. Aquí se ejecutan en procesos aparte,
+# con un máximo de RENDER_PROCESOS simultáneos y RENDER_TIMEOUT por trabajo.
+
+class RenderTimeout(Exception):
+    pass
+
+_pool = None
+_pool_pids = None     # cola donde cada proceso del pool actual anuncia su PID
+_pool_lock = threading.Lock()
+
+def _inicializar_proceso(cola_pids):
+    cola_pids.put(os.getpid())
+    # Dentro del proceso de render las fotos se preparan en serie (sin pool anidado)
+    config.IMAGENES_PROCESOS = 1
+
+def _obtener_pool():
+    global _pool, _pool_pids
+    with _pool_lock:
+        if _pool is None:
+            # 'spawn': el proceso de la API tiene hilos vivos y fork podría heredar locks tomados
+            contexto = multiprocessing.get_context("spawn")
+            _pool_pids = contexto.SimpleQueue()
+            _pool = ProcessPoolExecutor(max_workers=config.RENDER_PROCESOS, initializer=_inicializar_proceso,
+                                        initargs=(_pool_pids,), mp_context=contexto)
+        return _pool
+
+def _reiniciar_pool(pool):
+    """Descarta un pool con un trabajo colgado o roto; el siguiente render crea uno nuevo."""
+    global _pool, _pool_pids
+    with _pool_lock:
+        if _pool is not pool: return
+        _pool, cola_pids, _pool_pids = None, _pool_pids, None
+    # ProcessPoolExecutor no permite cancelar un trabajo en ejecución: se terminan sus
+    # procesos por PID (si el pool ya está roto, los que quedan vivos)
+    while not cola_pids.empty():
+        try: os.kill(cola_pids.get(), signal.SIGTERM)
+        except OSError: pass
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def renderizar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios, timeout=None, reporte_id=None, fecha=None):
+    """
+    Igual que pdf_generator.generar_pdf, pero en el pool de procesos.
+    Lanza RenderTimeout si tarda más de `timeout` (RENDER_TIMEOUT por defecto).
+    """
+    if config.RENDER_PROCESOS <= 0:
+        return pdf_generator.generar_pdf(cliente, tecnico, obs, path_firma, datos_usuarios, reporte_id=reporte_id, fecha=fecha)
+
+    pool = _obtener_pool()
+    try:
+        futuro = pool.submit(pdf_generator.generar_pdf, cliente, tecnico, obs, path_firma, datos_usuarios,
+                             reporte_id=reporte_id, fecha=fecha)
+        return futuro.result(timeout=timeout or config.RENDER_TIMEOUT)
+    except FuturesTimeout:
+        _reiniciar_pool(pool)
+        raise RenderTimeout(f"El PDF tardó más de {timeout or config.RENDER_TIMEOUT}s")
+    except BrokenProcessPool:
+        _reiniciar_pool(pool)
+        raise
+
+def detener():
+    global _pool, _pool_pids
+    with _pool_lock:
+        pool, _pool, _pool_pids = _pool, None, None
+    if pool: pool.shutdown(wait=False, cancel_futures=True)
+    # Pool de fotos que se crea en este proceso cuando RENDER_PROCESOS=0
+    imagenes.detener()
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+
+@pytest.fixture
+def base_vacia(tmp_path, monkeypatch):
+    """Base temporal sin migrar (para probar migraciones parciales)."""
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "visitas.db"))
+    yield
+    database.cerrar_conexion()
+
+@pytest.fixture
+def base(base_vacia):
+    """Base temporal con todas las migraciones aplicadas."""
+    database.migrar()
+    yield
+
+@pytest.fixture
+def api(base):
+    """TestClient de la API sobre la base temporal (sin eventos de arranque: ni worker ni GC)."""
+    from fastapi.testclient import TestClient
+    import api as modulo_api
+    import cache_maestros
+    cache_maestros.invalidar("clientes", "tecnicos", "usuarios")
+    return TestClient(modulo_api.app)
+
+@pytest.fixture
+def nuevo_reporte(base):
+    """Crea un reporte con encolar_reporte; `usuarios` es la lista de detalles_usuarios."""
+    import json
+
+    def crear(cliente="ACME", tecnico="Tec", fecha="2026-03-10 10:00:00", obs="", usuarios=()):
+        return database.encolar_reporte(
+            fecha=fecha, cliente=cliente, tecnico=tecnico, obs=obs, fotos_json="[]",
+            detalles_json=json.dumps(list(usuarios), ensure_ascii=False)
+        )
+    return crear
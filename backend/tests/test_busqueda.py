@@ -0,0 +1,46 @@
+import database
+
+def _ids(api, q, **filtros):
+    r = api.get("/reportes/buscar", params={"q": q, **filtros})
+    assert r.status_code == 200
+    return [item["id"] for item in r.json()["items"]]
+
+def test_busca_en_observaciones_y_trabajo_de_usuarios(api, nuevo_reporte):
+    impresora = nuevo_reporte(obs="Impresora atascada en bodega")
+    disco = nuevo_reporte(cliente="Beta", usuarios=[
+        {"nombre": "Ana Rojas", "atendido": True, "trabajo": "Cambio de disco"},
+    ])
+    nuevo_reporte(obs="Sin observaciones")
+
+    assert _ids(api, "impres") == [impresora]          # prefijo
+    assert _ids(api, "disco") == [disco]               # trabajo de un usuario
+    assert _ids(api, "rojas") == [disco]               # nombre de usuario
+    assert _ids(api, '"atascada en bodega"') == [impresora]
+    assert _ids(api, '"bodega atascada"') == []
+    assert _ids(api, "disco", cliente="ACME") == []
+    item = api.get("/reportes/buscar", params={"q": "bodega"}).json()["items"][0]
+    assert "[bodega]" in item["fragmento"]
+    assert api.get("/reportes/buscar", params={"q": " ¿? "}).status_code == 422
+
+def test_paginacion_por_desplazamiento(api, nuevo_reporte):
+    ids = [nuevo_reporte(obs="ventilador ruidoso") for _ in range(5)]
+    primera = api.get("/reportes/buscar", params={"q": "ventilador", "limite": 3}).json()
+    assert primera["total"] == 5 and primera["siguiente"] == 3
+    segunda = api.get("/reportes/buscar", params={"q": "ventilador", "limite": 3, "desplazamiento": 3}).json()
+    assert segunda["siguiente"] is None
+    assert sorted(i["id"] for i in primera["items"] + segunda["items"]) == ids
+
+def test_indice_sigue_a_actualizaciones_y_borrados(api, nuevo_reporte):
+    reporte_id = nuevo_reporte(obs="licencia pendiente", usuarios=[{"nombre": "Ana", "trabajo": "Antivirus"}])
+    assert _ids(api, "antivirus") == [reporte_id]
+
+    database.actualizar_reporte(reporte_id, "2026-03-10 10:00:00", "ACME", "Tec", "licencia instalada", "[]", "",
+                                '[{"nombre": "Ana", "trabajo": "Respaldo de correo"}]', 0)
+    assert _ids(api, "antivirus") == []
+    assert _ids(api, "pendiente") == []
+    assert _ids(api, "respaldo correo") == [reporte_id]
+    assert _ids(api, "instalada") == [reporte_id]
+
+    assert api.delete(f"/reporte/{reporte_id}").status_code == 200
+    assert _ids(api, "instalada") == []
+    assert database._consultar("SELECT COUNT(*) FROM reportes_fts")[0][0] == 0
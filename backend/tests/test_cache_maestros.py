@@ -0,0 +1,36 @@
+import database
+
+def test_if_none_match_responde_304_sin_cuerpo(api):
+    database.agregar_cliente("ACME", "a@x.cl")
+    r = api.get("/clientes")
+    assert r.status_code == 200
+    assert r.json() == [["ACME", "a@x.cl"]]
+    etag = r.headers["etag"]
+    r = api.get("/clientes", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.content == b""
+    assert r.headers["etag"] == etag
+    assert api.get("/clientes", headers={"If-None-Match": f'"otro", W/{etag}'}).status_code == 304
+
+def test_escritura_invalida_el_etag(api):
+    etag_clientes = api.get("/clientes").headers["etag"]
+    etag_tecnicos = api.get("/tecnicos").headers["etag"]
+    assert api.post("/clientes", json={"nombre": "ACME", "email": "a@x.cl"}).status_code == 200
+    r = api.get("/clientes", headers={"If-None-Match": etag_clientes})
+    assert r.status_code == 200
+    assert r.json() == [["ACME", "a@x.cl"]]
+    assert r.headers["etag"] != etag_clientes
+    # Las demás tablas conservan su versión
+    assert api.get("/tecnicos", headers={"If-None-Match": etag_tecnicos}).status_code == 304
+
+def test_usuarios_por_cliente_y_borrado(api):
+    database.agregar_cliente("ACME", "a@x.cl")
+    api.post("/usuarios", json={"nombre": "Ana", "cliente": "ACME"})
+    r = api.get("/usuarios/ACME")
+    assert r.json() == ["Ana"]
+    etag = r.headers["etag"]
+    assert api.get("/usuarios/ACME", headers={"If-None-Match": etag}).status_code == 304
+    assert api.delete("/usuario/ACME/Ana").status_code == 200
+    r = api.get("/usuarios/ACME", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.json() == []
@@ -0,0 +1,39 @@
+def _paginas(api, **filtros):
+    paginas, antes_de = [], None
+    while True:
+        params = {**filtros, "limite": 3}
+        if antes_de is not None: params["antes_de"] = antes_de
+        r = api.get("/reportes", params=params)
+        assert r.status_code == 200
+        cuerpo = r.json()
+        paginas.append([item["id"] for item in cuerpo["items"]])
+        antes_de = cuerpo["siguiente"]
+        if antes_de is None: return paginas
+
+def test_paginas_sin_duplicados_ni_huecos(api, nuevo_reporte):
+    ids = [nuevo_reporte(cliente="ACME" if i % 3 else "Beta", fecha=f"2026-03-{i + 1:02d} 10:00:00") for i in range(10)]
+    paginas = _paginas(api)
+    assert [len(p) for p in paginas] == [3, 3, 3, 1]
+    assert [i for p in paginas for i in p] == sorted(ids, reverse=True)
+
+    acme = [i for n, i in enumerate(ids) if n % 3]
+    assert [i for p in _paginas(api, cliente="ACME") for i in p] == sorted(acme, reverse=True)
+
+def test_reporte_nuevo_no_desplaza_las_paginas_siguientes(api, nuevo_reporte):
+    ids = [nuevo_reporte() for _ in range(6)]
+    primera = api.get("/reportes", params={"limite": 3}).json()
+    nuevo_reporte()
+    segunda = api.get("/reportes", params={"limite": 3, "antes_de": primera["siguiente"]}).json()
+    vistos = [item["id"] for item in primera["items"] + segunda["items"]]
+    assert vistos == sorted(ids, reverse=True)
+    assert segunda["siguiente"] is None
+
+def test_filtro_de_fechas_y_detalle_completo(api, nuevo_reporte):
+    nuevo_reporte(fecha="2026-03-01 09:00:00")
+    dentro = nuevo_reporte(fecha="2026-03-02 23:59:00", usuarios=[{"nombre": "Ana", "atendido": True}])
+    nuevo_reporte(fecha="2026-03-03 00:00:00")
+    r = api.get("/reportes", params={"desde": "2026-03-02", "hasta": "2026-03-02", "completo": True}).json()
+    assert [item["id"] for item in r["items"]] == [dentro]
+    assert r["items"][0]["detalles_usuarios"] == [{"nombre": "Ana", "atendido": True}]
+    assert "detalles_usuarios" not in api.get("/reportes").json()["items"][0]
+    assert api.get("/reportes", params={"desde": "02-03-2026"}).status_code == 422
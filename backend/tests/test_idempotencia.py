@@ -0,0 +1,12 @@
+import database
+
+def test_clave_vencida_no_se_reutiliza(base):
+    # Una clave fuera del TTL no se borra hasta el próximo encolar_reporte_idempotente:
+    # la búsqueda previa no debe tomarla como reintento
+    reporte_id, _, repetido = database.encolar_reporte_idempotente(
+        "k", "h", "2025-12-25 10:00:00", fecha="2026-01-01 10:00:00", cliente="ACME", tecnico="Tec",
+        obs="", fotos_json="[]", detalles_json="[]"
+    )
+    assert not repetido
+    assert database.buscar_idempotencia("k", "2026-01-01 09:00:00") == (reporte_id, "h")
+    assert database.buscar_idempotencia("k", "2026-01-08 10:00:01") is None
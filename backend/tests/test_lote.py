@@ -0,0 +1,39 @@
+import config
+import database
+
+def test_clientes_json_con_duplicados_y_actualizacion(api):
+    database.agregar_cliente("ACME", "viejo@x.cl")
+    r = api.post("/clientes/lote", json=[
+        {"nombre": "ACME", "email": "nuevo@x.cl"},
+        {"nombre": "Beta", "email": "b@x.cl"},
+        {"nombre": "Beta", "email": "b2@x.cl"},
+        {"nombre": "", "email": "x@x.cl"},
+    ])
+    assert r.status_code == 200
+    cuerpo = r.json()
+    assert [f["resultado"] for f in cuerpo["filas"]] == ["actualizado", "duplicado", "creado", "error: nombre vacío"]
+    assert cuerpo["resumen"] == {"actualizado": 1, "duplicado": 1, "creado": 1, "error": 1}
+    assert database.obtener_clientes() == [("ACME", "nuevo@x.cl"), ("Beta", "b2@x.cl")]
+
+def test_tecnicos_csv_con_punto_y_coma(api):
+    csv = "nombre;zona\nAna Pérez;Norte\nLuis;Sur\n"
+    r = api.post("/tecnicos/lote", content=csv.encode("utf-8-sig"), headers={"Content-Type": "text/csv"})
+    assert r.status_code == 200
+    assert [f["resultado"] for f in r.json()["filas"]] == ["creado", "creado"]
+    r = api.post("/tecnicos/lote", json=[{"nombre": "Luis"}])
+    assert r.json()["filas"][0]["resultado"] == "sin_cambios"
+
+def test_usuarios_de_cliente_inexistente_no_se_guardan(api):
+    database.agregar_cliente("ACME", "a@x.cl")
+    r = api.post("/usuarios/lote", json=[
+        {"nombre": "Ana", "cliente": "ACME"},
+        {"nombre": "Luis", "cliente": "Fantasma"},
+    ])
+    assert [f["resultado"] for f in r.json()["filas"]] == ["creado", "error: cliente 'Fantasma' no existe"]
+    assert database.obtener_todos_usuarios() == [("Ana", "ACME")]
+
+def test_lote_invalido_o_demasiado_grande(api, monkeypatch):
+    assert api.post("/clientes/lote", json={"nombre": "ACME"}).status_code == 400
+    assert api.post("/clientes/lote", content=b"{no es json", headers={"Content-Type": "application/json"}).status_code == 400
+    monkeypatch.setattr(config, "LOTE_MAX_FILAS", 1)
+    assert api.post("/tecnicos/lote", json=[{"nombre": "A"}, {"nombre": "B"}]).status_code == 413
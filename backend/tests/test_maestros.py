@@ -0,0 +1,12 @@
+import database
+
+def test_usuario_de_cliente_inexistente_responde_error(api):
+    r = api.post("/usuarios", json={"nombre": "Ana", "cliente": "Fantasma"})
+    assert r.status_code == 422
+    assert "Fantasma" in r.json()["detail"]
+    assert database.obtener_todos_usuarios() == []
+
+def test_usuario_de_cliente_existente(api):
+    database.agregar_cliente("ACME", "a@x.cl")
+    assert api.post("/usuarios", json={"nombre": "Ana", "cliente": "ACME"}).json()["message"] == "Usuario creado"
+    assert api.post("/usuarios", json={"nombre": "Ana", "cliente": "ACME"}).json()["message"] == "Usuario ya existía o error"
@@ -0,0 +1,43 @@
+import os
+import threading
+import time
+
+import config
+import database
+import media
+
+def _subida(sha, contenido=b"foto"):
+    ruta = os.path.join(media.dir_parciales(), f".parcial-{sha}-{time.time_ns()}")
+    with open(ruta, "wb") as f: f.write(contenido)
+    return ruta
+
+def test_gc_no_borra_un_archivo_reutilizado_durante_la_recoleccion(base, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MEDIA_DIR", str(tmp_path / "media"))
+    sha = "ab" * 32
+    final = media.ubicar(_subida(sha), sha, ".jpg")
+    relativa = os.path.relpath(final, config.MEDIA_DIR)
+    # Fila huérfana (refs = 0) con el archivo vencido
+    database.conectar().execute(
+        "INSERT INTO media (sha256, ruta, bytes, creado) VALUES (?, ?, 4, '2026-01-01 00:00:00')", (sha, relativa)
+    )
+    os.utime(final, (0, 0))
+
+    # La tablet vuelve a subir el mismo contenido justo después de que el GC revisó el mtime
+    antiguo = media._antiguo
+    hilos = []
+    def _antiguo_con_subida(ruta, limite):
+        resultado = antiguo(ruta, limite)
+        if not hilos:
+            hilos.append(threading.Thread(target=media.ubicar, args=(_subida(sha), sha, ".jpg")))
+            hilos[0].start()
+            hilos[0].join(0.2)
+        return resultado
+    monkeypatch.setattr(media, "_antiguo", _antiguo_con_subida)
+    media.recolectar_basura(gracia=60)
+    hilos[0].join()
+
+    # El reporte que registra la subida encuentra el archivo en su lugar
+    database.encolar_reporte(fecha="2026-01-02 00:00:00", cliente="ACME", tecnico="Tec", obs="",
+                             fotos_json="[]", detalles_json="[]", archivos=[(sha, relativa, 4)])
+    assert os.path.exists(final)
+    assert database.obtener_media(sha)[2] == 1
@@ -0,0 +1,33 @@
+import database
+
+def test_metricas_siguen_altas_cambios_y_bajas(api, nuevo_reporte):
+    a1 = nuevo_reporte(cliente="ACME", tecnico="Ana", fecha="2026-01-15 10:00:00")
+    nuevo_reporte(cliente="ACME", tecnico="Luis", fecha="2026-02-01 10:00:00")
+    b1 = nuevo_reporte(cliente="Beta", tecnico="Ana", fecha="2026-02-20 10:00:00")
+    database.actualizar_estado_email(a1, 1)
+    # El reporte de Beta pasa a ACME y a marzo
+    database.actualizar_reporte(b1, "2026-03-05 10:00:00", "ACME", "Ana", "", "[]", "", "[]", 0)
+
+    m = api.get("/metricas").json()
+    assert m["total"] == 3 and m["pendientes"] == 2
+    assert m["cliente_top"] == "ACME (3)"
+    assert {d["cliente"]: d["reportes"] for d in m["por_cliente"] if d["reportes"]} == {"ACME": 3}
+    assert {d["tecnico"]: d["reportes"] for d in m["por_tecnico"] if d["reportes"]} == {"Ana": 2, "Luis": 1}
+    assert [(d["mes"], d["reportes"]) for d in m["por_mes"] if d["reportes"]] == [
+        ("2026-01", 1), ("2026-02", 1), ("2026-03", 1)
+    ]
+    assert m["pendientes_por_cliente"] == [{"cliente": "ACME", "pendientes": 2}]
+
+    assert api.delete(f"/reporte/{a1}").status_code == 200
+    m = api.get("/metricas").json()
+    assert m["total"] == 2 and m["pendientes"] == 2
+    # Lo que mantienen los triggers coincide con recalcular todo desde `reportes`
+    database.reconstruir_metricas()
+    assert api.get("/metricas").json() == m
+
+def test_meses_limita_la_evolucion(api, nuevo_reporte):
+    for mes in range(1, 7):
+        nuevo_reporte(fecha=f"2026-{mes:02d}-01 10:00:00")
+    por_mes = api.get("/metricas", params={"meses": 3}).json()["por_mes"]
+    assert [d["mes"] for d in por_mes] == ["2026-04", "2026-05", "2026-06"]
+    assert api.get("/metricas", params={"meses": 0}).status_code == 422
@@ -0,0 +1,24 @@
+import database
+
+def _pendientes_clientes():
+    return database._consultar("SELECT clave FROM cambios_respaldo WHERE tabla = 'clientes'")
+
+def test_upsert_de_cliente_con_cambio_pendiente(base):
+    # El upsert de agregar_cliente disparaba el trigger de respaldo con una clave
+    # ya registrada y fallaba con "UNIQUE constraint failed"
+    assert database.agregar_cliente("ACME", "a@x.cl")
+    assert database.agregar_cliente("ACME", "b@x.cl")
+    assert database.obtener_clientes() == [("ACME", "b@x.cl")]
+    assert _pendientes_clientes() == [('["ACME"]',)]
+
+def test_importar_cliente_existente(base):
+    database.agregar_cliente("ACME", "a@x.cl")
+    assert database.importar_clientes([("ACME", "nuevo@x.cl"), ("Otro", "o@x.cl")]) == ["actualizado", "creado"]
+    assert database.obtener_clientes() == [("ACME", "nuevo@x.cl"), ("Otro", "o@x.cl")]
+
+def test_cambio_pendiente_pasa_al_seq_mas_nuevo(base):
+    database.agregar_cliente("ACME", "a@x.cl")
+    database.agregar_cliente("Otro", "o@x.cl")
+    database.agregar_cliente("ACME", "b@x.cl")
+    claves = database._consultar("SELECT clave FROM cambios_respaldo WHERE tabla = 'clientes' ORDER BY seq")
+    assert claves == [('["Otro"]',), ('["ACME"]',)]
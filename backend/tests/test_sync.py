@@ -0,0 +1,55 @@
+import database
+
+def test_cursor_cero_envia_filas_anteriores_al_registro(base_vacia):
+    # Las filas creadas antes de la v3 no tienen entrada en `cambios`
+    database.migrar(hasta=2)
+    database.conectar().execute("INSERT INTO clientes (nombre, email) VALUES ('Antiguo', 'a@x.cl')")
+    database.migrar()
+    database.agregar_cliente("Nuevo", "n@x.cl")
+    cursor, completo, cambios = database.obtener_cambios_desde(0)
+    assert completo
+    assert [c["nombre"] for c in cambios["clientes"]["upsert"]] == ["Antiguo", "Nuevo"]
+
+    database.agregar_cliente("Otro", "o@x.cl")
+    _, completo, cambios = database.obtener_cambios_desde(cursor)
+    assert not completo
+    assert [c["nombre"] for c in cambios["clientes"]["upsert"]] == ["Otro"]
+
+def test_lectura_no_toma_el_lock_de_escritura(base):
+    with database.lectura():
+        otra = database.sqlite3.connect(database.DB_NAME, timeout=0)
+        otra.execute("INSERT INTO clientes (nombre, email) VALUES ('X', 'x@x.cl')")
+        otra.commit()
+        otra.close()
+    assert not database.conectar().in_transaction
+
+def test_cambios_guarda_solo_la_ultima_entrada_por_clave(base):
+    database.agregar_cliente("ACME", "a@x.cl")
+    cursor, _, _ = database.obtener_cambios_desde(None)
+    database.agregar_cliente("ACME", "b@x.cl")
+    database.agregar_cliente("ACME", "c@x.cl")
+    database.agregar_cliente("Otro", "o@x.cl")
+    database.eliminar_cliente("Otro")
+    assert database._consultar("SELECT clave, operacion FROM cambios ORDER BY seq") == [
+        ("ACME", "upsert"), ("Otro", "delete")
+    ]
+    _, completo, cambios = database.obtener_cambios_desde(cursor)
+    assert not completo
+    assert cambios["clientes"] == {"upsert": [{"nombre": "ACME", "email": "c@x.cl"}], "delete": ["Otro"]}
+
+def test_migracion_compacta_cambios_existentes(base_vacia):
+    database.migrar(hasta=11)
+    for email in ("a@x.cl", "b@x.cl", "c@x.cl"):
+        database.agregar_cliente("ACME", email)
+    assert database._consultar("SELECT COUNT(*) FROM cambios")[0][0] == 3
+    database.migrar()
+    assert database._consultar("SELECT datos FROM cambios") == [('{"nombre":"ACME","email":"c@x.cl"}',)]
+
+def test_mismo_email_no_registra_cambio(api):
+    database.agregar_cliente("ACME", "a@x.cl")
+    seq = database._consultar("SELECT MAX(seq) FROM cambios")[0][0]
+    etag = api.get("/clientes").headers["etag"]
+    assert not database.agregar_cliente("ACME", "a@x.cl")
+    assert api.post("/clientes", json={"nombre": "ACME", "email": "a@x.cl"}).status_code == 200
+    assert database._consultar("SELECT MAX(seq) FROM cambios")[0][0] == seq
+    assert api.get("/clientes", headers={"If-None-Match": etag}).status_code == 304
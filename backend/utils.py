@@ -1,11 +1,13 @@
 import datetime
 import pytz
-import requests
-import base64
 import tempfile
 import os
+import threading
+import time
 from PIL import Image, ImageDraw
 import config
+import graph
+import correo
 
 def obtener_hora_chile():
     try:
@@ -13,25 +15,9 @@ def obtener_hora_chile():
     except:
         return datetime.datetime.now()
 
-# --- HELPER INTERNO PARA AUTH (Token Único) ---
+# --- HELPER INTERNO PARA AUTH (Token Único, cacheado en graph.py) ---
 def _obtener_token_graph():
-    url = f"https://login.microsoftonline.com/{config.GRAPH_TENANT_ID}/oauth2/v2.0/token"
-    data = {
-        'grant_type': 'client_credentials',
-        'client_id': config.GRAPH_CLIENT_ID,
-        'client_secret': config.GRAPH_CLIENT_SECRET,
-        'scope': 'https://graph.microsoft.com/.default'
-    }
-    try:
-        r = requests.post(url, data=data)
-        js = r.json()
-        if 'access_token' in js:
-            return js['access_token']
-        print(f"Error Token: {js}")
-        return None
-    except Exception as e:
-        print(f"Excepción Token: {e}")
-        return None
+    return graph.obtener_token()
 
 # --- HELPER PARA LIMPIAR NOMBRES DE CARPETAS ---
 def _sanitizar_nombre(nombre):
@@ -40,36 +26,39 @@ def _sanitizar_nombre(nombre):
         nombre = nombre.replace(char, '')
     return nombre.strip()
 
-# --- SHAREPOINT: SUBIR ARCHIVO (Retorna URL) ---
-def subir_archivo_sharepoint(ruta_local, cliente):
-    """
-    Sube el PDF a SharePoint y retorna: (True/False, Mensaje, WebUrl)
-    """
-    if not os.path.exists(ruta_local):
-        return False, "Archivo local no existe", None
+# --- SHAREPOINT: CACHÉ DE IDs DE SITIO Y BIBLIOTECA ---
+_sp_lock = threading.Lock()
+_sp_cache = {"site_id": None, "drive_id": None, "expira": 0.0}
 
-    token = _obtener_token_graph()
-    if not token:
-        return False, "No se pudo autenticar con Graph", None
+def _es_no_encontrado(r):
+    if r.status_code == 404: return True
+    try:
+        return r.json().get('error', {}).get('code') == 'itemNotFound'
+    except Exception:
+        return False
 
-    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
-    filename = os.path.basename(ruta_local)
-    
-    cliente_limpio = _sanitizar_nombre(cliente)
-    fecha_carpeta = obtener_hora_chile().strftime('%Y-%m-%d')
+def invalidar_cache_sharepoint():
+    with _sp_lock:
+        _sp_cache.update({"site_id": None, "drive_id": None, "expira": 0.0})
+
+def _resolver_drive_sharepoint():
+    """
+    Retorna (site_id, drive_id, error). Los IDs se guardan SHAREPOINT_CACHE_TTL
+    segundos; se consultan a Graph solo al expirar o tras un 404/itemNotFound.
+    """
+    with _sp_lock:
+        if _sp_cache["drive_id"] and time.time() < _sp_cache["expira"]:
+            return _sp_cache["site_id"], _sp_cache["drive_id"], None
 
-    try:
         # 1. Obtener ID del Sitio
-        site_url = f"https://graph.microsoft.com/v1.0/sites/{config.SHAREPOINT_HOST_NAME}:{config.SHAREPOINT_SITE_PATH}"
-        r_site = requests.get(site_url, headers=headers)
+        r_site = graph.solicitar("GET", f"/sites/{config.SHAREPOINT_HOST_NAME}:{config.SHAREPOINT_SITE_PATH}")
         if r_site.status_code != 200:
-            return False, f"Error Sitio SP: {r_site.text}", None
+            return None, None, f"Error Sitio SP: {r_site.text}"
         
         site_id = r_site.json()['id']
 
         # 2. Obtener ID del Drive
-        drives_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives"
-        r_drives = requests.get(drives_url, headers=headers)
+        r_drives = graph.solicitar("GET", f"/sites/{site_id}/drives")
         drive_id = None
         
         for d in r_drives.json().get('value', []):
@@ -81,17 +70,74 @@ def subir_archivo_sharepoint(ruta_local, cliente):
             drive_id = r_drives.json()['value'][0]['id']
 
         if not drive_id:
-            return False, "No se encontró biblioteca", None
+            return site_id, None, "No se encontró biblioteca"
+
+        _sp_cache.update({"site_id": site_id, "drive_id": drive_id, "expira": time.time() + config.SHAREPOINT_CACHE_TTL})
+        return site_id, drive_id, None
+
+def precalentar_sharepoint():
+    """Resuelve token e IDs de SharePoint al arrancar, para que la primera subida no pague esas llamadas."""
+    try:
+        token = _obtener_token_graph()
+        if not token: return False
+        _, drive_id, error = _resolver_drive_sharepoint()
+        if error: print(f"⚠️ Precarga SharePoint: {error}")
+        return drive_id is not None
+    except Exception as e:
+        print(f"⚠️ Precarga SharePoint: {e}")
+        return False
+
+# --- SHAREPOINT: SUBIDA POR SESIÓN (archivos sobre el límite de PUT simple) ---
+def _subir_por_sesion(drive_id, ruta_sharepoint, ruta_local, progreso=None):
+    """
+    Sube con createUploadSession en bloques leídos del disco (ver graph.subir_por_bloques).
+    Retorna la Response final de Graph.
+    """
+    r_sesion = graph.solicitar(
+        "POST", f"/drives/{drive_id}/root:{ruta_sharepoint}:/createUploadSession",
+        json={"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+    )
+    if r_sesion.status_code != 200:
+        return r_sesion
+    return graph.subir_por_bloques(r_sesion.json()['uploadUrl'], ruta_local, progreso)
+
+# --- SHAREPOINT: SUBIR ARCHIVO (Retorna URL) ---
+def subir_archivo_sharepoint(ruta_local, cliente, progreso=None):
+    """
+    Sube el PDF a SharePoint y retorna: (True/False, Mensaje, WebUrl)
+    Sobre SHAREPOINT_LIMITE_PUT_SIMPLE bytes usa una sesión de subida por bloques;
+    `progreso(enviados, total)` se llama tras cada bloque.
+    """
+    if not os.path.exists(ruta_local):
+        return False, "Archivo local no existe", None
+
+    token = _obtener_token_graph()
+    if not token:
+        return False, "No se pudo autenticar con Graph", None
+
+    filename = os.path.basename(ruta_local)
+    
+    cliente_limpio = _sanitizar_nombre(cliente)
+    fecha_carpeta = obtener_hora_chile().strftime('%Y-%m-%d')
+
+    try:
+        # 1-2. IDs de Sitio y Drive (cacheados)
+        site_id, drive_id, error = _resolver_drive_sharepoint()
+        if error:
+            return False, error, None
 
         # 3. Subir Archivo
         ruta_sharepoint = f"/{cliente_limpio}/{fecha_carpeta}/{filename}"
-        upload_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root:{ruta_sharepoint}:/content"
+        upload_url = f"/drives/{drive_id}/root:{ruta_sharepoint}:/content"
 
-        with open(ruta_local, 'rb') as f_upload:
-            headers_put = headers.copy()
-            headers_put['Content-Type'] = 'application/pdf'
-            r_up = requests.put(upload_url, headers=headers_put, data=f_upload)
+        if os.path.getsize(ruta_local) > config.SHAREPOINT_LIMITE_PUT_SIMPLE:
+            r_up = _subir_por_sesion(drive_id, ruta_sharepoint, ruta_local, progreso)
+        else:
+            with open(ruta_local, 'rb') as f_upload:
+                r_up = graph.solicitar("PUT", upload_url, headers={'Content-Type': 'application/pdf'},
+                                       data=f_upload, timeout=config.GRAPH_TIMEOUT_SUBIDA)
 
+        if _es_no_encontrado(r_up): invalidar_cache_sharepoint()
         if r_up.status_code in [200, 201]:
             resp = r_up.json()
             web_url = resp.get('webUrl', '') # Link directo al archivo
@@ -112,12 +158,7 @@ def crear_item_lista(datos):
     if not token: return False, "No token"
 
     # URL directa usando los IDs configurados
-    url = f"https://graph.microsoft.com/v1.0/sites/{config.SHAREPOINT_SITE_ID}/lists/{config.SHAREPOINT_LIST_ID}/items"
-    
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
+    url = f"/sites/{config.SHAREPOINT_SITE_ID}/lists/{config.SHAREPOINT_LIST_ID}/items"
 
     # Asegúrate de que los nombres de las claves ("Title", "Cliente", etc.)
     # coincidan EXACTAMENTE con las columnas 'internal name' de tu lista SharePoint.
@@ -132,7 +173,7 @@ def crear_item_lista(datos):
     }
 
     try:
-        r = requests.post(url, headers=headers, json=cuerpo)
+        r = graph.solicitar("POST", url, json=cuerpo)
         if r.status_code == 201:
             return True, "Item creado en lista"
         else:
@@ -141,112 +182,20 @@ def crear_item_lista(datos):
         return False, f"Excepción Lista: {e}"
 
 # --- EMAIL (CON COPIA A TÉCNICO) ---
-def enviar_correo_graph(ruta_pdf, cliente, tecnico, email_tecnico=None):
-    if not os.path.exists(ruta_pdf): return False, "PDF no existe."
-    
-    destinatario = config.CORREOS_POR_CLIENTE.get(cliente, "")
-    if not destinatario: return False, f"No hay correo para {cliente}"
-
-    token = _obtener_token_graph()
-    if not token: return False, "Error Auth Azure"
+def enviar_correo_graph(ruta_pdf, cliente, tecnico, email_tecnico=None, email_cliente=None):
+    # El armado y envío viven en correo.py (también el envío por lotes)
+    return correo.enviar_correo(ruta_pdf, cliente, tecnico, email_tecnico, email_cliente)
 
-    with open(ruta_pdf, "rb") as f:
-        pdf_content = base64.b64encode(f.read()).decode("utf-8")
-    
-    # --- DISEÑO DE CORREO MEJORADO ---
-    color = config.COLOR_PRIMARIO
-    html_body = f"""
-    <!DOCTYPE html>
-    <html>
-    <body style="margin:0; padding:0; font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f4f4f4;">
-        <table width="100%" border="0" cellspacing="0" cellpadding="0">
-            <tr>
-                <td align="center" style="padding: 20px;">
-                    <table width="600" border="0" cellspacing="0" cellpadding="0" style="background-color: #ffffff; border-radius: 8px; overflow: hidden; box-shadow: 0 4px 10px rgba(0,0,0,0.1);">
-                        <tr>
-                            <td bgcolor="{color}" style="padding: 30px; text-align: center; color: #ffffff;">
-                                <h1 style="margin:0; font-size: 24px; font-weight: 600;">REPORTE TÉCNICO</h1>
-                                <p style="margin:5px 0 0; font-size: 14px; opacity: 0.9;">Servicio de Visita en Terreno</p>
-                            </td>
-                        </tr>
-                        <tr>
-                            <td style="padding: 40px 30px; color: #333333;">
-                                <p style="font-size: 16px; margin-bottom: 20px;">Estimados <strong>{cliente}</strong>,</p>
-                                <p style="line-height: 1.6; color: #555;">
-                                    Se ha completado satisfactoriamente la visita técnica programada. A continuación, se detallan los datos del servicio realizado por nuestro especialista.
-                                </p>
-                                
-                                <table width="100%" border="0" cellspacing="0" cellpadding="10" style="margin: 20px 0; background-color: #f9f9f9; border-left: 4px solid {color};">
-                                    <tr>
-                                        <td width="30%" style="font-weight: bold; color: #777;">TÉCNICO:</td>
-                                        <td style="font-weight: 600; color: #333;">{tecnico}</td>
-                                    </tr>
-                                    <tr>
-                                        <td style="font-weight: bold; color: #777;">FECHA:</td>
-                                        <td style="font-weight: 600; color: #333;">{datetime.datetime.now().strftime('%d/%m/%Y')}</td>
-                                    </tr>
-                                    <tr>
-                                        <td style="font-weight: bold; color: #777;">ESTADO:</td>
-                                        <td style="color: #27ae60; font-weight: bold;">✅ Finalizado con Éxito</td>
-                                    </tr>
-                                </table>
-
-                                <p style="text-align: center; font-size: 14px; color: #888; margin-top: 30px;">
-                                    📎 El informe completo se encuentra adjunto en formato PDF.
-                                </p>
-                            </td>
-                        </tr>
-                        <tr>
-                            <td bgcolor="#eeeeee" style="padding: 20px; text-align: center; font-size: 12px; color: #999;">
-                                <p style="margin: 0;">&copy; {datetime.datetime.now().year} {config.EMPRESA_NOMBRE}</p>
-                                <p style="margin: 5px 0 0;">Por favor, no responder a este correo automático.</p>
-                            </td>
-                        </tr>
-                    </table>
-                </td>
-            </tr>
-        </table>
-    </body>
-    </html>
-    """
-    # ... (El resto del código de envío es igual, usando html_body) ...
-    # Asegúrate de incluir el bloque de destinations y request.post aquí
-    # Si necesitas el bloque completo de nuevo, pídelo, pero es reemplazar solo el html_body
-
-    # Construimos destinatarios
-    destinatarios = [{"emailAddress": {"address": destinatario}}]
-    
-    # Si hay email técnico, lo agregamos como destinatario (o podrías usar ccRecipients)
-    cc_destinatarios = []
-    if email_tecnico:
-        cc_destinatarios.append({"emailAddress": {"address": email_tecnico}})
-
-    email_data = {
-        "message": {
-            "subject": f"📍 Reporte Visita - {cliente}",
-            "body": {"contentType": "HTML", "content": html_body},
-            "toRecipients": destinatarios,
-            "ccRecipients": cc_destinatarios, # Agregamos copia aquí
-            "attachments": [{
-                "@odata.type": "#microsoft.graph.fileAttachment",
-                "name": os.path.basename(ruta_pdf),
-                "contentType": "application/pdf",
-                "contentBytes": pdf_content
-            }]
-        },
-        "saveToSentItems": "true"
-    }
-
-    try:
-        r = requests.post(
-            f"https://graph.microsoft.com/v1.0/users/{config.GRAPH_USER_EMAIL}/sendMail",
-            headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'},
-            json=email_data
-        )
-        if r.status_code == 202: return True, "Correo enviado"
-        return False, f"Error Email: {r.text}"
-    except Exception as e:
-        return False, f"Excepción Email: {e}"
+# --- LIMPIEZA DE ARCHIVOS TEMPORALES ---
+def eliminar_archivos_temporales(rutas):
+    print(f"🧹 Iniciando limpieza de {len(rutas)} archivos temporales...")
+    for ruta in rutas:
+        try:
+            if ruta and os.path.exists(ruta):
+                os.remove(ruta)
+                print(f"   - Borrado: {ruta}")
+        except Exception as e:
+            print(f"   ⚠️ Error borrando {ruta}: {e}")
 
 def guardar_firma_img(trazos, nombre_archivo="firma_temp.png"):
     if not trazos: return None
@@ -259,6 +208,61 @@ def guardar_firma_img(trazos, nombre_archivo="firma_temp.png"):
         elif len(t) == 1: draw.point(t[0], fill="black")
     img.save(path); return path
 
-def subir_backup_database():
-    # ... (Misma lógica de backup que tenías antes, omitida por brevedad si no cambió)
-    return True, "Backup OK"
\ No newline at end of file
+# --- SHAREPOINT: RESPALDOS DE LA BASE (ver backup.py) ---
+def subir_backup_sharepoint(ruta_local):
+    """Sube un respaldo a SHAREPOINT_BACKUP_FOLDER con su mismo nombre. Retorna (True/False, Mensaje)."""
+    if not _obtener_token_graph():
+        return False, "No se pudo autenticar con Graph"
+    try:
+        _, drive_id, error = _resolver_drive_sharepoint()
+        if error: return False, error
+        ruta_sharepoint = f"/{config.SHAREPOINT_BACKUP_FOLDER}/{os.path.basename(ruta_local)}"
+        # Siempre por sesión: el respaldo puede crecer más allá del PUT simple y así se reanuda
+        r_up = _subir_por_sesion(drive_id, ruta_sharepoint, ruta_local)
+        if _es_no_encontrado(r_up): invalidar_cache_sharepoint()
+        if r_up.status_code in [200, 201]:
+            return True, f"Respaldo subido a '{config.SHAREPOINT_BACKUP_FOLDER}'"
+        return False, f"Error subida respaldo: {r_up.status_code}"
+    except Exception as e:
+        return False, f"Excepción respaldo: {e}"
+
+def listar_backups_sharepoint():
+    """{nombre: item_id} de los archivos en SHAREPOINT_BACKUP_FOLDER."""
+    _, drive_id, error = _resolver_drive_sharepoint()
+    if error: raise RuntimeError(error)
+    archivos = {}
+    url = f"/drives/{drive_id}/root:/{config.SHAREPOINT_BACKUP_FOLDER}:/children?$select=id,name&$top=200"
+    while url:
+        r = graph.solicitar("GET", url)
+        if r.status_code != 200:
+            raise RuntimeError(f"Error listando respaldos: {r.status_code}")
+        js = r.json()
+        archivos.update({i['name']: i['id'] for i in js.get('value', [])})
+        url = js.get('@odata.nextLink')
+    return archivos
+
+def borrar_backups_sharepoint(item_ids):
+    """Borra esos archivos de la biblioteca. Retorna cuántos borró."""
+    _, drive_id, error = _resolver_drive_sharepoint()
+    if error: raise RuntimeError(error)
+    borrados = 0
+    for item_id in item_ids:
+        r = graph.solicitar("DELETE", f"/drives/{drive_id}/items/{item_id}")
+        if r.status_code in [204, 404]: borrados += 1
+        else: print(f"   ⚠️ No se pudo borrar el respaldo {item_id}: {r.status_code}")
+    return borrados
+
+def descargar_backup_sharepoint(item_id, destino):
+    """Descarga un respaldo a `destino` en bloques (sin cargarlo en memoria)."""
+    _, drive_id, error = _resolver_drive_sharepoint()
+    if error: raise RuntimeError(error)
+    r = graph.solicitar("GET", f"/drives/{drive_id}/items/{item_id}/content",
+                        timeout=config.GRAPH_TIMEOUT_SUBIDA, stream=True)
+    try:
+        if r.status_code != 200:
+            raise RuntimeError(f"Error descargando respaldo: {r.status_code}")
+        with open(destino, 'wb') as f:
+            for bloque in r.iter_content(1024 * 1024):
+                f.write(bloque)
+    finally:
+        r.close()